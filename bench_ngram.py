@@ -0,0 +1,579 @@
+#! /usr/bin/env python3
+
+# System
+import sys
+import os
+import time
+import tempfile
+import filecmp
+import platform
+import subprocess
+import tracemalloc
+from argparse import ArgumentParser
+import json
+
+# Math
+import random
+from statistics import median
+
+# Data Structures
+from collections import Counter
+
+# NGram
+import ngram
+
+# Logging
+import logging
+LOGGER = logging.getLogger(__name__)
+SH = logging.StreamHandler()
+SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+LOGGER.setLevel(logging.DEBUG)
+
+BENCH_VERSION = 1
+DEFAULT_CORPUS = "trumpTexts.json"
+THRESHOLD = 0.2
+MIN_SECONDS = 0.001
+IMPORT_BUDGET = 0.1
+WALK_OVERHEAD = 0.3
+PRUNE_SETTINGS = ["none", "quantize", "min=2", "min=2,3", "top=4", "bytes=0.5", "bytes=0.25+quantize"]
+HELD_OUT = 0.1
+
+# Run in a fresh interpreter, as tweet_ngram is from cron
+COLD_START = """
+import sys, time, json
+began = time.perf_counter()
+import ngram
+imported = time.perf_counter()
+ngram.load_model(sys.argv[1], int(sys.argv[2])).make_ngram_sentence(int(sys.argv[2]))
+json.dump({"import" : imported - began, "seconds" : time.perf_counter() - began,
+        "nltk" : "nltk" in sys.modules}, sys.stdout)
+"""
+
+DESCRIPTION="""Times the n-gram build and generation stages on a corpus scaled up by repeating its documents."""
+def get_arg_parser():
+    parser = ArgumentParser(prog=sys.argv[0], description=DESCRIPTION)
+    parser.add_argument("-i", "--info",
+            action = "store_true",
+            help = "set console logging output to INFO")
+    parser.add_argument("-d", "--debug",
+            action = "store_true",
+            help = "set console logging output to DEBUG")
+    parser.add_argument("-q", "--quiet",
+            action = "store_true",
+            help = "set console logging output to ERROR (mostly quiet output)")
+    parser.add_argument(
+            metavar = "<text.json>",
+            dest = "texts_filename",
+            nargs = "?",
+            default = DEFAULT_CORPUS,
+            help = "JSON corpus to benchmark on (default: %s)" % DEFAULT_CORPUS)
+    parser.add_argument("--scales",
+            type = int,
+            nargs = "+",
+            default = [1, 10],
+            help = "times to repeat the corpus, one run each (default: 1 10, 100 for the full suite)")
+    parser.add_argument("--high",
+            type = int,
+            default = 4,
+            help = "largest n to build and generate with (default: 4)")
+    parser.add_argument("--compact",
+            action = "store_true",
+            help = "benchmark the compact token stream storage")
+    parser.add_argument("--tokenizer",
+            choices = sorted(ngram.TOKENIZERS),
+            default = "word_tokenize",
+            help = "tokenizer to benchmark (default: word_tokenize)")
+    parser.add_argument("--sampling",
+            choices = ngram.SAMPLING,
+            default = "cumulative",
+            help = "successor sampling to benchmark (default: cumulative)")
+    parser.add_argument("--max-memory",
+            type = int,
+            metavar = "MB",
+            help = "also time building the model out of core within this many megabytes of counts")
+    parser.add_argument("--sentences",
+            type = int,
+            default = 100,
+            help = "sentences generated for each n and link type (default: 100)")
+    parser.add_argument("--max-chars",
+            type = int,
+            help = "generate sentences within this many characters")
+    parser.add_argument("--repeat",
+            type = int,
+            default = 3,
+            help = "runs of each stage, of which the median is kept (default: 3)")
+    parser.add_argument("--no-memory",
+            dest = "memory",
+            action = "store_false",
+            help = "skip the extra traced run of each stage that measures its peak memory")
+    parser.add_argument("--seed",
+            type = int,
+            default = 0,
+            help = "seed for scaling the corpus and generating (default: 0)")
+    parser.add_argument("-j", "--jobs",
+            type = int,
+            default = 1,
+            help = "also time generating across this many processes from the mapped model (default: 1, skipped)")
+    parser.add_argument("--prune",
+            nargs = "*",
+            metavar = "SETTING",
+            help = "also report model size against quality for each pruning, any of none, quantize, "
+                "min=<counts from bigrams up>, top=<successors> or bytes=<fraction of the unpruned model> "
+                "joined with + (default: %s)" % " ".join(PRUNE_SETTINGS))
+    parser.add_argument("-o", "--output",
+            help = "JSON file to write the results to, for a later --baseline or --results")
+    parser.add_argument("-b", "--baseline",
+            help = "JSON results to compare against, exiting 1 on any regression")
+    parser.add_argument("--results",
+            help = "compare these stored JSON results instead of running the benchmarks")
+    parser.add_argument("--threshold",
+            type = float,
+            default = THRESHOLD,
+            help = "fraction a stage may grow before it counts as a regression (default: %.2f)" % THRESHOLD)
+    parser.add_argument("--walk-overhead",
+            type = float,
+            default = WALK_OVERHEAD,
+            help = "fraction an unbounded sentence may take beyond a plain walk, exiting 1 beyond it (default: %.2f)"
+                % WALK_OVERHEAD)
+    parser.add_argument("--import-budget",
+            type = float,
+            default = IMPORT_BUDGET,
+            help = "seconds a fresh interpreter may take to import ngram, exiting 1 beyond it (default: %.2f)" % IMPORT_BUDGET)
+    return parser
+
+def scale_documents(documents, scale, seed = 0):
+    """The documents repeated scale times, each copy after the first in its
+    own seeded order so grams across documents vary between copies."""
+    scaled = list(documents)
+    for copy in range(1, scale):
+        order = list(documents)
+        random.Random(seed + copy).shuffle(order)
+        scaled.extend(order)
+    return scaled
+
+def measure(function, *args, repeat = 1, memory = True):
+    """Runs function repeat times and returns its last result with the
+    median seconds and, from one more traced run, its peak bytes."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    stats = {"seconds" : median(times), "runs" : repeat}
+    if memory:
+        tracemalloc.start()
+        try:
+            function(*args)
+            stats["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+def count_tokens(token_lists, low, high):
+    counter = ngram.NGramCounter(low, high)
+    for tokens in token_lists:
+        counter.add(tokens)
+    return counter
+def intern_tokens(token_lists):
+    vocabulary = ngram.Vocabulary()
+    stream = ngram.array(ngram.ID_TYPECODE)
+    for tokens in token_lists:
+        stream.extend(vocabulary.encode(tokens))
+    return vocabulary, stream
+
+def index_spans(token_lists):
+    spans = ngram.SpanIndex()
+    for tokens in token_lists:
+        spans.add(tokens)
+    spans.freeze()
+    return spans
+
+def build_generator(token_lists, args, record):
+    """Builds a generator one stage at a time as NGram.build does, recording
+    each stage."""
+    low, high = 1, args.high
+    generator = ngram.NGram([], low, high, compact = args.compact, sampling = args.sampling, tokenizer = args.tokenizer)
+    if args.compact:
+        (vocabulary, stream), stats = measure(intern_tokens, token_lists, repeat = args.repeat, memory = args.memory)
+        record("intern", stats, tokens = len(stream), vocabulary = len(vocabulary))
+        generator.vocabulary, generator.stream = vocabulary, stream
+        generator.sentence_end = set(vocabulary.ids[t] for t in ngram.SENTENCE_END if t in vocabulary.ids)
+        generator.grams, stats = measure(ngram.build_compact_ngrams, stream, low, high,
+                repeat = args.repeat, memory = args.memory)
+        record("grams", stats)
+        generator.lookup, stats = measure(ngram.build_compact_lookup, stream, vocabulary, low, high,
+                repeat = args.repeat, memory = args.memory)
+        record("lookup", stats)
+        generator.starter_grams, stats = measure(ngram.find_compact_starter_grams, stream, vocabulary, low, high,
+                repeat = args.repeat, memory = args.memory)
+        record("starters", stats)
+    else:
+        generator.counter, stats = measure(count_tokens, token_lists, low, high,
+                repeat = args.repeat, memory = args.memory)
+        grams = generator.grams = generator.counter.grams
+        record("grams", stats, grams = {n: len(grams[n]) for n in grams})
+        generator.lookup, stats = measure(ngram.build_successor_tables, grams, args.sampling,
+                repeat = args.repeat, memory = args.memory)
+        record("lookup", stats, prefixes = {n: len(generator.lookup[n]) for n in generator.lookup})
+        generator.starter_grams, stats = measure(ngram.find_starter_tables, grams, args.sampling,
+                repeat = args.repeat, memory = args.memory)
+        record("starters", stats)
+    generator.spans, stats = measure(index_spans, token_lists, repeat = args.repeat, memory = args.memory)
+    record("spans", stats, spans = len(generator.spans))
+    return generator
+
+def build_spilled(token_lists, filename, args):
+    """Counts out of core and writes the model, returning the runs spilled."""
+    with tempfile.TemporaryDirectory(dir = os.path.dirname(filename)) as directory:
+        counter = ngram.SpillingCounter(1, args.high, directory, args.max_memory << 20)
+        for tokens in token_lists:
+            counter.add(tokens)
+        ngram.save_spilled_model(counter, filename, tokenizer = args.tokenizer)
+    return counter.spilled
+
+def generate(generator, count, n, link_type, max_chars, seed):
+    return sum(1 for _ in generator.make_ngram_sentences(count, n, link_type, max_chars, seed = seed))
+def walk_plain(generator, count, n, link_type, seed):
+    # Sampling and backing off then joining, and nothing else, what an unbounded sentence should cost
+    for index in range(count):
+        words = ngram.generate_ngram_sentence(generator.starter_grams, generator.lookup, n, link_type,
+                generator.sentence_end, verbose = False, rng = random.Random(ngram.sentence_seed(seed, index)))
+        generator.join_sentence(words, verbose = False)
+    return count
+def score(generator, token_lists):
+    return len(generator.token_scores(token_lists))
+def reverse_index(generator, n):
+    generator.reverse_lookup()
+    return len(generator.reverse_remaining(n))
+def pick_keywords(generator, token_lists, n, count, max_chars, seed):
+    # Words of the sentences that a sentence within max_chars can be walked through, to time replies with
+    words = sorted(set(token for tokens in token_lists for token in tokens if token.isalpha()))
+    random.Random(seed).shuffle(words)
+    keywords = []
+    for word in words:
+        try:
+            next(generator.make_ngram_sentences(1, n, None, max_chars, seed = ngram.sentence_seed(seed, len(keywords)),
+                    keyword = word))
+        except ValueError:
+            continue
+        keywords.append(word)
+        if len(keywords) == count:
+            break
+    return keywords
+def reply(generator, keywords, n, max_chars, seed):
+    return sum(1 for index, keyword in enumerate(keywords) for _ in generator.make_ngram_sentences(1, n, None,
+            max_chars, seed = ngram.sentence_seed(seed, index), keyword = keyword))
+def generate_parallel(generator, count, n, link_type, max_chars, seed, jobs):
+    return sum(1 for _ in generator.make_parallel_sentences(count, n, link_type, max_chars, seed = seed, jobs = jobs))
+
+def cold_start(filename, n, repeat = 1):
+    """Times fresh interpreters importing ngram and generating one sentence
+    from the model file, returning the median seconds for the import and for
+    the whole run, and whether generating imported nltk."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", COLD_START, os.path.abspath(filename), str(n)],
+                cwd = os.path.dirname(os.path.abspath(ngram.__file__)))
+        runs.append(json.loads(output.decode("utf-8")))
+    return {"seconds" : median(r["seconds"] for r in runs), "import" : median(r["import"] for r in runs),
+            "nltk" : any(r["nltk"] for r in runs), "runs" : repeat}
+
+def run_scale(documents, scale, args, directory):
+    LOGGER.info("Benchmarking at %dx" % scale)
+    results = {}
+    def record(stage, stats, **extra):
+        stats.update(extra)
+        results[stage] = stats
+        LOGGER.info("%dx %s: %.4fs" % (scale, stage, stats["seconds"]))
+
+    scaled = scale_documents(documents, scale, args.seed)
+    record("corpus", {"seconds" : 0.0}, documents = len(scaled), characters = sum(len(d) for d in scaled))
+    token_lists, stats = measure(lambda d: list(ngram.tokenize_documents(d, args.tokenizer)), scaled,
+            repeat = args.repeat, memory = args.memory)
+    record("tokenize", stats, tokens = sum(len(t) for t in token_lists))
+    generator = build_generator(token_lists, args, record)
+
+    filename = os.path.join(directory, "bench-%d-ngram.model" % scale)
+    _, stats = measure(ngram.save_model, generator, filename, repeat = args.repeat, memory = args.memory)
+    record("save", stats, model_bytes = os.path.getsize(filename))
+    if args.max_memory and not args.compact:
+        external = os.path.join(directory, "bench-%d-external.model" % scale)
+        spilled, stats = measure(build_spilled, token_lists, external, args, repeat = args.repeat, memory = args.memory)
+        record("external", stats, spilled = spilled, identical = filecmp.cmp(filename, external, shallow = False))
+    del token_lists
+    mapped, stats = measure(ngram.MappedNGram, filename, repeat = args.repeat, memory = args.memory)
+    record("load", stats)
+    record("cold_start", cold_start(filename, args.high, args.repeat))
+
+    for source, model in (("memory", generator), ("mapped", mapped)):
+        for n in range(2, args.high + 1):
+            for link_type in ngram.LINK_TYPES:
+                _, stats = measure(generate, model, args.sentences, n, link_type, args.max_chars, args.seed,
+                        repeat = args.repeat, memory = args.memory)
+                stats["seconds"] /= args.sentences
+                record("generate/%s/%d/%s" % (source, n, str(link_type).lower()), stats, sentences = args.sentences)
+                if args.max_chars is None:
+                    _, stats = measure(walk_plain, model, args.sentences, n, link_type, args.seed,
+                            repeat = args.repeat, memory = False)
+                    stats["seconds"] /= args.sentences
+                    record("walk/%s/%d/%s" % (source, n, str(link_type).lower()), stats, sentences = args.sentences)
+        sentences = model.make_ngram_sentences(args.sentences, args.high, None, args.max_chars, seed = args.seed)
+        token_lists = list(ngram.tokenize_documents(sentences, args.tokenizer))
+        _, stats = measure(score, model, token_lists, repeat = args.repeat, memory = args.memory)
+        stats["seconds"] /= args.sentences
+        record("score/%s" % source, stats, sentences = args.sentences, tokens = sum(len(t) for t in token_lists))
+        _, stats = measure(reverse_index, model, args.high, memory = False)
+        record("reverse/%s" % source, stats)
+        keywords = pick_keywords(model, token_lists, args.high, args.sentences, args.max_chars, args.seed)
+        if keywords:
+            _, stats = measure(reply, model, keywords, args.high, args.max_chars, args.seed,
+                    repeat = args.repeat, memory = args.memory)
+            stats["seconds"] /= len(keywords)
+            record("keyword/%s" % source, stats, sentences = len(keywords))
+    if args.jobs > 1:
+        # Enough sentences per process to outweigh starting the pool
+        count = args.sentences * args.jobs
+        _, stats = measure(generate_parallel, mapped, count, args.high, None, args.max_chars, args.seed, args.jobs,
+                repeat = args.repeat, memory = False)
+        stats["seconds"] /= count
+        record("generate/parallel/%d" % args.high, stats, sentences = count, jobs = args.jobs)
+    return results
+
+def pruning_params(setting, high, unpruned_bytes):
+    # NGram keyword arguments for one --prune setting
+    params = {}
+    for part in setting.split("+"):
+        name, _, value = part.partition("=")
+        if name == "quantize":
+            params["quantize"] = True
+        elif name == "min":
+            params["min_counts"] = ngram.order_min_counts([int(c) for c in value.split(",")], high)
+        elif name == "top":
+            params["top_k"] = int(value)
+        elif name == "bytes":
+            params["max_bytes"] = int(float(value) * unpruned_bytes)
+        elif name != "none":
+            raise ValueError("Unknown pruning %s" % part)
+    return params
+
+def copy_counter(counter):
+    # Pruning takes grams out of the counter it builds from
+    copy = ngram.NGramCounter(counter.low, counter.high)
+    copy.grams = {n: Counter(counts) for n, counts in counter.grams.items()}
+    copy.tail = list(counter.tail)
+    return copy
+
+def coverage(generator, held_out, n):
+    # Share of the held out order n grams that the model still has
+    counts = held_out[n]
+    known = sum(count for gram, count in counts.items() if gram in generator.grams[n])
+    return known / sum(counts.values()) if counts else 0.0
+
+def sample_quality(model, count, n, max_chars, seed):
+    """Walks count sentences and returns the share copying the corpus, the
+    distinct order n grams per order n gram walked and the mean characters."""
+    copied, chars, grams = 0, 0, []
+    for index in range(count):
+        words = model.walk(n, None, max_chars, None, verbose = False,
+                rng = random.Random(ngram.sentence_seed(seed, index)))
+        copied += model.copies(words)
+        chars += len(model.join_sentence(words, verbose = False))
+        tokens = model.vocabulary.decode(words)
+        grams.extend(zip(*[tokens[i:] for i in range(n)]))
+    return {"copied" : copied / count, "distinct" : len(set(grams)) / len(grams) if grams else 0.0,
+            "chars" : chars / count}
+
+def prune_report(documents, args, directory):
+    """Builds the model from all but the last HELD_OUT of the documents with
+    each --prune setting, recording its size against how much of the held out
+    text it still knows and how the sentences it walks turn out. bytes
+    settings are fractions of the unpruned model file."""
+    held = max(int(len(documents) * HELD_OUT), 1)
+    token_lists = list(ngram.tokenize_documents(documents, args.tokenizer))
+    training, held_out = token_lists[:-held], token_lists[-held:]
+    counter = count_tokens(training, 1, args.high)
+    spans = index_spans(training)
+    held_out = count_tokens(held_out, 1, args.high).grams
+    settings = args.prune or PRUNE_SETTINGS
+    rows, unpruned_bytes = [], None
+    for setting in ["none"] + [s for s in settings if s != "none"]:
+        params = pruning_params(setting, args.high, unpruned_bytes or 0)
+        start = time.perf_counter()
+        generator = ngram.NGram([], 1, args.high, counter = copy_counter(counter), spans = spans,
+                sampling = args.sampling, tokenizer = args.tokenizer, **params)
+        seconds = time.perf_counter() - start
+        filename = os.path.join(directory, "prune-ngram.model")
+        ngram.save_model(generator, filename)
+        model_bytes = os.path.getsize(filename)
+        if unpruned_bytes is None:
+            unpruned_bytes = model_bytes
+            if "none" not in settings:
+                continue
+        mapped = ngram.MappedNGram(filename)
+        row = {"setting" : setting, "seconds" : seconds, "model_bytes" : model_bytes,
+                "size" : model_bytes / unpruned_bytes, "footprint" : generator.footprint(),
+                "grams" : {n: len(generator.grams[n]) for n in generator.grams},
+                "coverage" : {n: coverage(generator, held_out, n) for n in range(2, args.high + 1)}}
+        row.update(sample_quality(mapped, args.sentences, args.high, args.max_chars, args.seed))
+        LOGGER.info("%s: %d bytes" % (setting, model_bytes))
+        rows.append(row)
+        del mapped
+    return rows
+
+def print_prune_report(rows):
+    high = max(int(n) for n in rows[0]["coverage"])
+    print("%-22s %12s %6s %9s %9s %7s %8s %6s" % ("pruning", "model bytes", "size", "held 2", "held %d" % high,
+            "copied", "distinct", "chars"))
+    for row in rows:
+        coverage = {int(n): value for n, value in row["coverage"].items()}
+        print("%-22s %12d %6.3f %9.3f %9.3f %7.3f %8.3f %6.1f" % (row["setting"], row["model_bytes"], row["size"],
+                coverage[2], coverage[high], row["copied"], row["distinct"], row["chars"]))
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL,
+                cwd = os.path.dirname(os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    LOGGER.info("Reading %s" % args.texts_filename)
+    documents = [ngram.normalize_text(text) for text in ngram.iter_documents(args.texts_filename)]
+    results = {
+            "version" : BENCH_VERSION,
+            "environment" : {
+                "python" : platform.python_version(),
+                "implementation" : platform.python_implementation(),
+                "platform" : platform.platform(),
+                "processor" : platform.processor() or platform.machine(),
+                "revision" : git_revision(),
+                "model_version" : ngram.MODEL_VERSION,
+                },
+            "parameters" : {
+                "corpus" : os.path.basename(args.texts_filename),
+                "corpus_digest" : ngram.corpus_digest(args.texts_filename),
+                "high" : args.high,
+                "compact" : args.compact,
+                "tokenizer" : args.tokenizer,
+                "sampling" : args.sampling,
+                "sentences" : args.sentences,
+                "max_chars" : args.max_chars,
+                "repeat" : args.repeat,
+                "seed" : args.seed,
+                "jobs" : args.jobs,
+                "prune" : args.prune,
+                "max_memory" : args.max_memory,
+                },
+            "scales" : {},
+            }
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in args.scales:
+            results["scales"][str(scale)] = run_scale(documents, scale, args, directory)
+        if args.prune is not None:
+            results["prune"] = prune_report(documents, args, directory)
+    return results
+
+def check_budget(results, budget = IMPORT_BUDGET):
+    """Returns a line for every scale whose cold start took longer than
+    budget to import ngram or imported nltk just to generate."""
+    failures = []
+    for scale, stages in sorted(results["scales"].items(), key = lambda item: int(item[0])):
+        start = stages.get("cold_start")
+        if start is None:
+            continue
+        if start["import"] > budget:
+            failures.append("%sx import: %.4fs over the %.4fs budget" % (scale, start["import"], budget))
+        if start["nltk"]:
+            failures.append("%sx generate: imported nltk" % scale)
+    return failures
+
+def check_overhead(results, overhead = WALK_OVERHEAD):
+    """Returns a line for every scale and model whose unbounded sentences,
+    summed over each n and link type, took more than overhead longer than
+    plain walks of the same sentences, as they would paying for length
+    budgets they weren't given. Summing steadies stages of a few
+    milliseconds each."""
+    failures = []
+    for scale, stages in sorted(results["scales"].items(), key = lambda item: int(item[0])):
+        totals = {}
+        for stage, walk in stages.items():
+            generate = stages.get("generate/" + stage[len("walk/"):])
+            if not stage.startswith("walk/") or generate is None:
+                continue
+            source = stage.split("/")[1]
+            spent, plain = totals.get(source, (0.0, 0.0))
+            totals[source] = (spent + generate["seconds"], plain + walk["seconds"])
+        for source, (spent, plain) in sorted(totals.items()):
+            if spent > plain * (1 + overhead):
+                failures.append("%sx generate/%s: %.6gs against %.6gs walking plainly, summed over n and link types"
+                        % (scale, source, spent, plain))
+    return failures
+
+def compare(results, baseline, threshold = THRESHOLD):
+    """Returns a line for every stage that got more than threshold slower or
+    bigger than in the baseline. Stages only in one of them are skipped."""
+    if results.get("parameters") != baseline.get("parameters"):
+        LOGGER.warning("Comparing results run with different parameters")
+    regressions = []
+    for scale, stages in sorted(results["scales"].items(), key = lambda item: int(item[0])):
+        for stage, stats in stages.items():
+            base = baseline["scales"].get(scale, {}).get(stage)
+            if base is None:
+                continue
+            for measurement, floor in (("seconds", MIN_SECONDS), ("peak_bytes", 0)):
+                if measurement not in stats or measurement not in base:
+                    continue
+                new, old = stats[measurement], base[measurement]
+                if new > old * (1 + threshold) and new - old > floor:
+                    regressions.append("%sx %s %s: %.6g -> %.6g (%+.1f%%)" % (
+                            scale, stage, measurement, old, new, 100.0 * (new - old) / old if old else float("inf")))
+    return regressions
+
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    # Logging Information
+    for handler in (SH, ngram.SH):
+        handler.setLevel(logging.WARNING)
+    if args.info:
+        SH.setLevel(logging.INFO)
+    if args.debug:
+        SH.setLevel(logging.DEBUG)
+        ngram.SH.setLevel(logging.DEBUG)
+    if args.quiet:
+        SH.setLevel(logging.ERROR)
+
+    if args.results:
+        with open(args.results, "r") as file:
+            results = json.load(file)
+    else:
+        results = run(args)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent = 2, sort_keys = True)
+            LOGGER.info("Wrote results to %s" % args.output)
+
+    if results.get("prune"):
+        print_prune_report(results["prune"])
+    failures = check_budget(results, args.import_budget) + check_overhead(results, args.walk_overhead)
+    for failure in failures:
+        print("OVER BUDGET %s" % failure)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+        print("No regressions against %s" % args.baseline)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    ngram.configure_logging((LOGGER, SH))
+    LOGGER.info("Beginning Session")
+    rtn = main()
+    LOGGER.info("Ending Session")
+    sys.exit(rtn)
@@ -3,40 +3,67 @@
 # System
 import sys
 import os
-import pickle
+import fcntl
+import time
+import mmap
+import struct
+import tempfile
+import hashlib
+import re
+import threading
+import shutil
+from contextlib import contextmanager
+from concurrent.futures import Future
 from argparse import ArgumentParser
 import json
-from pprint import pformat
 
 # Math
 import random
+from math import log, exp
 
 # Data Structures
+from heapq import nlargest, merge
+from itertools import islice, groupby
 from collections import defaultdict
+from collections import Counter
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
 
 # Logging
 import logging
-from logging import handlers
 LOGGER = logging.getLogger(__name__)
 SH = logging.StreamHandler()
-FH = logging.handlers.RotatingFileHandler(os.path.splitext(sys.argv[0])[0] + ".log", maxBytes=5 * 1000000, backupCount = 5)
 SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
-FH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(lineno)s:%(funcName)s:%(message)s"))
 LOGGER.setLevel(logging.DEBUG)
-LOGGER.addHandler(SH)
-LOGGER.addHandler(FH)
 
 GENSEN = logging.getLogger("generated")
-GS = logging.FileHandler("generated" + ".log")
-GS.setFormatter(logging.Formatter("%(asctime)s:%(message)s"))
 GENSEN.setLevel(logging.INFO)
-GENSEN.addHandler(GS)
+
+def configure_logging(*scripts):
+    """Attaches the console handler and a rotating log file named after the
+    running script to this module's logger and to each (logger, console
+    handler) pair in scripts, and logs generated sentences to generated.log.
+    Scripts call it when run, so importing ngram opens no files."""
+    from logging import handlers
+    filename = os.path.splitext(sys.argv[0])[0] + ".log"
+    for logger, console in ((LOGGER, SH),) + scripts:
+        if console in logger.handlers:
+            continue
+        FH = handlers.RotatingFileHandler(filename, maxBytes=5 * 1000000, backupCount = 5)
+        FH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(lineno)s:%(funcName)s:%(message)s"))
+        logger.addHandler(console)
+        logger.addHandler(FH)
+    if not GENSEN.handlers:
+        GS = logging.FileHandler("generated" + ".log")
+        GS.setFormatter(logging.Formatter("%(asctime)s:%(message)s"))
+        GENSEN.addHandler(GS)
 
 # Natural Language Processing
-from nltk import word_tokenize
-from nltk import pos_tag
-from nltk import everygrams
-from nltk import ngrams
+# nltk takes most of a second to import, so only building from text does
+def word_tokenize(text):
+    from nltk import word_tokenize
+    return word_tokenize(text)
 
 PUNCTUATION = set(",;.!?:'%")
 PUNCTUATION.add("...")
@@ -63,13 +90,78 @@ def get_arg_parser():
             help = "n value")
     parser.add_argument("-c", "--cache",
             action = "store_true",
-            help = "caches NGram object based on JSON and loads if it already exists")
+            help = "maps the cached model file for the JSON if it already exists")
+    parser.add_argument("-m", "--model",
+            action = "store_true",
+            help = "<text.json> is a model file saved by an earlier run: generates from it without reading a corpus")
     parser.add_argument("-l", "--last",
             action = "store_true",
             help = "links on the last word of a gram only")
     parser.add_argument("-r", "--random",
             action = "store_true",
             help = "links on a random number ofthe last words")
+    parser.add_argument("--compact",
+            action = "store_true",
+            help = "stores the model as interned token IDs in typed arrays")
+    parser.add_argument("--sampling",
+            choices = SAMPLING,
+            default = "cumulative",
+            help = "how successor tables are sampled (default: cumulative)")
+    parser.add_argument("--min-count",
+            type = int,
+            nargs = "+",
+            help = "prunes grams seen fewer times than this, per order from bigrams up, the last for every higher order")
+    parser.add_argument("--top-k",
+            type = int,
+            help = "prunes all but this many of the most frequent successors of each prefix")
+    parser.add_argument("--max-bytes",
+            type = int,
+            help = "prunes the rarest grams until the model file fits about this many bytes")
+    parser.add_argument("--quantize",
+            action = "store_true",
+            help = "stores the model's counts in 32 bits instead of 64")
+    parser.add_argument("--max-memory",
+            type = int,
+            metavar = "MB",
+            help = "counts out of core, spilling counts past this many megabytes to disk and merging them")
+    parser.add_argument("--pos",
+            action = "store_true",
+            help = "tags the corpus and generates from a template of part of speech tags instead")
+    parser.add_argument("--max-chars",
+            type = int,
+            help = "generates a sentence no longer than this many characters")
+    parser.add_argument("--min-chars",
+            type = int,
+            help = "avoids ending the sentence before this many characters")
+    parser.add_argument("--novel",
+            action = "store_true",
+            help = "walks sentences again while they copy %d or more tokens in a row from the corpus" % SPAN_TOKENS)
+    parser.add_argument("--count",
+            type = int,
+            help = "generates this many sentences from the one model")
+    parser.add_argument("--pool",
+            type = int,
+            help = "walks this many sentences and prints the --count, one by default, that score best")
+    parser.add_argument("--keyword",
+            help = "generates sentences with this word in them, grown out both ways from where the corpus has it")
+    parser.add_argument("--seed",
+            type = int,
+            help = "seeds generation, so the same model generates the same sentences whatever the --jobs")
+    parser.add_argument("-j", "--jobs",
+            type = int,
+            default = 1,
+            help = "number of processes to build the model and generate --count sentences with (default: 1)")
+    parser.add_argument("--tokenizer",
+            choices = sorted(TOKENIZERS),
+            default = "word_tokenize",
+            help = "how documents are split into tokens (default: word_tokenize)")
+    parser.add_argument("--no-token-cache",
+            dest = "tokens",
+            action = "store_false",
+            help = "tokenizes every document again instead of reusing the corpus's token cache")
+    parser.add_argument("--metrics",
+            metavar = "<metrics file>",
+            help = "writes stage timings and model sizes here, as Prometheus text for .prom files or JSON")
     return parser
 
 def save_as_json(object, filename, check = False):
@@ -89,61 +181,939 @@ def open_json(filename, check = False):
     with open(filename, "r") as file:
         return json.load(file)
 
-def build_ngrams(tokens, low, high):
-    LOGGER.debug("Building ngrams from %d to %d" % (low, high))
-    assert low <= high
-    assert low > 0
-    grams = {}
-    for n in range(low, high + 1):
-        grams[n] = [g for g in ngrams(tokens, n)]
-    return grams
-def build_pos_ngrams(tagged, low, high):
-    LOGGER.debug("Building POS ngrams from %d to %d" % (low, high))
-    assert low <= high
-    assert low > 0
-    pos_tokens = []
-    pos_words = defaultdict(list)
-    for word, pos in tagged:
-        pos_tokens.append(pos)
-        pos_words[pos].append(word)
-    grams = {}
-    for n in range(low, high + 1):
-        grams[n] = [g for g in ngrams(pos_tokens, n)]
-    return grams, pos_words
-def build_prefix_lookup(grams):
-    LOGGER.debug("Building lookup table")
-    lookup = {}
-    for n, tuples in grams.items():
-        LOGGER.debug("Building lookup table for %d" % n)
-        lookup[n] = defaultdict(list)
-        for t in tuples:
-            for i in range(1, n):
-                lookup[n][t[:i]].append(t)
-                #LOGGER.debug("%d:%s:%s" % (i, t[:i], t[-1:]))
-    #for n in lookup:
-    #    LOGGER.debug("Lookup at %d" % n)
-    #    for k,v in lookup[n].items():
-    #        LOGGER.debug("%s:%s" % (k,v))
-    return lookup
-def find_starter_grams(grams):
-    # Find Starter Words
-    LOGGER.debug("Finding starter words")
+@contextmanager
+def atomic_file(filename, mode = "wb"):
+    """Opens a temporary file beside filename to write, and on leaving the
+    block syncs it and moves it over filename, so readers never see it half
+    written. The temporary file is removed if the block raises."""
+    fd, temporary = tempfile.mkstemp(prefix = ".", suffix = ".tmp", dir = os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+# Instrumentation
+class Metrics(object):
+    """Running timers and counters for the build and generation stages, and
+    gauges for the size of the last model built or loaded. Exported as a
+    JSON snapshot or in the Prometheus text format."""
+    def __init__(self, namespace = "ngram"):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self.lock:
+            self.timers = defaultdict(lambda: [0, 0.0])
+            self.counters = Counter()
+            self.gauges = {}
+    def time(self, stage, seconds):
+        with self.lock:
+            timer = self.timers[stage]
+            timer[0] += 1
+            timer[1] += seconds
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.time(stage, time.perf_counter() - start)
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] += amount
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+    def snapshot(self):
+        with self.lock:
+            return {
+                    "timers" : {stage: {"runs" : runs, "seconds" : seconds}
+                        for stage, (runs, seconds) in sorted(self.timers.items())},
+                    "counters" : dict(sorted(self.counters.items())),
+                    "gauges" : [{"name" : name, "labels" : dict(labels), "value" : value}
+                        for (name, labels), value in sorted(self.gauges.items(), key = lambda item: str(item[0]))],
+                    }
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        def family(name, kind, samples):
+            name = "%s_%s" % (self.namespace, name)
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, prometheus_labels(labels), value))
+        family("stage_runs_total", "counter",
+                (({"stage" : stage}, timer["runs"]) for stage, timer in snapshot["timers"].items()))
+        family("stage_seconds_total", "counter",
+                (({"stage" : stage}, repr(timer["seconds"])) for stage, timer in snapshot["timers"].items()))
+        for name, value in snapshot["counters"].items():
+            family("%s_total" % name, "counter", [({}, value)])
+        gauges = defaultdict(list)
+        for gauge in snapshot["gauges"]:
+            gauges[gauge["name"]].append((gauge["labels"], gauge["value"]))
+        for name, samples in gauges.items():
+            family(name, "gauge", samples)
+        return "\n".join(lines) + "\n"
+    def save(self, filename):
+        """Writes the Prometheus text format to .prom files and a JSON
+        snapshot otherwise, replacing the file whole so scrapers never see
+        it half written."""
+        if os.path.splitext(filename)[1] == ".prom":
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.snapshot(), indent = 2) + "\n"
+        with atomic_file(filename, "w") as file:
+            file.write(data)
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % ",".join("%s=\"%s\"" % (key, escape(value)) for key, value in sorted(labels.items()))
+METRICS = Metrics()
+
+# Corpus Streaming
+JSON_CHUNK = 1 << 16
+JSON_SEPARATORS = " \t\r\n,"
+def iter_json_array(file, chunk = JSON_CHUNK):
+    # Decodes one element at a time, reading more only when the buffered text
+    # ends partway through an element
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while not buffer:
+        more = file.read(chunk)
+        buffer = more.lstrip()
+        if not more:
+            break
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array")
+    buffer = buffer[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip(JSON_SEPARATORS)
+        if buffer.startswith("]"):
+            return
+        try:
+            element, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            element, end = None, None
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError("Truncated JSON array")
+            more = file.read(max(chunk, len(buffer)))
+            eof = not more
+            buffer += more
+            continue
+        yield element
+        buffer = buffer[end:]
+def iter_documents(filename, field = "text"):
+    """Yields each document's text from a JSON array or JSON Lines file
+    without loading the whole file."""
+    LOGGER.debug("Streaming documents from '%s'", filename)
+    with open(filename, "r", encoding = "utf-8") as file:
+        first = ""
+        while first.isspace() or not first:
+            first = file.read(1)
+            if not first:
+                return
+        if first == "[":
+            file.seek(0)
+            for document in iter_json_array(file):
+                yield document[field]
+            return
+        yield json.loads(first + file.readline())[field]
+        for line in file:
+            if line.strip():
+                yield json.loads(line)[field]
+
+class NGramCounter(object):
+    """Counts grams of every order one token list at a time. The last few
+    tokens carry over, so grams span documents as they did in joined text."""
+    def __init__(self, low, high):
+        assert low <= high
+        assert low > 0
+        self.low = low
+        self.high = high
+        self.grams = {n: Counter() for n in range(low, high + 1)}
+        self.tail = []
+    def add(self, tokens):
+        window = self.tail + list(tokens)
+        for n, counts in self.grams.items():
+            start = max(len(self.tail) - n + 1, 0)
+            counts.update(zip(*[window[start + i:] for i in range(n)]))
+        self.tail = window[max(len(window) - self.high + 1, 0):] if self.high > 1 else []
+    def merge(self, grams, head, tail):
+        """Adds the counts of a shard counted on its own, after the grams that
+        span the boundary with what came before, so counts and their order
+        match counting the shard's tokens with add."""
+        window = self.tail + head
+        for n, counts in self.grams.items():
+            start = max(len(self.tail) - n + 1, 0)
+            stop = min(len(self.tail), len(window) - n + 1)
+            counts.update(tuple(window[i:i + n]) for i in range(start, stop))
+            counts.update(grams[n])
+        if len(head) < self.high - 1:
+            self.tail = window[max(len(window) - self.high + 1, 0):]
+        else:
+            self.tail = tail
+def find_starter_tables(gram_counts, sampling = "cumulative"):
+    LOGGER.debug("Finding starter tables")
     starter_words = set()
-    starter_words.add(grams[2][0])
-    for bigram in grams[2]:
+    for bigram in gram_counts[2]:
         if bigram[0] in SENTENCE_END and bigram[1][0].isupper():
             starter_words.add(bigram[1])
-    starter_grams = defaultdict(list)
-
-    # Find Grams that Start with a Starter Word
-    LOGGER.debug("Finding starter grams")
-    for n, tuples in grams.items():
-        for tuple in tuples:
-            if tuple[0] in starter_words:
-                starter_grams[n].append(tuple)
+    starter_tables = {}
+    for n, counts in gram_counts.items():
+        counted = [(g, c) for g, c in counts.items() if g[0] in starter_words]
+        starter_tables[n] = SuccessorTables({(): counted}, sampling)[()]
+    return starter_tables
+def build_pos_words(word_counts, sampling = "cumulative"):
+    """Count tables of the words seen with each tag, from counts keyed on
+    (tag, word), so filling in a tag samples its words by frequency."""
+    LOGGER.debug("Building %s word tables for tags", sampling)
+    buckets = defaultdict(list)
+    for (tag, word), count in word_counts.items():
+        buckets[tag].append((word, count))
+    return SuccessorTables(buckets, sampling)
+
+# Typed Array Storage
+ID_TYPECODE = "I"
+COUNT_TYPECODE = "I"
+OFFSET_TYPECODE = "Q"
+def array_bytes(data):
+    return len(data) * data.itemsize if data is not None else 0
+
+# Weighted Sampling
+SAMPLING = ("cumulative", "alias")
+def alias_columns(counts, total):
+    # Integer Vose: every column holds `total` units so no float error creeps in
+    k = len(counts)
+    scaled = [c * k for c in counts]
+    probability = [total] * k
+    alias = list(range(k))
+    small = [i for i in range(k) if scaled[i] < total]
+    large = [i for i in range(k) if scaled[i] >= total]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        probability[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= total - scaled[s]
+        (small if scaled[l] < total else large).append(l)
+    return probability, alias
+class SuccessorTables(object):
+    """Counted successor tables for many prefixes, stored CSR style: each
+    prefix maps to a slice of the distinct grams and their running counts.
+    Alias sampling adds a Vose alias table over the same slice."""
+    def __init__(self, buckets, sampling = "cumulative"):
+        assert sampling in SAMPLING, "Unknown sampling %s" % sampling
+        self.index = {}
+        self.offsets = array(OFFSET_TYPECODE, [0])
+        self.grams = []
+        self.cumulative = array(COUNT_TYPECODE)
+        self.probability = None
+        self.alias = None
+        if sampling == "alias":
+            self.probability = array(OFFSET_TYPECODE)
+            self.alias = array(ID_TYPECODE)
+        for prefix, counted in buckets.items():
+            self.index[prefix] = len(self.offsets) - 1
+            total = 0
+            for gram, count in counted:
+                total += count
+                self.grams.append(gram)
+                self.cumulative.append(total)
+            if self.alias is not None:
+                probability, alias = alias_columns([c for g, c in counted], total)
+                self.probability.extend(probability)
+                self.alias.extend(alias)
+            self.offsets.append(len(self.grams))
+    def __len__(self):
+        return len(self.index)
+    def __iter__(self):
+        return iter(self.index)
+    def __contains__(self, prefix):
+        return prefix in self.index
+    def __getitem__(self, prefix):
+        bucket = self.index[prefix]
+        return SuccessorTable(self, self.offsets[bucket], self.offsets[bucket + 1])
+    def items(self):
+        for prefix in self.index:
+            yield prefix, self[prefix]
+class SuccessorTable(object):
+    """View of the distinct grams sharing one prefix, with their counts."""
+    __slots__ = ("tables", "start", "stop")
+    def __init__(self, tables, start, stop):
+        self.tables = tables
+        self.start = start
+        self.stop = stop
+    def __len__(self):
+        return self.stop - self.start
+    def __iter__(self):
+        previous = 0
+        for ndx in range(self.start, self.stop):
+            cumulative = self.tables.cumulative[ndx]
+            yield self.tables.grams[ndx], cumulative - previous
+            previous = cumulative
+    @property
+    def total(self):
+        return self.tables.cumulative[self.stop - 1] if self.stop > self.start else 0
+    def sample(self, rng = random):
+        if self.stop == self.start:
+            raise IndexError("Cannot sample from an empty table")
+        tables = self.tables
+        if tables.alias is not None:
+            column = self.start + rng.randrange(self.stop - self.start)
+            if rng.randrange(self.total) < tables.probability[column]:
+                return tables.grams[column]
+            return tables.grams[self.start + tables.alias[column]]
+        ndx = bisect_right(tables.cumulative, rng.randrange(self.total), self.start, self.stop)
+        return tables.grams[ndx]
+def build_successor_tables(gram_counts, sampling = "cumulative"):
+    """SuccessorTables for each order, keyed on every prefix of its grams,
+    for models walked in memory, where a step is one dict lookup and a
+    sample from a slice holding whole grams."""
+    LOGGER.debug("Building %s successor tables", sampling)
+    tables = {}
+    for n, counts in gram_counts.items():
+        buckets = defaultdict(list)
+        for gram, count in counts.items():
+            for i in range(1, n):
+                buckets[gram[:i]].append((gram, count))
+        tables[n] = SuccessorTables(buckets, sampling)
+    return tables
+def sample(bucket, rng = random):
+    # Plain lists weight grams by repetition, tables know their own weights
+    if isinstance(bucket, list):
+        return rng.choice(bucket)
+    return bucket.sample(rng)
+def successors(bucket):
+    # Plain lists and compact buckets repeat grams rather than counting them
+    if isinstance(bucket, (list, GramBucket)):
+        return ((g, 1) for g in bucket)
+    return iter(bucket)
+SAMPLE_TRIES = 8
+def sample_where(bucket, accept, tries = SAMPLE_TRIES, rng = random):
+    """Samples a gram that accept allows, weighted as sample would, or
+    returns None if there is none. Rejection sampling handles the common
+    case, falling back to scanning the bucket."""
+    for tried in range(tries):
+        choice = sample(bucket, rng)
+        if accept(choice):
+            if tried:
+                METRICS.count("retries", tried)
+            return choice
+    METRICS.count("retries", tries)
+    METRICS.count("scans")
+    counted = [(g, c) for g, c in successors(bucket) if accept(g)]
+    if not counted:
+        return None
+    r = rng.randrange(sum(c for g, c in counted))
+    for gram, count in counted:
+        r -= count
+        if r < 0:
+            return gram
+
+# Prefix Tries
+class PrefixTrie(object):
+    """The grams of every order in one trie, a level per order, each level
+    sorted typed arrays: the last token ID of every node, where its children
+    start on the level below and the running total of counts along the level.
+    The grams of order n under any prefix are one contiguous run of level n,
+    so one trie serves every order and prefix length while holding each
+    distinct context once. Alias sampling adds a Vose alias table over each
+    node's children, for prefixes one token short of the order."""
+    def __init__(self, ids, children, cumulative, vocabulary = None, probability = None, alias = None):
+        self.ids = ids
+        self.children = children
+        self.cumulative = cumulative
+        self.high = max(ids)
+        # Without a vocabulary grams are tuples of token IDs
+        self.vocabulary = vocabulary
+        self.probability = probability
+        self.alias = alias
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids.values())
+    def find(self, prefix):
+        # The node of prefix on its level, or None
+        if self.vocabulary is not None:
+            known = self.vocabulary.ids
+            prefix = [known.get(token) for token in prefix]
+        node = None
+        for depth, id in enumerate(prefix, 1):
+            ids = self.ids[depth]
+            if node is None:
+                lo, hi = 0, len(ids)
+            else:
+                children = self.children[depth - 1]
+                lo, hi = children[node], children[node + 1]
+            node = bisect_left(ids, id, lo, hi) if id is not None else hi
+            if node == hi or ids[node] != id:
+                return None
+        return node
+    def path(self, ids):
+        # The node of each prefix of ids on its level, for as long as the trie has them
+        nodes = []
+        node = None
+        for depth, id in enumerate(ids, 1):
+            level = self.ids[depth]
+            if node is None:
+                lo, hi = 0, len(level)
+            else:
+                children = self.children[depth - 1]
+                lo, hi = children[node], children[node + 1]
+            node = bisect_left(level, id, lo, hi) if id is not None else hi
+            if node == hi or level[node] != id:
+                break
+            nodes.append(node)
+        return nodes
+    def count(self, n, node):
+        # Count of the gram at a node of level n
+        cumulative = self.cumulative[n]
+        return cumulative[node] - (cumulative[node - 1] if node else 0)
+    def context(self, n, node):
+        # Total count of the grams one token longer below a node of level n
+        start, stop = self.children[n][node], self.children[n][node + 1]
+        if stop == start:
+            return 0
+        cumulative = self.cumulative[n + 1]
+        return cumulative[stop - 1] - (cumulative[start - 1] if start else 0)
+    def span(self, node, depth, n):
+        # The run of level n below a node at depth
+        start, stop = node, node + 1
+        for level in range(depth, n):
+            children = self.children[level]
+            start, stop = children[start], children[stop]
+        return start, stop
+    def gram(self, prefix, n, node):
+        # The gram ending at a node of level n, below prefix
+        if len(prefix) == n - 1:
+            id = self.ids[n][node]
+            return tuple(prefix) + ((self.vocabulary.tokens[id] if self.vocabulary is not None else id),)
+        tail = []
+        for level in range(n, len(prefix), -1):
+            tail.append(self.ids[level][node])
+            if level > 1:
+                node = bisect_right(self.children[level - 1], node) - 1
+        tail.reverse()
+        if self.vocabulary is not None:
+            tail = self.vocabulary.decode(tail)
+        return tuple(prefix) + tuple(tail)
+    def level(self, n):
+        """Every gram of level n as a tuple of IDs, in trie order."""
+        grams = [(id,) for id in self.ids[1]]
+        for level in range(2, n + 1):
+            children, ids = self.children[level - 1], self.ids[level]
+            grams = [prefix + (ids[node],) for parent, prefix in enumerate(grams)
+                    for node in range(children[parent], children[parent + 1])]
+        return grams
+    def counts(self, n):
+        """Every gram counted at level n as a tuple of IDs, with its count."""
+        cumulative = self.cumulative[n]
+        previous = 0
+        for node, gram in enumerate(self.level(n)):
+            if cumulative[node] > previous:
+                yield gram, cumulative[node] - previous
+            previous = cumulative[node]
+    def arrays(self):
+        for level in sorted(self.ids):
+            for data in (self.ids, self.children, self.cumulative, self.probability or {}, self.alias or {}):
+                if level in data:
+                    yield data[level]
+class TrieTable(object):
+    """View of the order n grams under one prefix: a run of a trie level."""
+    __slots__ = ("trie", "prefix", "n", "start", "stop", "base", "total")
+    def __init__(self, trie, prefix, n, start, stop):
+        self.trie = trie
+        self.prefix = prefix
+        self.n = n
+        self.start = start
+        self.stop = stop
+        self.base = trie.cumulative[n][start - 1] if start else 0
+        self.total = trie.cumulative[n][stop - 1] - self.base if stop > start else 0
+    def __len__(self):
+        return self.stop - self.start
+    def __iter__(self):
+        cumulative = self.trie.cumulative[self.n]
+        previous = self.base
+        for ndx in range(self.start, self.stop):
+            if cumulative[ndx] > previous:
+                yield self.trie.gram(self.prefix, self.n, ndx), cumulative[ndx] - previous
+            previous = cumulative[ndx]
+    def sample(self, rng = random):
+        if self.stop == self.start:
+            raise IndexError("Cannot sample from an empty table")
+        trie, n = self.trie, self.n
+        if trie.alias is not None and len(self.prefix) == n - 1:
+            column = self.start + rng.randrange(self.stop - self.start)
+            if rng.randrange(self.total) >= trie.probability[n][column]:
+                column = self.start + trie.alias[n][column]
+            return trie.gram(self.prefix, n, column)
+        ndx = bisect_right(trie.cumulative[n], self.base + rng.randrange(self.total), self.start, self.stop)
+        return trie.gram(self.prefix, n, ndx)
+class TrieLookup(object):
+    """One order of a PrefixTrie, standing in for a dict from each prefix to
+    the table of order n grams it starts."""
+    def __init__(self, trie, n):
+        self.trie = trie
+        self.n = n
+        # A membership test is usually followed by fetching the same table
+        self.last = (None, None)
+    def __len__(self):
+        # Prefixes of every length, counting those only seen too near the end
+        return sum(len(self.trie.ids[depth]) for depth in range(1, self.n))
+    def find(self, prefix):
+        if not 0 < len(prefix) < self.n:
+            return None
+        return self.trie.find(prefix)
+    def table(self, prefix):
+        last, table = self.last
+        if last == prefix:
+            return table
+        node = self.find(prefix)
+        table = None
+        if node is not None:
+            start, stop = self.trie.span(node, len(prefix), self.n)
+            table = TrieTable(self.trie, tuple(prefix), self.n, start, stop)
+            if not table.total:
+                table = None
+        self.last = (prefix, table)
+        return table
+    def __contains__(self, prefix):
+        return self.table(prefix) is not None
+    def __getitem__(self, prefix):
+        table = self.table(prefix)
+        if table is None:
+            raise KeyError(prefix)
+        return table
+def count_shift(total, length):
+    # Bits dropped from each count so a level's running total fits COUNT_TYPECODE
+    limit = (1 << (8 * array(COUNT_TYPECODE).itemsize)) - 1 - length
+    shift = 0
+    while total >> shift > limit:
+        shift += 1
+    return shift
+def build_prefix_trie(gram_counts, sampling = "cumulative", vocabulary = None, quantize = False):
+    """Builds the trie of gram_counts, counts of each order keyed on token
+    tuples. With a vocabulary the tokens are interned into it, otherwise they
+    are already IDs. Levels are filled from the top down so that every
+    prefix of a gram is a node even where its own order wasn't counted. With
+    quantize, counts and child offsets take 32 bits instead of 64, a level's
+    counts halved as often as it takes for its total to fit, no count below
+    one."""
+    assert sampling in SAMPLING, "Unknown sampling %s" % sampling
+    LOGGER.debug("Building %s prefix trie", sampling)
+    wide = COUNT_TYPECODE if quantize else OFFSET_TYPECODE
+    high = max(gram_counts)
+    if vocabulary is not None:
+        intern = vocabulary.intern
+        gram_counts = {n: {tuple(intern(t) for t in g): c for g, c in counts.items()}
+                for n, counts in gram_counts.items()}
+    levels = {}
+    below = set()
+    for n in range(high, 0, -1):
+        levels[n] = sorted(below.union(gram_counts.get(n, ())))
+        below = set(gram[:-1] for gram in levels[n])
+    ids, children, cumulative = {}, {}, {}
+    probability = alias = None
+    if sampling == "alias":
+        probability, alias = {}, {}
+    for n in range(1, high + 1):
+        level, counts = levels[n], gram_counts.get(n, {})
+        ids[n] = array(ID_TYPECODE, (gram[-1] for gram in level))
+        cumulative[n] = array(wide)
+        shift = count_shift(sum(counts.values()), len(level)) if quantize else 0
+        total = 0
+        for gram in level:
+            count = counts.get(gram, 0)
+            total += max(count >> shift, 1) if count else 0
+            cumulative[n].append(total)
+        if n < high:
+            # Children follow in the same order as their parents
+            offsets = children[n] = array(wide, [0])
+            child, following = 0, levels[n + 1]
+            for gram in level:
+                while child < len(following) and following[child][:-1] == gram:
+                    child += 1
+                offsets.append(child)
+        if alias is not None:
+            probability[n], alias[n] = array(wide), array(ID_TYPECODE)
+            starts = children[n - 1] if n > 1 else array(OFFSET_TYPECODE, [0, len(level)])
+            for start, stop in zip(starts, starts[1:]):
+                counts = [cumulative[n][ndx] - (cumulative[n][ndx - 1] if ndx else 0) for ndx in range(start, stop)]
+                columns = alias_columns(counts, sum(counts))
+                probability[n].extend(columns[0])
+                alias[n].extend(columns[1])
+        del levels[n]
+    return PrefixTrie(ids, children, cumulative, vocabulary, probability, alias)
+
+# Pruning
+PRUNING = ("min_counts", "top_k", "max_bytes", "quantize")
+def pruning_header(min_counts = None, top_k = None, max_bytes = None, quantize = False):
+    # How a model was pruned, as its model file records it
+    return {"min_counts" : {str(n): c for n, c in sorted((min_counts or {}).items()) if c > 1},
+            "top_k" : top_k, "max_bytes" : max_bytes, "quantize" : bool(quantize)}
+def order_min_counts(counts, high):
+    # Minimum counts listed from order two up, the last repeated for higher orders
+    if not counts:
+        return None
+    return {n: counts[min(n - 2, len(counts) - 1)] for n in range(2, high + 1)}
+def prune_grams(gram_counts, min_counts = None, top_k = None):
+    """The counts of the grams of each order n seen at least min_counts[n]
+    times, keeping of those only the top_k most frequent successors of each
+    prefix. A gram goes with its prefix and its suffix, which the trie needs
+    as nodes for the walk to reach and leave it. Unigrams are all kept, so every token can still be
+    backed off to."""
+    pruned = {}
+    for n, counts in sorted(gram_counts.items()):
+        minimum = (min_counts or {}).get(n, 1)
+        shorter = pruned.get(n - 1) if n > 2 and pruned.get(n - 1) is not gram_counts.get(n - 1) else None
+        if n == 1 or (minimum <= 1 and not top_k and shorter is None):
+            pruned[n] = counts
+            continue
+        kept = [(g, c) for g, c in counts.items()
+                if c >= minimum and (shorter is None or (g[:-1] in shorter and g[1:] in shorter))]
+        if top_k:
+            successors = defaultdict(list)
+            for gram, count in kept:
+                successors[gram[:-1]].append((count, gram))
+            kept = [(gram, count) for grams in successors.values() for count, gram in nlargest(top_k, grams)]
+        pruned[n] = Counter(dict(kept))
+        LOGGER.debug("Kept %d of %d %d-grams", len(pruned[n]), len(counts), n)
+    return pruned
+def node_bytes(quantize = False):
+    # Model file bytes of a trie node: its ID, child offset and count, and its remaining characters
+    wide = array(COUNT_TYPECODE if quantize else OFFSET_TYPECODE).itemsize
+    return array(ID_TYPECODE).itemsize + 2 * wide + len(LINK_TYPES) * array(COUNT_TYPECODE).itemsize
+def choose_min_counts(gram_counts, budget, fixed = 0, quantize = False):
+    """The lowest minimum counts for the orders above one that leave few
+    enough grams for a model file of budget bytes, fixed of them taken by
+    what pruning leaves alone. Each step raises the minimum of whichever
+    order it sheds the most grams from, never emptying an order."""
+    levels = {n: sorted(Counter(counts.values()).items()) for n, counts in gram_counts.items() if n > 1 and counts}
+    kept = {n: len(gram_counts[n]) for n in levels}
+    position = {n: 0 for n in levels}
+    size, unpruned = node_bytes(quantize), len(gram_counts.get(1, ()))
+    while fixed + size * (unpruned + sum(kept.values())) > budget:
+        shed = [(levels[n][position[n]][1], n) for n in levels if position[n] < len(levels[n]) - 1]
+        if not shed:
+            LOGGER.warning("No pruning fits a model in %d bytes", budget)
+            break
+        grams, n = max(shed)
+        kept[n] -= grams
+        position[n] += 1
+    return {n: levels[n][position[n]][0] for n in levels}
+
+# Scoring
+BACKOFF = 0.4
+def stupid_backoff(trie, ids, low, high, floor, paths = None):
+    """The log stupid backoff score of each token of ids given the tokens
+    before it: the relative count of the longest gram ending on it whose
+    context was counted, times BACKOFF for every order backed off, or floor
+    for a token never seen. Counts come from one trie descent for each start
+    position, which finds every order starting there at once; paths keeps
+    those descents for the other sentences of a batch."""
+    descents = []
+    for start in range(len(ids)):
+        window = tuple(ids[start:start + high])
+        nodes = paths.get(window) if paths is not None else None
+        if nodes is None:
+            nodes = trie.path(window)
+            if paths is not None:
+                paths[window] = nodes
+        descents.append(nodes)
+    unigrams = trie.cumulative[1][-1] if len(trie.cumulative[1]) else 0
+    penalty = log(BACKOFF)
+    scores = []
+    for i in range(len(ids)):
+        score = 0.0
+        for n in range(min(high, i + 1), max(low, 1) - 1, -1):
+            nodes = descents[i - n + 1]
+            if len(nodes) >= n:
+                count = trie.count(n, nodes[n - 1])
+                context = trie.context(n - 1, nodes[n - 2]) if n > 1 else unigrams
+                if count and context:
+                    scores.append(score + log(count / context))
+                    break
+            score += penalty
+        else:
+            scores.append(floor)
+    return scores
+
+# Compact Storage
+class Vocabulary(object):
+    """Interns tokens as consecutive integer IDs."""
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+    def __len__(self):
+        return len(self.tokens)
+    def intern(self, token):
+        id = self.ids.get(token)
+        if id is None:
+            id = len(self.tokens)
+            self.ids[token] = id
+            self.tokens.append(token)
+        return id
+    def encode(self, tokens):
+        return array(ID_TYPECODE, (self.intern(t) for t in tokens))
+    def decode(self, ids):
+        return [self.tokens[id] for id in ids]
+    def token(self, id):
+        return self.tokens[id]
+def pack_prefix(prefix, base):
+    # Prefixes of a fixed length map to a single int, IDs shifted by one so
+    # that the leading token is never a zero digit
+    key = 0
+    for id in prefix:
+        key = key * base + id + 1
+    return key
+class GramView(object):
+    """The order n grams of a token stream, as windows over the stream."""
+    def __init__(self, stream, n):
+        self.stream = stream
+        self.n = n
+    def __len__(self):
+        return max(len(self.stream) - self.n + 1, 0)
+    def __getitem__(self, ndx):
+        if ndx < 0:
+            ndx += len(self)
+        if not 0 <= ndx < len(self):
+            raise IndexError("gram index out of range")
+        return tuple(self.stream[ndx:ndx + self.n])
+class GramBucket(object):
+    """The grams starting at positions[start:stop] of a token stream."""
+    def __init__(self, stream, positions, start, stop, n):
+        self.stream = stream
+        self.positions = positions
+        self.start = start
+        self.stop = stop
+        self.n = n
+    def __len__(self):
+        return self.stop - self.start
+    def __getitem__(self, ndx):
+        if ndx < 0:
+            ndx += len(self)
+        if not 0 <= ndx < len(self):
+            raise IndexError("bucket index out of range")
+        position = self.positions[self.start + ndx]
+        return tuple(self.stream[position:position + self.n])
+    def sample(self, rng = random):
+        return self[rng.randrange(len(self))]
+class PrefixIndex(object):
+    """CSR index from every prefix of one length to the stream positions it
+    starts at, kept in ascending order so one index serves every order."""
+    def __init__(self, stream, length, base):
+        LOGGER.debug("Indexing prefixes of length %d", length)
+        self.length = length
+        self.base = base
+        self.buckets = {}
+        last = len(stream) - length - 1
+        bucket_of = array(ID_TYPECODE)
+        counts = array(OFFSET_TYPECODE)
+        for position in range(last + 1):
+            key = pack_prefix(stream[position:position + length], base)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = len(counts)
+                self.buckets[key] = bucket
+                counts.append(0)
+            counts[bucket] += 1
+            bucket_of.append(bucket)
+        self.offsets = array(OFFSET_TYPECODE, [0])
+        for count in counts:
+            self.offsets.append(self.offsets[-1] + count)
+        cursor = array(OFFSET_TYPECODE, self.offsets[:-1])
+        self.positions = array(OFFSET_TYPECODE, [0]) * len(bucket_of)
+        for position, bucket in enumerate(bucket_of):
+            self.positions[cursor[bucket]] = position
+            cursor[bucket] += 1
+    def span(self, prefix, last):
+        bucket = self.buckets.get(pack_prefix(prefix, self.base))
+        if bucket is None:
+            return 0, 0
+        start = self.offsets[bucket]
+        stop = bisect_right(self.positions, last, start, self.offsets[bucket + 1])
+        return start, stop
+class CompactLookup(object):
+    """Stand-in for one order of the prefix lookup, over a token stream."""
+    def __init__(self, stream, indexes, n):
+        self.stream = stream
+        self.indexes = indexes
+        self.n = n
+        self.last = len(stream) - n
+    def __len__(self):
+        # Prefixes of every length, counting those only seen too near the end
+        return sum(len(self.indexes[i].buckets) for i in range(1, self.n))
+    def __contains__(self, prefix):
+        if not 0 < len(prefix) < self.n:
+            return False
+        start, stop = self.indexes[len(prefix)].span(prefix, self.last)
+        return stop > start
+    def __getitem__(self, prefix):
+        if not 0 < len(prefix) < self.n:
+            raise KeyError(prefix)
+        index = self.indexes[len(prefix)]
+        start, stop = index.span(prefix, self.last)
+        if stop == start:
+            raise KeyError(prefix)
+        return GramBucket(self.stream, index.positions, start, stop, self.n)
+def build_compact_ngrams(stream, low, high):
+    LOGGER.debug("Building compact ngrams from %d to %d", low, high)
+    assert low <= high
+    assert low > 0
+    return {n: GramView(stream, n) for n in range(low, high + 1)}
+def build_compact_lookup(stream, vocabulary, low, high):
+    LOGGER.debug("Building compact lookup table")
+    base = len(vocabulary) + 1
+    indexes = {i: PrefixIndex(stream, i, base) for i in range(1, high)}
+    return {n: CompactLookup(stream, indexes, n) for n in range(low, high + 1)}
+def find_compact_starter_grams(stream, vocabulary, low, high):
+    LOGGER.debug("Finding compact starter grams")
+    starter_words = set()
+    sentence_end = set(vocabulary.ids[t] for t in SENTENCE_END if t in vocabulary.ids)
+    for position in range(1, len(stream)):
+        if stream[position - 1] in sentence_end and vocabulary.tokens[stream[position]][0].isupper():
+            starter_words.add(stream[position])
+    positions = array(OFFSET_TYPECODE,
+            (p for p in range(len(stream)) if stream[p] in starter_words))
+    starter_grams = {}
+    for n in range(low, high + 1):
+        stop = bisect_right(positions, len(stream) - n)
+        starter_grams[n] = GramBucket(stream, positions, 0, stop, n)
     return starter_grams
-def combine_punctuation(tokens):
-    LOGGER.debug("Combining punctuation:%s" % tokens)
+
+# Length Budgets
+LINK_TYPES = (None, "last", "random")
+UNREACHABLE = 0xFFFFFFFF
+def token_chars(token, previous = None):
+    """Characters a token adds to a sentence once punctuation is combined: a
+    space and the token, or just the token for punctuation, which also
+    repeats a punctuation token before it."""
+    if token not in PUNCTUATION:
+        return len(token) + 1
+    if previous is not None and previous in PUNCTUATION:
+        return len(token) + len(previous) + 1
+    return len(token)
+def gram_chars(gram, start, chars = token_chars):
+    # Characters added by gram[start:], following on from gram[start - 1]
+    total = 0
+    for ndx in range(start, len(gram)):
+        total += chars(gram[ndx], gram[ndx - 1] if ndx > 0 else None)
+    return total
+def link_lengths(n, link_type):
+    if link_type == "last":
+        return (1,)
+    if link_type == "random":
+        return tuple(range(1, n))
+    return (n - 1,)
+def build_min_remaining(grams, n, link_type, sentence_end, chars = token_chars):
+    """Fewest characters still to come before a sentence end, for each state
+    of the last n - 1 tokens, when linking with link_type. A shortest path
+    search back from the states ending a sentence, with a bucket per
+    distance since costs are small integers; states that can't reach a
+    sentence end are left out."""
+    LOGGER.debug("Finding remaining characters for %d grams linking %s", n, link_type)
+    lengths = link_lengths(n, link_type)
+    arriving = defaultdict(list)
+    for gram in grams:
+        arriving[gram[1:]].append(gram)
+    # Linking on all n - 1 tokens the prefix is the state itself, shorter
+    # prefixes lead on to every state ending with them
+    ending = {r: defaultdict(list) for r in lengths if r < n - 1}
+    if ending:
+        states = set(arriving)
+        states.update(gram[:-1] for gram in grams)
+        for state in states:
+            for r in ending:
+                ending[r][state[-r:]].append(state)
+
+    # Frontier entries are a state, or a prefix of length r whose cheapest way
+    # on to a sentence end is settled when it is reached
+    remaining = {}
+    best = {r: {} for r in lengths}
+    settled = {r: set() for r in lengths}
+    frontier = defaultdict(list)
+    frontier[0] = [(0, state) for state in arriving if state[-1] in sentence_end]
+    distance = 0
+    while frontier:
+        if distance not in frontier:
+            distance += 1
+            continue
+        for r, key in frontier.pop(distance):
+            if r:
+                if key in settled[r]:
+                    continue
+                settled[r].add(key)
+                for state in ending[r][key] if r in ending else (key,):
+                    if state not in remaining:
+                        frontier[distance].append((0, state))
+                continue
+            if key in remaining:
+                continue
+            remaining[key] = distance
+            for gram in arriving.get(key, ()):
+                for r in lengths:
+                    prefix = gram[:r]
+                    if prefix in settled[r]:
+                        continue
+                    cost = distance + gram_chars(gram, r, chars)
+                    if cost < best[r].get(prefix, cost + 1):
+                        best[r][prefix] = cost
+                        frontier[cost].append((r, prefix))
+    return remaining
+class Budget(object):
+    """Tracks the characters used by a sentence being generated, accepting
+    only grams that can still reach a sentence end within max_chars and,
+    where possible, none that end it before min_chars. Without either it
+    just keeps the walk to grams that can reach a sentence end at all."""
+    def __init__(self, remaining, max_chars = None, min_chars = None, sentence_end = SENTENCE_END, chars = token_chars):
+        self.remaining = remaining
+        # The first token isn't preceded by a space
+        self.limit = max_chars + 1 if max_chars is not None else None
+        self.minimum = min_chars + 1 if min_chars is not None else 0
+        self.sentence_end = sentence_end
+        self.chars = chars
+        self.used = 0
+    @property
+    def counting(self):
+        return self.limit is not None or self.minimum > 0
+    def fits(self, gram, r, strict = True):
+        if not self.counting:
+            return gram[-1] in self.sentence_end or self.remaining.get(gram[1:]) is not None
+        used = self.used + gram_chars(gram, r, self.chars)
+        if gram[-1] in self.sentence_end:
+            return (self.limit is None or used <= self.limit) and (not strict or used >= self.minimum)
+        remaining = self.remaining.get(gram[1:])
+        return remaining is not None and (self.limit is None or used + remaining <= self.limit)
+    def choose(self, bucket, r, context = None, rng = random):
+        """Samples a gram extending the sentence after its first r tokens.
+        With context, grams backed off from a lower order are judged as
+        though they followed on from context instead."""
+        if context is None:
+            fits = lambda g, strict: self.fits(g, r, strict)
+        else:
+            fits = lambda g, strict: self.fits(context + g[r:], len(context), strict)
+        choice = sample_where(bucket, lambda g: fits(g, True), rng = rng)
+        if choice is None and self.minimum:
+            choice = sample_where(bucket, lambda g: fits(g, False), rng = rng)
+        return choice
+    def spend(self, gram, r):
+        if self.counting:
+            self.used += gram_chars(gram, r, self.chars)
+    def opens(self, words, n):
+        # Whether a sentence begun with words can still reach an end within the limit
+        remaining = 0 if words[-1] in self.sentence_end else self.remaining.get(tuple(words[-(n - 1):]))
+        if remaining is None:
+            return False
+        return self.limit is None or self.used + gram_chars(tuple(words), 0, self.chars) + remaining <= self.limit
+
+def combine_punctuation(tokens, verbose = True):
+    if verbose:
+        LOGGER.debug("Combining punctuation:%s", tokens)
     combined = []
     money_seen = False
     for ndx in range(1, len(tokens)):
@@ -159,60 +1129,154 @@ def combine_punctuation(tokens):
         else:
             combined.append(tokens[ndx - 1])
     return combined
-def generate_ngram_sentence(starter_grams, lookup, n, link_type = None):
-    LOGGER.debug("Building N-Gram sentence using %d grams" % n)
+MAX_STEPS = 1000
+NOVEL_TRIES = 20
+def backoff_prefixes(word_list, lookup, n, prefix):
+    """The order and prefix of every table to extend the sentence from: the
+    linked prefix first, then the other prefixes of order n, longest first,
+    then lower orders. Every length of order n comes before any lower order,
+    so a budget that one length fits is never given up on."""
+    yield n, prefix
+    for m in range(n, 1, -1):
+        if m not in lookup:
+            continue
+        for length in range(min(m - 1, len(word_list)), 0, -1):
+            if m != n or length != len(prefix):
+                yield m, tuple(word_list[-length:])
+def finish_sentence(word_list, lookup, n, link_type, sentence_end, budget, rng = random):
+    """Ends the sentence along a shortest way to a sentence end. Every step
+    lowers the characters still to come, so this always stops, leaving the
+    sentence unended only if its state can't reach an end at all."""
+    while word_list[-1] not in sentence_end:
+        best, candidates = None, []
+        for r in link_lengths(n, link_type):
+            prefix = tuple(word_list[-r:])
+            if prefix not in lookup[n]:
+                continue
+            for gram, count in successors(lookup[n][prefix]):
+                remaining = 0 if gram[-1] in sentence_end else budget.remaining.get(gram[1:])
+                if remaining is None:
+                    continue
+                cost = gram_chars(gram, r, budget.chars) + remaining
+                if best is None or cost < best:
+                    best, candidates = cost, []
+                if cost == best:
+                    candidates.append((gram, r))
+        if not candidates:
+            return False
+        choice, r = rng.choice(candidates)
+        word_list.extend(choice[r:])
+        budget.spend(choice, r)
+    return True
+def generate_ngram_sentence(starter_grams, lookup, n, link_type = None, sentence_end = SENTENCE_END, budget = None,
+        verbose = True, max_steps = MAX_STEPS, rng = random, words = None):
+    """Walks from a starter gram to a sentence end. A prefix with no way on
+    backs off to shorter prefixes and lower orders, and after max_steps the
+    sentence is finished the shortest way the budget's table knows, or left
+    where it is without a budget, so every walk stops. Every choice is drawn from rng, a random.Random or the
+    random module itself. With words, the walk goes on from those instead
+    of a starter gram."""
+    # Per-step debugging is formatted only when verbose, batches turn it off
+    debug = verbose and LOGGER.isEnabledFor(logging.DEBUG)
+    if debug:
+        LOGGER.debug("Building N-Gram sentence using %d grams", n)
+    start = time.perf_counter()
     assert(n >= 2)
     assert(n <= len(lookup))
     word_list = []
-    start_gram = random.choice(starter_grams[n])
-    word_list.extend(start_gram)
-    LOGGER.debug("Starting with: %s" % (start_gram,))
-    if link_type == "last":
-        LOGGER.debug("Linking last token")
-    elif link_type == "random":
-        LOGGER.debug("Linking on random number of last tokens")
+    if words is not None:
+        start_gram = tuple(words)
+        if budget is not None:
+            budget.spend(start_gram, 0)
+    elif budget is None:
+        start_gram = sample(starter_grams[n], rng)
     else:
-        LOGGER.debug("Linking last %d tokens" % (n - 1,))
-    while word_list[-1] not in SENTENCE_END:
+        start_gram = budget.choose(starter_grams[n], 0, rng = rng)
+        if start_gram is None:
+            if budget.limit is None:
+                raise ValueError("No starter gram reaches a sentence end")
+            raise ValueError("No sentence fits in %d characters" % (budget.limit - 1))
+        budget.spend(start_gram, 0)
+    word_list.extend(start_gram)
+    if debug:
+        LOGGER.debug("Starting with: %s", start_gram)
+        if link_type == "last":
+            LOGGER.debug("Linking last token")
+        elif link_type == "random":
+            LOGGER.debug("Linking on random number of last tokens")
+        else:
+            LOGGER.debug("Linking last %d tokens", n - 1)
+    steps = 0
+    while word_list[-1] not in sentence_end:
+        if steps == max_steps:
+            LOGGER.warning("No sentence end after %d steps, finishing the sentence", steps)
+            METRICS.count("step_caps")
+            if budget is None or not finish_sentence(word_list, lookup, n, link_type, sentence_end, budget, rng):
+                METRICS.count("unfinished")
+            break
+        steps += 1
         prefix = None
-        link_num = None
         if link_type == "last":
             prefix = tuple(word_list[-1:])
         elif link_type == "random":
-            r = random.randrange(1, n)
-            LOGGER.debug("Linking last %d tokens" % (r,))
+            r = rng.randrange(1, n)
+            if debug:
+                LOGGER.debug("Linking last %d tokens", r)
             assert r != n, "The random number %d cannot equal n=%d" % (r, n)
             prefix = tuple(word_list[-r:])
         else:
             prefix = tuple(word_list[-(n - 1):])
-        if prefix not in lookup[n]:
-            LOGGER.error("Couldn't find %s in lookup for %d" % (prefix,n))
-            continue
-        choice = random.choice(lookup[n][prefix])
-        extend = choice[len(prefix) - len(choice):]
-        LOGGER.debug("Prefix:%s:Choice:%s:Extend:%s" % (prefix, choice, extend))
+        choice = fallback = None
+        for m, backoff in backoff_prefixes(word_list, lookup, n, prefix):
+            if backoff not in lookup[m]:
+                continue
+            bucket = lookup[m][backoff]
+            if budget is None:
+                choice = sample(bucket, rng)
+            elif m == n:
+                choice = budget.choose(bucket, len(backoff), rng = rng)
+            else:
+                # Judged as the order n gram it leaves the sentence ending with
+                choice = budget.choose(bucket, len(backoff), tuple(word_list[-(n - m + len(backoff)):]), rng)
+            if fallback is None and budget is not None and budget.limit is None:
+                fallback = (backoff, bucket)
+            if choice is not None:
+                break
+        if choice is None and fallback is not None:
+            # Nothing reaches an end from here, wander on until the step cap
+            backoff, bucket = fallback
+            choice = sample(bucket, rng)
+        if choice is None:
+            LOGGER.error("Couldn't extend %s in lookup for %d", prefix, n)
+            METRICS.count("dead_ends")
+            break
+        if backoff != prefix:
+            if debug:
+                LOGGER.debug("Backed off from %s to %s", prefix, backoff)
+            METRICS.count("backoffs")
+        extend = choice[len(backoff):]
+        if debug:
+            LOGGER.debug("Prefix:%s:Choice:%s:Extend:%s", backoff, choice, extend)
+        if budget is not None:
+            budget.spend(tuple(word_list[-(n - len(extend)):]) + tuple(extend), n - len(extend))
         word_list.extend(extend)
+    METRICS.time("walk", time.perf_counter() - start)
+    METRICS.count("steps", steps)
     return word_list
-def generate_pos_ngram_sentence(starter_pos_ngrams, pos_lookup, pos_words, n):
-    LOGGER.debug("Building POS sentence using %d grams" % n)
-    pos_list = generate_ngram_sentence(starter_pos_ngrams, pos_lookup, n)
+def generate_pos_ngram_sentence(starter_pos_ngrams, pos_lookup, pos_words, n, verbose = True, rng = random):
+    """Walks a sentence of tags as generate_ngram_sentence walks words, then
+    fills in each tag with a word sampled by how often it had that tag,
+    starting on a capitalized word where the tag has one."""
+    LOGGER.debug("Building POS sentence using %d grams", n)
+    pos_list = generate_ngram_sentence(starter_pos_ngrams, pos_lookup, n, verbose = verbose, rng = rng)
 
     if pos_list[0] in PUNCTUATION:
-        LOGGER.warning("Removing %s" % pos_list.pop(0))
-    LOGGER.debug("Tags:%s" % pos_list)
-    capital_words = []
-    for word in pos_words[pos_list[0]]:
-        if word[0].isupper():
-            capital_words.append(word)
-
-    word_list = []
-    if len(capital_words):
-        word_list.append(random.choice(capital_words))
-    else:
-        word_list.append(random.choice(pos_words[pos_list[0]]).title())
-
-    for tag in pos_list:
-        word = random.choice(pos_words[tag])
+        LOGGER.warning("Removing %s", pos_list.pop(0))
+    LOGGER.debug("Tags:%s", pos_list)
+    first = sample_where(pos_words[pos_list[0]], lambda word: word[0].isupper(), rng = rng)
+    word_list = [first if first is not None else sample(pos_words[pos_list[0]], rng).title()]
+    for tag in pos_list[1:]:
+        word = sample(pos_words[tag], rng)
         if "NN" not in tag and word != "I":
             word = word.lower()
         word_list.append(word)
@@ -235,61 +1299,1832 @@ DELET = set((
     "(",
     ")",
     ))
-class NGram(object):
-    def __init__(self, text, low = 1, high = 3, pos = False):
+DELET_TABLE = str.maketrans({d: None for d in DELET})
+def normalize_text(text):
+    return text.translate(DELET_TABLE)
+# Tokenizers
+# Titles and months written short, whose dot ends no sentence
+ABBREVIATIONS = ("Mr", "Mrs", "Ms", "Dr", "Sen", "Rep", "Gov", "Gen", "Lt", "Col", "Sgt", "Capt", "Prof", "Rev", "Hon",
+        "Pres", "St", "vs", "Jan", "Feb", "Mar", "Apr", "Aug", "Sept", "Oct", "Nov", "Dec")
+TOKEN_PATTERN = re.compile(r"""
+    \.\.\.                          # an ellipsis is one token
+    | [$€£¥]                        # money symbols, joined back onto the amount
+    | \d+(?:[.,:/]\d+)+             # numbers with separators, times and dates
+    | (?:\w\.){2,}                   # dotted initialisms keep their last dot, U.S. and a.m.
+    | \b(?:%s)\.(?!\w)               # so do known abbreviations, Mr. and Nov.
+    | \w+(?:[’'&.\-]\w+)*           # words, with inner apostrophes, hyphens and dots
+    | [^\w\s]                       # any other punctuation, a character at a time
+    """ % "|".join(ABBREVIATIONS), re.VERBOSE)
+def regex_tokenize(text):
+    """Splits text much as word_tokenize does where combine_punctuation
+    puts it back together: punctuation and money symbols come apart from
+    words, contractions and abbreviations stay whole."""
+    return TOKEN_PATTERN.findall(text)
+TOKENIZERS = {
+        "word_tokenize" : word_tokenize,
+        "regex" : regex_tokenize,
+        }
+def tokenize_documents(documents, tokenizer = "word_tokenize", cache = None):
+    """Yields the tokens of each document, looking them up in cache first and
+    adding any it lacks. Token lists among the documents pass through, as
+    they do for documents found in the cache before sharding."""
+    tokenize = TOKENIZERS[tokenizer]
+    for document in documents:
+        if not isinstance(document, str):
+            yield document
+            continue
+        key = document_key(document, tokenizer) if cache is not None else None
+        tokens = cache.get(key) if key is not None else None
+        if tokens is None:
+            start = time.perf_counter()
+            tokens = [t for t in tokenize(document) if t not in DELET]
+            METRICS.time("tokenize", time.perf_counter() - start)
+            if cache is not None:
+                cache.put(key, tokens)
+        else:
+            METRICS.count("cached_documents")
+        yield tokens
 
-        LOGGER.debug("Tokenizing")
-        tokens = word_tokenize(text)
-        tokens = [t for t in tokens if t not in DELET]
-        #LOGGER.debug("Tagging")
-        #pos = pos_tag(tokens)
+# Token Caches
+TOKEN_CACHE_MAGIC = b"NGTK"
+TOKEN_CACHE_VERSION = 2
+TOKEN_CACHE_PREAMBLE = struct.Struct("<4sI")
+TOKEN_RECORD = struct.Struct("<32sI")
+TOKEN_SEPARATOR = "\0"
+def token_cache_filename(filename):
+    return os.path.splitext(filename)[0] + "-tokens.cache"
+def document_key(document, tokenizer):
+    return hashlib.sha256(("%s\0%s" % (tokenizer, document)).encode("utf-8")).digest()
+class TokenCache(object):
+    """Token lists of documents tokenized before, appended to one file and
+    keyed on a digest of the tokenizer and the document, so the same text is
+    never tokenized twice. Any number of processes may share the file, each
+    appending under a lock and taking in the records the others appended. A
+    record cut short by a crash is dropped and written over, and one that
+    can't be read is a miss."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}
+        self.end = 0
+        self.reader = None
+        self.writer = None
+        if os.path.isfile(filename):
+            self.load()
+    def load(self):
+        with open(self.filename, "rb") as file:
+            if file.read(TOKEN_CACHE_PREAMBLE.size) != TOKEN_CACHE_PREAMBLE.pack(TOKEN_CACHE_MAGIC, TOKEN_CACHE_VERSION):
+                LOGGER.warning("Ignoring unreadable token cache %s", self.filename)
+                return
+            self.end = self.scan(file, TOKEN_CACHE_PREAMBLE.size)
+        LOGGER.debug("Token cache %s holds %d documents", self.filename, len(self.index))
+    def scan(self, file, offset):
+        # Indexes the whole records from offset on, returning where they end
+        size = file.seek(0, os.SEEK_END)
+        file.seek(offset)
+        while offset + TOKEN_RECORD.size <= size:
+            key, length = TOKEN_RECORD.unpack(file.read(TOKEN_RECORD.size))
+            if offset + TOKEN_RECORD.size + length > size:
+                break
+            self.index[key] = (offset + TOKEN_RECORD.size, length)
+            offset += TOKEN_RECORD.size + length
+            file.seek(offset)
+        return offset
+    def __len__(self):
+        return len(self.index)
+    def __contains__(self, key):
+        return key in self.index
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        if self.reader is None:
+            self.reader = open(self.filename, "rb", buffering = 0)
+        offset, length = entry
+        # Read past any buffer, which could hold a torn record since written over
+        data = os.pread(self.reader.fileno(), length, offset)
+        try:
+            if len(data) < length:
+                raise ValueError("record cut short")
+            data = data.decode("utf-8")
+        except ValueError as e:
+            LOGGER.warning("Ignoring unreadable token cache record: %s", e)
+            del self.index[key]
+            return None
+        return data.split(TOKEN_SEPARATOR) if data else []
+    def put(self, key, tokens):
+        if key in self.index:
+            return
+        if self.writer is None:
+            self.writer = open(self.filename, "a+b")
+        preamble = TOKEN_CACHE_PREAMBLE.pack(TOKEN_CACHE_MAGIC, TOKEN_CACHE_VERSION)
+        fcntl.flock(self.writer, fcntl.LOCK_EX)
+        try:
+            self.writer.seek(0)
+            if self.writer.read(TOKEN_CACHE_PREAMBLE.size) != preamble:
+                self.writer.truncate(0)
+                self.writer.write(preamble)
+                self.index, self.end = {}, TOKEN_CACHE_PREAMBLE.size
+            else:
+                self.end = self.scan(self.writer, max(self.end, TOKEN_CACHE_PREAMBLE.size))
+            if key in self.index:
+                return
+            data = TOKEN_SEPARATOR.join(tokens).encode("utf-8")
+            self.writer.truncate(self.end)
+            self.writer.write(TOKEN_RECORD.pack(key, len(data)))
+            self.writer.write(data)
+            # Flushed so the reader, and other processes, see it before the lock goes
+            self.writer.flush()
+            self.index[key] = (self.end + TOKEN_RECORD.size, len(data))
+            self.end += TOKEN_RECORD.size + len(data)
+        finally:
+            fcntl.flock(self.writer, fcntl.LOCK_UN)
+    def close(self):
+        for file in (self.reader, self.writer):
+            if file is not None:
+                file.close()
+        self.reader = self.writer = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception):
+        self.close()
 
-        # N Gram Generation
-        grams = build_ngrams(tokens, low, high)
+# Copied Spans
+SPAN_TOKENS = 8
+SPAN_BASE = 0x100000001B3
+SPAN_MASK = (1 << 64) - 1
+SPAN_TYPECODE = "Q"
+def token_hash(token):
+    # Stable across processes, unlike hash() on strings
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size = 8).digest(), "little")
+class SpanIndex(object):
+    """Rolling hashes of every run of k tokens inside a document of the
+    corpus, kept as one sorted array, so whether a sentence copies k or more
+    tokens in a row from the corpus takes a binary search per token."""
+    def __init__(self, k = SPAN_TOKENS, hashes = None):
+        self.k = k
+        self.hashes = hashes if hashes is not None else array(SPAN_TYPECODE)
+        self.sorted = hashes is not None
+        self.power = pow(SPAN_BASE, k - 1, SPAN_MASK + 1)
+        self.token_hashes = {}
+    def __len__(self):
+        return len(self.hashes)
+    def windows(self, tokens):
+        # The hash of each run of k tokens, rolled along the tokens
+        hashes, k = self.token_hashes, self.k
+        value = 0
+        for ndx, token in enumerate(tokens):
+            hashed = hashes.get(token)
+            if hashed is None:
+                hashed = hashes[token] = token_hash(token)
+            if ndx >= k:
+                value = (value - hashes[tokens[ndx - k]] * self.power) & SPAN_MASK
+            value = (value * SPAN_BASE + hashed) & SPAN_MASK
+            if ndx >= k - 1:
+                yield value
+    def add(self, tokens):
+        self.hashes.extend(self.windows(tokens))
+        self.sorted = False
+    def merge(self, hashes):
+        # Adds the hashes another index took, such as a shard worker's
+        self.hashes.extend(hashes)
+        self.sorted = False
+    def freeze(self):
+        if not self.sorted:
+            self.hashes = array(SPAN_TYPECODE, sorted(set(self.hashes)))
+            self.sorted = True
+    def __contains__(self, value):
+        ndx = bisect_left(self.hashes, value)
+        return ndx < len(self.hashes) and self.hashes[ndx] == value
+    def copies(self, tokens):
+        """Whether tokens hold a run of k or more tokens from the corpus."""
+        assert self.sorted, "Spans must be frozen before searching"
+        return any(value in self for value in self.windows(list(tokens)))
 
-        # N Gram Lookup Tables
-        lookup = build_prefix_lookup(grams)
+# Parallel Building
+SHARD_CHARACTERS = 1 << 20
+def shard_documents(documents, size = SHARD_CHARACTERS):
+    shard, length = [], 0
+    for document in documents:
+        shard.append(document)
+        length += len(document)
+        if length >= size:
+            yield shard
+            shard, length = [], 0
+    if shard:
+        yield shard
+def cached_documents(documents, tokenizer, cache):
+    # Swaps documents for their cached tokens so shards only tokenize the rest
+    for document in documents:
+        tokens = cache.get(document_key(document, tokenizer)) if cache is not None and isinstance(document, str) else None
+        if tokens is None:
+            yield document
+        else:
+            METRICS.count("cached_documents")
+            yield tokens
+def tokenize_shard(arguments):
+    # Returns the tokens of each document and, with keep, the cache key of
+    # those tokenized here
+    shard, tokenizer, keep = arguments
+    tokenized = []
+    for document, tokens in zip(shard, tokenize_documents(shard, tokenizer)):
+        key = document_key(document, tokenizer) if keep and isinstance(document, str) else None
+        tokenized.append((key, tokens))
+    return tokenized
+def count_shard(arguments):
+    # Counts the grams and hashes the spans inside one shard and returns the
+    # edge tokens the parent needs to count the grams spanning shards, and
+    # with keep, the tokens of documents it tokenized for the parent to cache
+    shard, low, high, k, tokenizer, keep = arguments
+    counter = NGramCounter(low, high)
+    spans = SpanIndex(k)
+    head = []
+    fresh = []
+    for document, tokens in zip(shard, tokenize_documents(shard, tokenizer)):
+        if keep and isinstance(document, str):
+            fresh.append((document_key(document, tokenizer), tokens))
+        if len(head) < high - 1:
+            head.extend(tokens[:high - 1 - len(head)])
+        counter.add(tokens)
+        spans.add(tokens)
+    return counter.grams, head, counter.tail, spans.hashes, fresh
+def imap_jobs(function, iterable, jobs):
+    """Maps in order across a pool of jobs processes, consuming the iterable
+    lazily."""
+    import multiprocessing
+    LOGGER.debug("Mapping %s over %d processes", function.__name__, jobs)
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap(function, iterable):
+            yield result
 
-        # Sentence Starting N Gram
-        starter_grams = find_starter_grams(grams)
+# Parallel Generation
+GENERATE_CHUNK = 16
+SHARED = None
+def make_rng(rng):
+    # None draws from the random module, a seed from its own Random
+    if rng is None:
+        return random
+    if isinstance(rng, int):
+        return random.Random(rng)
+    return rng
+def sentence_seed(seed, index):
+    """The seed sentence index of a batch seeded with seed is drawn from,
+    whichever process walks it."""
+    digest = hashlib.blake2b(b"%d:%d" % (seed, index), digest_size = 8).digest()
+    return int.from_bytes(digest, "little")
+def share_generator(generator, filename):
+    # Forked workers are handed the parent's generator, others map its model file
+    global SHARED
+    SHARED = generator if generator is not None else MappedNGram(filename)
+def imap_shared(generator, function, iterable, jobs):
+    """Maps in order across jobs processes that each see generator as
+    SHARED. Forked processes share its pages copy-on-write, elsewhere only a
+    mapped model can be shared, by mapping its file again; anything else is
+    mapped here, in this process."""
+    import multiprocessing
+    if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+        context, initargs = multiprocessing.get_context("fork"), (generator, None)
+    elif jobs > 1 and isinstance(generator, MappedNGram):
+        context, initargs = multiprocessing.get_context(), (None, generator.filename)
+    else:
+        if jobs > 1:
+            LOGGER.warning("Can't share an unmapped model without fork, generating in one process")
+        global SHARED
+        SHARED = generator
+        try:
+            yield from map(function, iterable)
+        finally:
+            SHARED = None
+        return
+    LOGGER.debug("Mapping %s over %d processes", function.__name__, jobs)
+    with context.Pool(jobs, share_generator, initargs) as pool:
+        for result in pool.imap(function, iterable):
+            yield result
+def walk_seeds(arguments):
+    seeds, n, link_type, max_chars, min_chars, novel, keyword = arguments
+    return [SHARED.join_sentence(SHARED.walk(n, link_type, max_chars, min_chars, novel, False, random.Random(seed),
+            keyword), False) for seed in seeds]
+
+# Part of Speech Tagging
+TAGGER = "pos_tag"
+def tag_key(document, tokenizer):
+    # Tags are cached beside the tokens, keyed as if by another tokenizer
+    return document_key(document, "%s/%s" % (tokenizer, TAGGER))
+def cached_tags(documents, tokenizer, cache):
+    # Swaps documents for their cached tokens and tags so shards only tag the rest
+    for document in documents:
+        tags = tokens = None
+        if cache is not None and isinstance(document, str):
+            tags = cache.get(tag_key(document, tokenizer))
+            if tags is not None:
+                tokens = cache.get(document_key(document, tokenizer))
+        if tokens is None:
+            yield document
+        else:
+            METRICS.count("cached_tags")
+            yield tokens, tags
+def tag_shard(arguments):
+    # Tags every untagged document of one shard in a single pos_tag_sents
+    # call, returning the tokens and tags of each and, with keep, the keys to
+    # cache the tokens and tags made here under
+    from nltk import pos_tag_sents
+    shard, tokenizer, keep = arguments
+    untagged = [document for document in shard if not isinstance(document, tuple)]
+    tokenized = tokenize_shard((untagged, tokenizer, keep))
+    tagged = iter(pos_tag_sents([tokens for key, tokens in tokenized]) if tokenized else [])
+    tokenized = iter(tokenized)
+    results = []
+    for document in shard:
+        if isinstance(document, tuple):
+            results.append((None, None) + document)
+            continue
+        key, tokens = next(tokenized)
+        tags = [tag for word, tag in next(tagged)]
+        tagged_key = tag_key(document, tokenizer) if keep and isinstance(document, str) else None
+        results.append((key, tagged_key, tokens, tags))
+    return results
+
+class NGram(object):
+    vocabulary = None
+    trie = None
+    sentence_end = SENTENCE_END
+    tokenizer = "word_tokenize"
+    scoring = None
+    reverse = None
+    backward = None
+    min_counts = None
+    top_k = None
+    max_bytes = None
+    quantize = False
+    pruning = pruning_header()
+    def __init__(self, text, low = 1, high = 3, pos = False, compact = False, sampling = "cumulative", jobs = 1,
+            counter = None, tokenizer = "word_tokenize", token_cache = None, spans = None,
+            min_counts = None, top_k = None, max_bytes = None, quantize = False):
+        """Builds from text, either one string or an iterable of document
+        strings that is tokenized and counted a document at a time. With jobs
+        above one, documents are sharded across that many processes. Counts
+        already taken, such as those recovered from a model file, can be
+        continued from by passing their NGramCounter, and their SpanIndex
+        with them. tokenizer names one of
+        TOKENIZERS, and a TokenCache spares tokenizing documents seen before.
+        With pos, documents are also tagged and the tags counted, for
+        make_pos_sentence. Counted models can be pruned to grams of each
+        order n seen min_counts[n] times, to the top_k successors of each
+        prefix, or to minimum counts chosen to fit a model file of max_bytes;
+        quantize stores the trie's counts in 32 bits."""
+        assert tokenizer in TOKENIZERS, "Unknown tokenizer %s" % tokenizer
+        assert not (compact and (min_counts or top_k or max_bytes)), "Compact models keep every gram in their stream"
 
         # Store Relevant Data
         self.low            = low
         self.high           = high
-        self.text           = text
-        self.grams          = grams
-        self.lookup         = lookup
-        self.starter_grams  = starter_grams
+        self.text           = text if isinstance(text, str) else None
+        self.sampling       = sampling
+        self.tokenizer      = tokenizer
+        self.token_cache    = token_cache
+        self.spans          = spans if spans is not None else SpanIndex()
+        self.min_counts     = min_counts
+        self.top_k          = top_k
+        self.max_bytes      = max_bytes
+        self.quantize       = quantize
+        self.pruning        = pruning_header(min_counts, top_k, max_bytes, quantize)
         self.pos = pos
-
         if pos:
-            pos_grams, pos_words = build_pos_ngrams(pos, low, high)
-            pos_lookup = build_prefix_lookup(pos_grams)
-            starter_pos_grams = find_starter_grams(pos_grams)
-            self.pos_grams      = pos_grams
-            self.pos_words      = pos_words
-            self.pos_lookup     = pos_lookup
-            self.starter_pos_grams  = starter_pos_grams
+            self.pos_counter        = NGramCounter(low, high)
+            self.pos_word_counts    = Counter()
+        if compact:
+            # Interned Token Stream
+            assert counter is None, "Compact models are built from tokens, not counts"
+            self.vocabulary = Vocabulary()
+            self.stream     = array(ID_TYPECODE)
+        else:
+            assert counter is None or (counter.low, counter.high) == (low, high)
+            self.counter    = counter if counter is not None else NGramCounter(low, high)
+
+        documents = [text] if isinstance(text, str) else text
+        self.count_documents(documents, jobs)
+        self.build()
         return
-    def make_ngram_sentence(self, n = 3, link_type = None):
-        word_list = generate_ngram_sentence(self.starter_grams, self.lookup, n, link_type)
-        combined = combine_punctuation(word_list)
-        sentence = ' '.join(combined)
-        LOGGER.debug("%d-Gram Sentence:%s" % (n,sentence))
-        GENSEN.info("%d-Gram Sentence:%s" % (n,sentence))
+    def count_documents(self, documents, jobs = 1):
+        LOGGER.debug("Tokenizing with %s", self.tokenizer)
+        if self.pos:
+            documents = self.tag_documents(documents, jobs)
+        cache, keep = self.token_cache, self.token_cache is not None
+        token_lists = tokenize_documents(documents, self.tokenizer, cache)
+        if jobs > 1:
+            documents = cached_documents(documents, self.tokenizer, cache)
+        if self.vocabulary is not None:
+            if jobs > 1:
+                shards = ((shard, self.tokenizer, keep) for shard in shard_documents(documents))
+                token_lists = (self.cache_tokens(key, tokens)
+                        for tokenized in imap_jobs(tokenize_shard, shards, jobs) for key, tokens in tokenized)
+            for token_list in token_lists:
+                with METRICS.timer("count"):
+                    self.stream.extend(self.vocabulary.encode(token_list))
+                    self.spans.add(token_list)
+        elif jobs > 1:
+            shards = ((shard, self.low, self.high, self.spans.k, self.tokenizer, keep) for shard in shard_documents(documents))
+            for shard_grams, head, tail, spans, fresh in imap_jobs(count_shard, shards, jobs):
+                for key, tokens in fresh:
+                    self.cache_tokens(key, tokens)
+                with METRICS.timer("merge"):
+                    self.counter.merge(shard_grams, head, tail)
+                    self.spans.merge(spans)
+        else:
+            for token_list in token_lists:
+                with METRICS.timer("count"):
+                    self.counter.add(token_list)
+                    self.spans.add(token_list)
+    def tag_documents(self, documents, jobs = 1):
+        """Tags documents a shard to a pos_tag_sents call, across jobs
+        processes when above one, counting the tag grams and the words seen
+        with each tag, and yields the tokens of each document on for
+        counting."""
+        LOGGER.debug("Tagging with %s", TAGGER)
+        cache, keep = self.token_cache, self.token_cache is not None
+        shards = ((shard, self.tokenizer, keep) for shard in shard_documents(cached_tags(documents, self.tokenizer, cache)))
+        for tagged in (imap_jobs(tag_shard, shards, jobs) if jobs > 1 else map(tag_shard, shards)):
+            for key, tagged_key, tokens, tags in tagged:
+                self.cache_tokens(key, tokens)
+                if tagged_key is not None:
+                    cache.put(tagged_key, tags)
+                with METRICS.timer("count"):
+                    self.pos_counter.add(tags)
+                    self.pos_word_counts.update(zip(tags, tokens))
+                yield tokens
+    def cache_tokens(self, key, tokens):
+        return cache_tokens(self.token_cache, key, tokens)
+    def build(self):
+        low, high = self.low, self.high
+        self.remaining = {}
+        self.scoring = self.reverse = self.backward = None
+        with METRICS.timer("spans"):
+            self.spans.freeze()
+        if self.vocabulary is not None:
+            vocabulary, tokens = self.vocabulary, self.stream
+            self.sentence_end   = set(vocabulary.ids[t] for t in SENTENCE_END if t in vocabulary.ids)
+            self.grams          = build_compact_ngrams(tokens, low, high)
+            with METRICS.timer("lookup"):
+                self.lookup     = build_compact_lookup(tokens, vocabulary, low, high)
+            with METRICS.timer("starters"):
+                self.starter_grams = find_compact_starter_grams(tokens, vocabulary, low, high)
+        else:
+            # N Gram Generation
+            self.grams          = self.counter.grams
+
+            # Sentence Starting N Gram, before pruning loses any way to start
+            with METRICS.timer("starters"):
+                self.starter_grams = find_starter_tables(self.grams, self.sampling)
+
+            if self.min_counts or self.top_k or self.max_bytes:
+                with METRICS.timer("prune"):
+                    self.grams = self.counter.grams = self.prune()
+
+            # N Gram Lookup Tables, the trie waiting for scoring or saving
+            with METRICS.timer("lookup"):
+                self.lookup     = build_successor_tables(self.grams, self.sampling)
+
+        if self.pos:
+            # Part of Speech Templates
+            with METRICS.timer("tags"):
+                self.pos_grams          = self.pos_counter.grams
+                self.pos_lookup         = build_successor_tables(self.pos_grams, self.sampling)
+                self.starter_pos_grams  = find_starter_tables(self.pos_grams, self.sampling)
+                self.pos_words          = build_pos_words(self.pos_word_counts, self.sampling)
+        self.measure()
+    def prune(self):
+        """The counts pruned as asked, with minimum counts raised as far as
+        it takes to fit max_bytes when given. Pruned grams are gone
+        from the counter too, so documents added later count from what is
+        left."""
+        min_counts = dict(self.min_counts or {})
+        if self.max_bytes:
+            chosen = choose_min_counts(self.grams, self.max_bytes, self.fixed_bytes(), self.quantize)
+            min_counts = {n: max(count, min_counts.get(n, 1)) for n, count in chosen.items()}
+            LOGGER.info("Minimum counts %s fit %d bytes", min_counts, self.max_bytes)
+        for n, count in min_counts.items():
+            METRICS.gauge("min_count", count, n = n)
+        return prune_grams(self.grams, min_counts, self.top_k)
+    def fixed_bytes(self):
+        # Model file bytes pruning leaves alone: the spans, vocabulary and starter grams
+        total = array_bytes(self.spans.hashes)
+        total += sum(len(gram[0].encode("utf-8")) + array(OFFSET_TYPECODE).itemsize for gram in self.grams.get(1, ()))
+        for n, table in self.starter_grams.items():
+            total += len(table) * (n * array(ID_TYPECODE).itemsize + array(COUNT_TYPECODE).itemsize)
+        return total
+    def add_documents(self, documents, jobs = 1):
+        """Counts only the given documents into the model, continuing from
+        where the last document left off, and rebuilds the tables."""
+        if self.text is not None:
+            documents = list(documents)
+            self.text = '\n'.join([self.text] + documents)
+        self.count_documents(documents, jobs)
+        self.build()
+    def measure(self, metrics = METRICS):
+        # Gauges for the model just built or loaded
+        for n in range(self.low, self.high + 1):
+            if self.vocabulary is None:
+                metrics.gauge("grams", len(self.grams[n]), n = n)
+            metrics.gauge("prefixes", len(self.lookup[n]), n = n)
+        if self.vocabulary is not None:
+            metrics.gauge("vocabulary", len(self.vocabulary))
+        metrics.gauge("spans", len(self.spans))
+        metrics.gauge("model_bytes", self.footprint())
+    def footprint(self):
+        """Approximate bytes held by the tables: array buffers and container
+        overheads, leaving out the token strings and tuples they share."""
+        if self.vocabulary is not None:
+            total = array_bytes(self.stream) + array_bytes(self.spans.hashes)
+            total += sys.getsizeof(self.vocabulary.ids) + sys.getsizeof(self.vocabulary.tokens)
+            for index in self.lookup[self.high].indexes.values():
+                total += array_bytes(index.offsets) + array_bytes(index.positions) + sys.getsizeof(index.buckets)
+            return total
+        total = sum(sys.getsizeof(counts) for counts in self.grams.values()) + array_bytes(self.spans.hashes)
+        for tables in self.lookup.values():
+            total += sys.getsizeof(tables.index) + sys.getsizeof(tables.grams)
+            for data in (tables.offsets, tables.cumulative, tables.probability, tables.alias):
+                total += array_bytes(data)
+        return total
+    def tail(self):
+        # The last high - 1 tokens counted, which new documents continue from
+        if self.vocabulary is not None:
+            return self.vocabulary.decode(self.stream[max(len(self.stream) - self.high + 1, 0):] if self.high > 1 else [])
+        return list(self.counter.tail)
+    def token_chars(self, token, previous = None):
+        if self.vocabulary is not None:
+            token = self.vocabulary.token(token)
+            previous = self.vocabulary.token(previous) if previous is not None else None
+        return token_chars(token, previous)
+    def min_remaining(self, n, link_type = None):
+        """The fewest characters to a sentence end from each state, built on
+        first use for each n and link_type."""
+        if (n, link_type) not in self.remaining:
+            grams = self.grams[n] if self.vocabulary is None else Counter(self.grams[n])
+            with METRICS.timer("remaining"):
+                self.remaining[(n, link_type)] = build_min_remaining(grams, n, link_type, self.sentence_end,
+                        self.token_chars)
+        return self.remaining[(n, link_type)]
+    def budget(self, n, link_type, max_chars = None, min_chars = None, keyword = False):
+        # Unbounded sentences take plain steps, but one grown around a keyword
+        # needs to know how far each state is from an end
+        if max_chars is None and min_chars is None and not keyword:
+            return None
+        return Budget(self.min_remaining(n, link_type), max_chars, min_chars, self.sentence_end, self.token_chars)
+    def join_sentence(self, word_list, verbose = True):
+        if self.vocabulary is not None:
+            word_list = self.vocabulary.decode(word_list)
+        combined = combine_punctuation(word_list, verbose)
+        return ' '.join(combined)
+    def copies(self, word_list):
+        # Whether a walk copies a run of spans.k or more tokens from the corpus
+        if self.vocabulary is not None:
+            word_list = self.vocabulary.decode(word_list)
+        return self.spans.copies(word_list)
+    def keyword_prefix(self, keyword, n):
+        """The tokens of keyword as the lookups key them, trying them lower
+        cased and capitalized too. Raises ValueError for a keyword no order n
+        gram starts with."""
+        # A plain word is its own token, without loading a tokenizer for it
+        tokens = (keyword,) if keyword.isalnum() else tuple(TOKENIZERS[self.tokenizer](keyword))
+        if not 0 < len(tokens) < n:
+            raise ValueError("A keyword must be 1 to %d tokens" % (n - 1))
+        for form in (tokens, tuple(t.lower() for t in tokens), (tokens[0].capitalize(),) + tokens[1:]):
+            prefix = encode_prefix(form, self.vocabulary)
+            if prefix is not None and prefix in self.lookup[n]:
+                return prefix
+        raise ValueError("Never saw %s" % keyword)
+    def reverse_lookup(self):
+        """Lookups of every order over the grams reversed, so the table of a
+        sentence's first tokens reversed holds the tokens seen before them.
+        Built from the model's trie on first use."""
+        if self.reverse is None:
+            trie = self.scoring_trie()
+            with METRICS.timer("reverse"):
+                reverse = build_prefix_trie({n: {gram[::-1]: count for gram, count in trie.counts(n)}
+                        for n in range(self.low, self.high + 1)})
+                reverse.vocabulary = trie.vocabulary
+            self.reverse = {n: TrieLookup(reverse, n) for n in range(self.low, self.high + 1)}
+        return self.reverse
+    def reverse_remaining(self, n):
+        """The fewest characters back to a sentence start from each state of
+        a sentence's first n - 1 tokens reversed, built on first use."""
+        if self.backward is None:
+            self.backward = {}
+        if n not in self.backward:
+            trie = self.reverse_lookup()[n].trie
+            grams = [gram if trie.vocabulary is None else tuple(trie.vocabulary.decode(gram))
+                    for gram, count in trie.counts(n)]
+            with METRICS.timer("remaining"):
+                self.backward[n] = build_min_remaining(grams, n, None, self.sentence_end, self.token_chars)
+        return self.backward[n]
+    def around(self, prefix, n, budget, verbose = True, rng = random):
+        """A gram starting with prefix, walked back to a sentence start over
+        the reverse lookup, keeping to the characters the budget leaves once
+        the shortest way on from the gram is set aside. None if the walk
+        left no end within the budget. Grams ending a sentence before their
+        last token are passed over, or the walk would run on into the next."""
+        gram = sample_where(self.lookup[n][prefix], lambda g: not any(t in self.sentence_end for t in g[:-1]), rng = rng)
+        if gram is None:
+            return None
+        ahead = 0 if gram[-1] in self.sentence_end else budget.remaining.get(gram[1:])
+        if ahead is None:
+            return None
+        back = Budget(self.reverse_remaining(n), budget.limit - 1 - ahead if budget.limit is not None else None,
+                sentence_end = self.sentence_end, chars = self.token_chars)
+        if not back.opens(gram[::-1], n):
+            return None
+        words = generate_ngram_sentence(None, self.reverse_lookup(), n, None, self.sentence_end, back, verbose,
+                rng = rng, words = gram[::-1])
+        # The walk stops on the end of the sentence before, which isn't kept
+        words = words[-2::-1] if words[-1] in self.sentence_end else words[::-1]
+        return words if budget.opens(words, n) else None
+    def walk(self, n, link_type, max_chars, min_chars, novel = False, verbose = True, rng = random, keyword = None):
+        """Walks a sentence, and with novel walks it again while it copies the
+        corpus, keeping the last walk after NOVEL_TRIES. With keyword, the walk
+        grows out both ways from a gram it starts, again while no end then
+        fits max_chars."""
+        prefix = self.keyword_prefix(keyword, n) if keyword is not None else None
+        word_list = None
+        for _ in range(NOVEL_TRIES if novel or prefix is not None else 1):
+            budget = self.budget(n, link_type, max_chars, min_chars, prefix is not None)
+            words = None
+            if prefix is not None:
+                words = self.around(prefix, n, budget, verbose, rng)
+                if words is None:
+                    METRICS.count("keyword_retries")
+                    continue
+            word_list = generate_ngram_sentence(self.starter_grams, self.lookup, n, link_type, self.sentence_end,
+                    budget, verbose = verbose, rng = rng, words = words)
+            if not novel or not self.copies(word_list):
+                return word_list
+            METRICS.count("copied")
+        if word_list is None:
+            if max_chars is None:
+                raise ValueError("No sentence with %s reaches an end" % keyword)
+            raise ValueError("No sentence with %s fits in %d characters" % (keyword, max_chars))
+        LOGGER.warning("All %d %d-Gram sentences copied the corpus", NOVEL_TRIES, n)
+        return word_list
+    def make_ngram_sentence(self, n = 3, link_type = None, max_chars = None, min_chars = None, novel = False,
+            rng = None, keyword = None):
+        """Generates a sentence, which with max_chars is walked so that it
+        comes out no longer than that, and with min_chars too, no shorter
+        where the corpus allows. With novel, sentences copying SPAN_TOKENS or
+        more tokens in a row from the corpus are walked again. rng is a seed
+        or random.Random to draw from instead of the random module. With
+        keyword, the sentence is one the corpus could hold it in, grown back
+        to a sentence start and on to an end from wherever it was seen."""
+        word_list = self.walk(n, link_type, max_chars, min_chars, novel, rng = make_rng(rng), keyword = keyword)
+        sentence = self.join_sentence(word_list)
+        LOGGER.debug("%d-Gram Sentence:%s", n, sentence)
+        GENSEN.info("%d-Gram Sentence:%s", n, sentence)
+        METRICS.count("sentences")
         return sentence
-    def make_pos_sentence(self, n = 6):
-        assert self.pos, "POS NGrams not implemented"
-        word_list = generate_pos_ngram_sentence(self.starter_pos_grams, self.pos_lookup, self.pos_words, n)
+    def make_ngram_sentences(self, count, n = 3, link_type = None, max_chars = None, min_chars = None, novel = False,
+            seed = None, keyword = None):
+        """Yields count sentences as make_ngram_sentence would, logging once
+        for the batch instead of for every step and sentence. With seed,
+        sentence i is drawn from sentence_seed(seed, i), just as
+        make_parallel_sentences draws it."""
+        LOGGER.debug("Generating %d %d-Gram sentences", count, n)
+        start = time.time()
+        for index in range(count):
+            rng = random.Random(sentence_seed(seed, index)) if seed is not None else random
+            word_list = self.walk(n, link_type, max_chars, min_chars, novel, verbose = False, rng = rng,
+                    keyword = keyword)
+            METRICS.count("sentences")
+            yield self.join_sentence(word_list, verbose = False)
+        elapsed = time.time() - start
+        LOGGER.info("Generated %d %d-Gram sentences in %.3fs (%.1f sentences/second)",
+                count, n, elapsed, count / elapsed if elapsed else float("inf"))
+    def make_parallel_sentences(self, count, n = 3, link_type = None, max_chars = None, min_chars = None,
+            novel = False, seed = None, jobs = None, keyword = None):
+        """Yields the sentences make_ngram_sentences would with seed, walked
+        across jobs processes, every CPU by default, sharing this model. Any
+        one of them can be made again with make_ngram_sentence(rng =
+        sentence_seed(seed, i)). Without seed one is drawn, and logged."""
+        if seed is None:
+            seed = random.getrandbits(64)
+            LOGGER.info("Seeding %d-Gram sentences with %d", n, seed)
+        jobs = jobs or os.cpu_count() or 1
+        if keyword is not None:
+            # Built once here for every process to share
+            self.reverse_remaining(n)
+        start = time.time()
+        chunks = ([sentence_seed(seed, i) for i in range(first, min(first + GENERATE_CHUNK, count))]
+                for first in range(0, count, GENERATE_CHUNK))
+        for sentences in imap_shared(self, walk_seeds, ((seeds, n, link_type, max_chars, min_chars, novel, keyword)
+                for seeds in chunks), jobs):
+            METRICS.count("sentences", len(sentences))
+            yield from sentences
+        elapsed = time.time() - start
+        LOGGER.info("Generated %d %d-Gram sentences across %d processes in %.3fs (%.1f sentences/second)",
+                count, n, jobs, elapsed, count / elapsed if elapsed else float("inf"))
+    def scoring_trie(self):
+        # The trie counts are read from, built on first use for models walked from other tables
+        if self.trie is not None:
+            return self.trie
+        if self.scoring is None:
+            with METRICS.timer("score_trie"):
+                if self.vocabulary is None:
+                    self.scoring = build_prefix_trie(self.grams, vocabulary = Vocabulary(), quantize = self.quantize)
+                else:
+                    self.scoring = build_prefix_trie({n: Counter(self.grams[n])
+                            for n in range(self.low, self.high + 1)})
+        return self.scoring
+    def token_scores(self, token_lists):
+        """The log score of every token of each token list given the tokens
+        before it, by stupid_backoff over the model's orders."""
+        trie = self.scoring_trie()
+        vocabulary = self.vocabulary if self.vocabulary is not None else trie.vocabulary
+        known = vocabulary.ids
+        unigrams = trie.cumulative[1][-1] if len(trie.cumulative[1]) else 0
+        floor = log(1 / (unigrams + len(vocabulary)))
+        paths = {}
+        with METRICS.timer("score"):
+            return [stupid_backoff(trie, [known.get(t) for t in tokens], self.low, self.high, floor, paths)
+                    for tokens in token_lists]
+    def score(self, sentences):
+        """The log score of each sentence, a string tokenized as the corpus
+        was or a list of tokens, scored in one batch. Stupid backoff doesn't
+        sum to one, so scores rank sentences rather than give probabilities."""
+        token_lists = list(tokenize_documents(sentences, self.tokenizer))
+        return [sum(scores) for scores in self.token_scores(token_lists)]
+    def perplexity(self, sentences):
+        # Perplexity of the sentences taken together, from their scores
+        token_lists = list(tokenize_documents(sentences, self.tokenizer))
+        scores = [score for scores in self.token_scores(token_lists) for score in scores]
+        return exp(-sum(scores) / len(scores)) if scores else float("inf")
+    def make_best_sentences(self, count, pool, n = 3, link_type = None, max_chars = None, min_chars = None,
+            novel = False, seed = None, seconds = None, keyword = None):
+        """Walks pool sentences, fewer if seconds runs out first but never
+        fewer than count, and returns the count of them scoring best per
+        token, best first. Walks are scored as tokens, never tokenized
+        again."""
+        start = time.perf_counter()
+        walks = []
+        for index in range(pool):
+            if index >= count and seconds is not None and time.perf_counter() - start > seconds:
+                break
+            rng = random.Random(sentence_seed(seed, index)) if seed is not None else random
+            walks.append(self.walk(n, link_type, max_chars, min_chars, novel, verbose = False, rng = rng,
+                    keyword = keyword))
+        tokens = [self.vocabulary.decode(w) if self.vocabulary is not None else w for w in walks]
+        scores = [sum(s) / len(s) if s else float("-inf") for s in self.token_scores(tokens)]
+        best = sorted(range(len(walks)), key = lambda i: scores[i], reverse = True)[:count]
+        METRICS.count("sentences", len(walks))
+        LOGGER.debug("Kept %d of %d sentences in %.3fs", len(best), len(walks), time.perf_counter() - start)
+        return [self.join_sentence(walks[i], verbose = False) for i in best]
+    def make_pos_sentence(self, n = 6, rng = None):
+        """Generates a sentence from a walk over the tag grams, each tag
+        filled in with one of the words it was seen with."""
+        assert self.pos, "Built without POS tags"
+        word_list = generate_pos_ngram_sentence(self.starter_pos_grams, self.pos_lookup, self.pos_words, n,
+                rng = make_rng(rng))
         combined = combine_punctuation(word_list)
         sentence = ' '.join(combined)
-        LOGGER.debug("%d-Gram POS Sentence:%s" % (n, sentence))
-        GENSEN.info("%d-Gram POS Sentence:%s" % (n, sentence))
+        LOGGER.debug("%d-Gram POS Sentence:%s", n, sentence)
+        GENSEN.info("%d-Gram POS Sentence:%s", n, sentence)
+        METRICS.count("sentences")
         return sentence
 
+# Model Files
+MODEL_MAGIC = b"NGRM"
+MODEL_VERSION = 5
+MODEL_PREAMBLE = struct.Struct("<4sII")
+MODEL_ALIGNMENT = 8
 def cache_filename(filename):
-    return os.path.splitext(filename)[0] + "-ngram.pickle"
+    return os.path.splitext(filename)[0] + "-ngram.model"
+def model_grams(generator, vocabulary, n):
+    # Counts of each order n gram as a tuple of IDs, whatever the storage
+    if generator.vocabulary is None:
+        return Counter({tuple(vocabulary.intern(t) for t in g): c for g, c in generator.grams[n].items()})
+    return Counter(generator.grams[n])
+def model_starters(generator, vocabulary, n):
+    if generator.vocabulary is None:
+        return Counter({tuple(vocabulary.intern(t) for t in g): c for g, c in generator.starter_grams[n]})
+    return Counter(generator.starter_grams[n])
+def model_sections(generator):
+    LOGGER.debug("Laying out model sections")
+    vocabulary = generator.vocabulary
+    trie = generator.trie
+    counts = None
+    if trie is None and vocabulary is None:
+        # Counted models intern their tokens into the trie they score with
+        trie = generator.scoring_trie()
+    if trie is None:
+        counts = {n: model_grams(generator, vocabulary, n) for n in range(generator.low, generator.high + 1)}
+        trie = build_prefix_trie(counts, quantize = generator.quantize)
+    elif vocabulary is None:
+        # Counted models already interned their tokens for the trie
+        vocabulary = trie.vocabulary
+    sections = []
+    for n in range(1, trie.high + 1):
+        sections.append(("trie/%d/ids" % n, trie.ids[n]))
+        if n < trie.high:
+            sections.append(("trie/%d/children" % n, trie.children[n]))
+        sections.append(("trie/%d/cumulative" % n, trie.cumulative[n]))
+    sections.append(("spans/hashes", generator.spans.hashes))
+    for n in range(generator.low, generator.high + 1):
+        if n > 1:
+            # Remaining characters of each state, in the order of its node
+            grams = counts[n] if counts is not None else model_grams(generator, vocabulary, n)
+            states = trie.level(n - 1)
+            sentence_end = set(vocabulary.ids[t] for t in SENTENCE_END if t in vocabulary.ids)
+            chars = lambda id, previous: token_chars(vocabulary.tokens[id],
+                    vocabulary.tokens[previous] if previous is not None else None)
+            for link_type in LINK_TYPES:
+                remaining = build_min_remaining(grams, n, link_type, sentence_end, chars)
+                values = array(COUNT_TYPECODE, (remaining.get(state, UNREACHABLE) for state in states))
+                sections.append(("remaining/%d/%s" % (n, str(link_type).lower()), values))
+        grams = array(ID_TYPECODE)
+        cumulative = array(COUNT_TYPECODE)
+        total = 0
+        for gram, count in model_starters(generator, vocabulary, n).items():
+            total += count
+            grams.extend(gram)
+            cumulative.append(total)
+        sections.append(("starter/%d/grams" % n, grams))
+        sections.append(("starter/%d/cumulative" % n, cumulative))
+    blob = bytearray()
+    offsets = array(OFFSET_TYPECODE, [0])
+    for token in vocabulary.tokens:
+        blob.extend(token.encode("utf-8"))
+        offsets.append(len(blob))
+    sections.append(("vocabulary/offsets", offsets))
+    sections.append(("vocabulary/blob", array("B", blob)))
+    sentence_end = sorted(vocabulary.ids[t] for t in SENTENCE_END if t in vocabulary.ids)
+    return sections, sentence_end
+def save_model(generator, filename, corpus = None):
+    """Writes the generator as a memory-mappable model file. The file is
+    written beside its destination and renamed into place, so readers only
+    ever see a complete model. corpus records what the model was built from,
+    as made by load_generator."""
+    LOGGER.debug("Saving model to %s", filename)
+    start = time.perf_counter()
+    sections, sentence_end = model_sections(generator)
+    write_model(filename, {
+            "low" : generator.low,
+            "high" : generator.high,
+            "tokenizer" : generator.tokenizer,
+            "span_tokens" : generator.spans.k,
+            "byteorder" : sys.byteorder,
+            "sentence_end" : sentence_end,
+            "tail" : generator.tail(),
+            "corpus" : corpus or {},
+            "pruning" : generator.pruning,
+            }, sections)
+    METRICS.time("save", time.perf_counter() - start)
+    return True
+def write_model(filename, header, sections):
+    """Writes header and sections, (name, data) pairs of arrays or anything
+    else with a typecode, itemsize, length and tofile, as a model file."""
+    header = dict(header, sections = {})
+    # Section offsets are relative to the end of the header, so the header
+    # can be sized after the layout is known
+    offset = 0
+    for name, data in sections:
+        header["sections"][name] = [offset, len(data), data.typecode]
+        offset += len(data) * data.itemsize
+        offset += -offset % MODEL_ALIGNMENT
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-(MODEL_PREAMBLE.size + len(encoded)) % MODEL_ALIGNMENT)
+    with atomic_file(filename) as file:
+        file.write(MODEL_PREAMBLE.pack(MODEL_MAGIC, MODEL_VERSION, len(encoded)))
+        file.write(encoded)
+        for name, data in sections:
+            data.tofile(file)
+            file.write(b"\0" * (-file.tell() % MODEL_ALIGNMENT))
+class MappedVocabulary(object):
+    """Decodes token IDs straight out of a mapped model file."""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self.known = None
+    def __len__(self):
+        return len(self.offsets) - 1
+    @property
+    def ids(self):
+        # Token to ID, decoded from the blob on first use for encoding tokens
+        if self.known is None:
+            self.known = {token: id for id, token in enumerate(self.decode(range(len(self))))}
+        return self.known
+    def decode(self, ids):
+        return [bytes(self.blob[self.offsets[id]:self.offsets[id + 1]]).decode("utf-8") for id in ids]
+    def token(self, id):
+        return bytes(self.blob[self.offsets[id]:self.offsets[id + 1]]).decode("utf-8")
+class MappedTable(object):
+    """One prefix's successors in a mapped model file."""
+    __slots__ = ("prefix", "width", "extend", "cumulative", "start", "stop")
+    def __init__(self, prefix, width, extend, cumulative, start, stop):
+        self.prefix = prefix
+        self.width = width
+        self.extend = extend
+        self.cumulative = cumulative
+        self.start = start
+        self.stop = stop
+    def __len__(self):
+        return self.stop - self.start
+    @property
+    def total(self):
+        return self.cumulative[self.stop - 1] if self.stop > self.start else 0
+    def __iter__(self):
+        previous = 0
+        for ndx in range(self.start, self.stop):
+            yield self.prefix + tuple(self.extend[ndx * self.width:(ndx + 1) * self.width]), self.cumulative[ndx] - previous
+            previous = self.cumulative[ndx]
+    def sample(self, rng = random):
+        if self.stop == self.start:
+            raise IndexError("Cannot sample from an empty table")
+        ndx = bisect_right(self.cumulative, rng.randrange(self.total), self.start, self.stop)
+        return self.prefix + tuple(self.extend[ndx * self.width:(ndx + 1) * self.width])
+class MappedRemaining(object):
+    """Remaining characters of each state, beside its key in a mapped model."""
+    def __init__(self, lookup, values):
+        self.lookup = lookup
+        self.values = values
+    def get(self, state):
+        bucket = self.lookup.find(state)
+        if bucket is None or self.values[bucket] == UNREACHABLE:
+            return None
+        return self.values[bucket]
+class MappedNGram(NGram):
+    """An NGram generating straight from a mapped model file, touching only
+    the pages that the lookups for each sentence need."""
+    def __init__(self, filename):
+        LOGGER.debug("Mapping model at %s", filename)
+        began = time.perf_counter()
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(self.map) < MODEL_PREAMBLE.size:
+            raise ValueError("%s is too short to be a model file" % filename)
+        magic, version, length = MODEL_PREAMBLE.unpack_from(self.map)
+        if magic != MODEL_MAGIC:
+            raise ValueError("%s is not a model file" % filename)
+        if version != MODEL_VERSION:
+            raise ValueError("%s is model version %d, expected %d" % (filename, version, MODEL_VERSION))
+        start = MODEL_PREAMBLE.size
+        header = json.loads(self.map[start:start + length].decode("utf-8"))
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("%s was written %s endian" % (filename, header["byteorder"]))
+        self.data = start + length
+        self.sections = header["sections"]
+
+        # Store Relevant Data
+        self.low            = header["low"]
+        self.high           = header["high"]
+        self.tokenizer      = header["tokenizer"]
+        self.text           = None
+        self.grams          = None
+        levels              = range(1, self.high + 1)
+        self.trie           = PrefixTrie({n: self.section("trie/%d/ids" % n) for n in levels},
+                {n: self.section("trie/%d/children" % n) for n in levels if n < self.high},
+                {n: self.section("trie/%d/cumulative" % n) for n in levels})
+        self.lookup         = {n: TrieLookup(self.trie, n) for n in range(self.low, self.high + 1)}
+        self.starter_grams  = {}
+        for n in range(self.low, self.high + 1):
+            cumulative = self.section("starter/%d/cumulative" % n)
+            self.starter_grams[n] = MappedTable((), n, self.section("starter/%d/grams" % n),
+                    cumulative, 0, len(cumulative))
+        self.vocabulary     = MappedVocabulary(self.section("vocabulary/offsets"), self.section("vocabulary/blob"))
+        self.spans          = SpanIndex(header["span_tokens"], self.section("spans/hashes"))
+        self.sentence_end   = set(header["sentence_end"])
+        self.corpus         = header["corpus"]
+        self.pruning        = header.get("pruning", pruning_header())
+        self.quantize       = self.pruning["quantize"]
+        self.last_tokens    = header["tail"]
+        self.pos = False
+        METRICS.time("load", time.perf_counter() - began)
+        self.measure()
+    def footprint(self):
+        # Only the pages generation touches are ever read in
+        return len(self.map)
+    def tail(self):
+        return list(self.last_tokens)
+    def min_remaining(self, n, link_type = None):
+        values = self.section("remaining/%d/%s" % (n, str(link_type).lower()))
+        return MappedRemaining(self.lookup[n], values)
+    def counter(self):
+        """Recovers the gram counts from the trie, for continuing the model
+        with more documents."""
+        LOGGER.debug("Recovering counts from model")
+        tokens = self.vocabulary.decode(range(len(self.vocabulary)))
+        counter = NGramCounter(self.low, self.high)
+        counter.tail = self.tail()
+        for n in range(self.low, self.high + 1):
+            counts = counter.grams[n]
+            for gram, count in self.trie.counts(n):
+                counts[tuple(tokens[id] for id in gram)] = count
+        return counter
+    def span_index(self):
+        # A copy of the spans that more documents can be added to
+        return SpanIndex(self.spans.k, array(SPAN_TYPECODE, self.spans.hashes))
+    def section(self, name):
+        offset, length, typecode = self.sections[name]
+        start = self.data + offset
+        size = array(typecode).itemsize
+        return memoryview(self.map)[start:start + length * size].cast(typecode)
+CORPUS_CHUNK = 1 << 20
+def corpus_digest(filename):
+    digest = hashlib.sha256()
+    with METRICS.timer("digest"), open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(CORPUS_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+class DocumentDigest(object):
+    """Running digest over the documents read through it, so a model can
+    tell whether a corpus only grew since it was built."""
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.count = 0
+    def read(self, documents):
+        for document in documents:
+            self.hash.update(hashlib.sha256(document.encode("utf-8")).digest())
+            self.count += 1
+            yield document
+    def hexdigest(self):
+        return self.hash.hexdigest()
+def load_generator(filename, n, cache = True, tokens = True, **params):
+    """Maps the cached model for a corpus. The cache is keyed on a digest of
+    the corpus and the build parameters: a model built from an earlier run
+    of the same documents only has the new documents counted into it, and
+    any other mismatch, pruning included, rebuilds it from the corpus. A
+    pruned model is always rebuilt whole, as its counts have lost grams the
+    new documents would add to. With tokens, whatever is
+    built takes the tokens of documents it has seen before from the corpus's
+    token cache. Without a tokenizer, the cached model's is kept, so a
+    corpus built with another tokenizer isn't rebuilt with the default. Model
+    files hold no tags, so pos always builds in memory.
+    With max_memory, counts that would take more than that many bytes spill
+    to disk and the model is written from them, counting every document
+    again rather than continuing."""
+    digest = corpus_digest(filename)
+    tokenizer = params.get("tokenizer")
+    max_memory = params.pop("max_memory", None)
+    assert not (max_memory and (params.get("pos") or params.get("compact") or params.get("min_counts")
+            or params.get("top_k") or params.get("max_bytes"))), "Out-of-core builds keep every gram, untagged"
+    generator = None
+    if cache and not params.get("pos") and os.path.isfile(cache_filename(filename)):
+        LOGGER.debug("Loading from cache at %s" % cache_filename(filename))
+        try:
+            generator = MappedNGram(cache_filename(filename))
+        except (ValueError, KeyError) as e:
+            LOGGER.warning("Ignoring unreadable cache: %s" % e)
+    if tokenizer is None:
+        # Unless told otherwise, the model is built the way it was last time
+        tokenizer = params["tokenizer"] = generator.tokenizer if generator != None else NGram.tokenizer
+    if generator != None and generator.high < n:
+        LOGGER.debug("%d smaller than %d. Rebuilding." % (generator.high, n))
+        generator = None
+    if generator != None and generator.tokenizer != tokenizer:
+        LOGGER.debug("Cache tokenized with %s. Rebuilding." % generator.tokenizer)
+        generator = None
+    if generator != None and generator.pruning != pruning_header(**{k: params[k] for k in PRUNING if k in params}):
+        LOGGER.debug("Cache pruned with %s. Rebuilding." % generator.pruning)
+        generator = None
+    if generator != None and generator.corpus.get("digest") == digest:
+        return generator
+
+    if tokens:
+        params["token_cache"] = TokenCache(token_cache_filename(filename))
+    try:
+        documents = DocumentDigest()
+        if (generator != None and generator.corpus.get("documents") and generator.pruning == pruning_header()
+                and not max_memory):
+            # Read through the documents the model already has, then count the rest
+            texts = documents.read(iter_documents(filename))
+            for text in islice(texts, generator.corpus["documents"]):
+                pass
+            if (documents.count == generator.corpus["documents"]
+                    and documents.hexdigest() == generator.corpus["documents_digest"]):
+                LOGGER.debug("Adding documents after the first %d" % documents.count)
+                params.pop("compact", None)
+                updated = NGram((normalize_text(text) for text in texts), generator.low, generator.high,
+                        counter = generator.counter(), spans = generator.span_index(), **params)
+                corpus = {"digest" : digest, "documents" : documents.count, "documents_digest" : documents.hexdigest()}
+                LOGGER.debug("Caching as %s" % cache_filename(filename))
+                save_model(updated, cache_filename(filename), corpus)
+                return updated
+            LOGGER.debug("Corpus changed before document %d. Rebuilding." % documents.count)
+            documents = DocumentDigest()
+
+        LOGGER.debug("Getting Text")
+        texts = documents.read(iter_documents(filename))
+        if max_memory:
+            LOGGER.debug("Counting within %d bytes" % max_memory)
+            directory = os.path.dirname(os.path.abspath(cache_filename(filename)))
+            with tempfile.TemporaryDirectory(prefix = ".spill-", dir = directory) as directory:
+                counter = SpillingCounter(1, n, directory, max_memory)
+                counter.count((normalize_text(text) for text in texts), tokenizer, params.get("token_cache"),
+                        params.get("jobs", 1))
+                corpus = {"digest" : digest, "documents" : documents.count, "documents_digest" : documents.hexdigest()}
+                LOGGER.debug("Caching as %s" % cache_filename(filename))
+                save_spilled_model(counter, cache_filename(filename), corpus, tokenizer, params.get("quantize", False))
+            return MappedNGram(cache_filename(filename))
+        generator = NGram((normalize_text(text) for text in texts), high = n, **params)
+        corpus = {"digest" : digest, "documents" : documents.count, "documents_digest" : documents.hexdigest()}
+        LOGGER.debug("Caching as %s" % cache_filename(filename))
+        save_model(generator, cache_filename(filename), corpus)
+        return generator
+    finally:
+        if tokens:
+            params["token_cache"].close()
+
+def load_model(filename, n):
+    """Maps a model file saved by an earlier build for generation alone. No
+    corpus is read, so nothing is ever rebuilt and nltk is never imported."""
+    generator = MappedNGram(filename)
+    if generator.high < n:
+        raise ValueError("%s only has n-grams up to %d" % (filename, generator.high))
+    return generator
 
+# Out-of-Core Building
+SPILL_BYTES = 256 << 20
+GRAM_ENTRY_BYTES = 240
+RUN_TYPECODE = "Q"
+RUN_RECORDS = 4096
+SPILL_TOKENS = 4096
+MERGE_FANIN = 32
+DISK_PAGE = 4096
+class SortedRuns(object):
+    """Runs on disk of records sorted on a key of width IDs, each with a
+    count and the position it was first seen at, merged back into one run
+    with the counts of equal keys summed and the first position kept."""
+    def __init__(self, directory, width):
+        self.directory = directory
+        self.width = width
+        self.runs = []
+    def spill(self, records):
+        # Writes records, already sorted, as one more run
+        fd, filename = tempfile.mkstemp(prefix = "run-", dir = self.directory)
+        buffer = array(RUN_TYPECODE)
+        with os.fdopen(fd, "wb") as file:
+            for key, count, first in records:
+                buffer.extend(key)
+                buffer.append(count)
+                buffer.append(first)
+                if len(buffer) >= RUN_RECORDS * (self.width + 2):
+                    buffer.tofile(file)
+                    del buffer[:]
+            buffer.tofile(file)
+        self.runs.append(filename)
+    def read(self, filename):
+        # Yields the records of a run a buffer at a time
+        width = self.width
+        with open(filename, "rb") as file:
+            while True:
+                buffer = array(RUN_TYPECODE)
+                try:
+                    buffer.fromfile(file, RUN_RECORDS * (width + 2))
+                except EOFError:
+                    pass
+                if not buffer:
+                    return
+                for ndx in range(0, len(buffer), width + 2):
+                    yield tuple(buffer[ndx:ndx + width]), buffer[ndx + width], buffer[ndx + width + 1]
+    def combine(self, filenames):
+        key = None
+        for record in merge(*(self.read(filename) for filename in filenames)):
+            if record[0] != key:
+                if key is not None:
+                    yield key, count, first
+                key, count, first = record
+            else:
+                count += record[1]
+                first = min(first, record[2])
+        if key is not None:
+            yield key, count, first
+    def finish(self):
+        """Merges the runs down to one, MERGE_FANIN at a time so that only
+        so many are ever open and buffered at once."""
+        if not self.runs:
+            self.spill(())
+        while len(self.runs) > 1:
+            group, self.runs = self.runs[:MERGE_FANIN], self.runs[MERGE_FANIN:]
+            self.spill(self.combine(group))
+            for filename in group:
+                os.unlink(filename)
+    def __iter__(self):
+        assert len(self.runs) == 1, "Runs must be finished before reading"
+        return self.read(self.runs[0])
+class SpillingCounter(object):
+    """Counts token lists as NGramCounter does, grams as tuples of IDs, and
+    hashes their spans as SpanIndex does, spilling both to sorted runs in
+    directory whenever they'd take more than max_memory bytes. Only the
+    vocabulary stays in memory for the whole corpus. Each gram keeps where
+    it was first seen, the spill and its place in the Counter, so the order
+    the in-memory build meets grams in can be had back."""
+    def __init__(self, low, high, directory, max_memory = SPILL_BYTES, k = SPAN_TOKENS):
+        self.low = low
+        self.high = high
+        self.directory = directory
+        self.max_memory = max_memory
+        self.counter = NGramCounter(low, high)
+        self.vocabulary = Vocabulary()
+        self.spans = SpanIndex(k)
+        self.grams = {n: SortedRuns(directory, n) for n in range(low, high + 1)}
+        self.span_runs = SortedRuns(directory, 1)
+        self.spilled = 0
+    def size(self):
+        # Rough bytes held by the counts and hashes so far
+        entries = sum(len(counts) for counts in self.counter.grams.values())
+        return entries * GRAM_ENTRY_BYTES + array_bytes(self.spans.hashes)
+    def add(self, tokens):
+        # Long documents are counted SPILL_TOKENS at a time, the tail carrying grams across
+        ids = self.vocabulary.encode(tokens)
+        for start in range(0, len(ids), SPILL_TOKENS):
+            self.counter.add(ids[start:start + SPILL_TOKENS])
+            if self.size() > self.max_memory:
+                self.spill()
+        self.spans.add(tokens)
+    def count(self, documents, tokenizer = "word_tokenize", cache = None, jobs = 1):
+        """Tokenizes and counts documents, across jobs processes when above
+        one, as NGram counts a compact model's."""
+        token_lists = tokenize_documents(documents, tokenizer, cache)
+        if jobs > 1:
+            documents = cached_documents(documents, tokenizer, cache)
+            shards = ((shard, tokenizer, cache is not None) for shard in shard_documents(documents))
+            token_lists = (cache_tokens(cache, key, tokens)
+                    for tokenized in imap_jobs(tokenize_shard, shards, jobs) for key, tokens in tokenized)
+        for token_list in token_lists:
+            with METRICS.timer("count"):
+                self.add(token_list)
+    def spill(self):
+        LOGGER.debug("Spilling run %d to %s", self.spilled, self.directory)
+        with METRICS.timer("spill"):
+            base = self.spilled << 40
+            for n, counts in self.counter.grams.items():
+                records = sorted((key, count, base + rank) for rank, (key, count) in enumerate(counts.items()))
+                counts.clear()
+                self.grams[n].spill(records)
+                del records
+            self.spans.freeze()
+            self.span_runs.spill(((value,), 1, 0) for value in self.spans.hashes)
+            self.spans.hashes = array(SPAN_TYPECODE)
+        self.spilled += 1
+        METRICS.count("spilled_runs")
+    def finish(self):
+        """Spills what is left and merges every order's runs."""
+        self.spill()
+        with METRICS.timer("merge"):
+            for runs in list(self.grams.values()) + [self.span_runs]:
+                runs.finish()
+    def level(self, n):
+        """Every node of trie level n in order, as (IDs, count, first)
+        records. Levels below the counted orders are the prefixes of the
+        level above, with no count."""
+        if n >= self.low:
+            return iter(self.grams[n])
+        return ((prefix, 0, 0) for prefix, _ in groupby(key[:-1] for key, count, first in self.level(n + 1)))
+    def tail(self):
+        return self.vocabulary.decode(self.counter.tail)
+def cache_tokens(cache, key, tokens):
+    # Keeps the tokens a shard worker made, which can't write the cache itself
+    if key is not None:
+        cache.put(key, tokens)
+    return tokens
+class SectionFile(object):
+    """A model section written to its own file as it is made, so that no
+    more than a buffer of it is in memory until the model is put
+    together."""
+    def __init__(self, directory, typecode, values = ()):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.length = 0
+        self.buffer = array(typecode)
+        fd, self.filename = tempfile.mkstemp(prefix = "section-", dir = directory)
+        self.file = os.fdopen(fd, "wb")
+        for value in values:
+            self.append(value)
+    def __len__(self):
+        return self.length + len(self.buffer)
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= RUN_RECORDS:
+            self.flush()
+    def flush(self):
+        self.buffer.tofile(self.file)
+        self.length += len(self.buffer)
+        del self.buffer[:]
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+    def tofile(self, file):
+        self.close()
+        with open(self.filename, "rb") as section:
+            shutil.copyfileobj(section, file)
+class DiskArray(object):
+    """A closed SectionFile read and written in place DISK_PAGE values at a
+    time, holding no more than pages of them in memory and writing back
+    the least recently used first."""
+    def __init__(self, section, pages):
+        section.close()
+        self.typecode = section.typecode
+        self.size = DISK_PAGE * section.itemsize
+        self.file = open(section.filename, "r+b")
+        self.pages = pages
+        self.cache = OrderedDict()
+    def write(self, number, data):
+        os.pwrite(self.file.fileno(), data.tobytes(), number * self.size)
+    def page(self, number):
+        entry = self.cache.get(number)
+        if entry is not None:
+            self.cache.move_to_end(number)
+            return entry
+        if len(self.cache) >= self.pages:
+            evicted, (data, dirty) = self.cache.popitem(last = False)
+            if dirty:
+                self.write(evicted, data)
+        data = array(self.typecode)
+        data.frombytes(os.pread(self.file.fileno(), self.size, number * self.size))
+        entry = self.cache[number] = [data, False]
+        return entry
+    def __getitem__(self, index):
+        return self.page(index // DISK_PAGE)[0][index % DISK_PAGE]
+    def __setitem__(self, index, value):
+        entry = self.page(index // DISK_PAGE)
+        entry[0][index % DISK_PAGE] = value
+        entry[1] = True
+    def close(self):
+        for number, (data, dirty) in self.cache.items():
+            if dirty:
+                self.write(number, data)
+        self.cache.clear()
+        self.file.close()
+class DiskLists(object):
+    """A list of records width values wide for each node of a level, kept
+    in two DiskArrays: where each node's records start, and the records."""
+    def __init__(self, directory, lists, width, pages):
+        starts, values = SectionFile(directory, RUN_TYPECODE), SectionFile(directory, RUN_TYPECODE)
+        for records in lists:
+            starts.append(len(values) // width)
+            for record in records:
+                for value in record:
+                    values.append(value)
+        starts.append(len(values) // width)
+        self.width = width
+        self.nodes = len(starts) - 1
+        self.starts = DiskArray(starts, pages)
+        self.values = DiskArray(values, pages)
+    def __getitem__(self, index):
+        width, values = self.width, self.values
+        return [tuple(values[ndx] for ndx in range(record * width, (record + 1) * width))
+                for record in range(self.starts[index], self.starts[index + 1])]
+    def close(self):
+        self.starts.close()
+        self.values.close()
+class Frontier(object):
+    """Entries of a search over small integer costs, bucketed by distance,
+    each bucket buffered in memory up to RUN_RECORDS and spilled to a file
+    of its own past that. Iterating yields the nearest bucket's distance
+    and entries until none are left, buckets filled meanwhile included."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.buckets = {}
+    def push(self, distance, entry):
+        bucket = self.buckets.get(distance)
+        if bucket is None:
+            bucket = self.buckets[distance] = [array(RUN_TYPECODE), None]
+        bucket[0].append(entry)
+        if len(bucket[0]) >= RUN_RECORDS:
+            if bucket[1] is None:
+                fd, bucket[1] = tempfile.mkstemp(prefix = "bucket-", dir = self.directory)
+                os.close(fd)
+            with open(bucket[1], "ab") as file:
+                bucket[0].tofile(file)
+            del bucket[0][:]
+    def entries(self, buffer, filename):
+        if filename is not None:
+            with open(filename, "rb") as file:
+                while True:
+                    spilled = array(RUN_TYPECODE)
+                    try:
+                        spilled.fromfile(file, RUN_RECORDS)
+                    except EOFError:
+                        pass
+                    if not spilled:
+                        break
+                    yield from spilled
+            os.unlink(filename)
+        yield from buffer
+    def __iter__(self):
+        while self.buckets:
+            distance = min(self.buckets)
+            yield distance, self.entries(*self.buckets.pop(distance))
+def level_children(level, following):
+    # Where the children of each node of a level start on the next, walking both in order
+    following = iter(following)
+    below = next(following, None)
+    child = 0
+    yield 0
+    for key, count, first in level:
+        while below is not None and below[0][:-1] == key:
+            child += 1
+            below = next(following, None)
+        yield child
+def level_ancestors(counter, n):
+    # Each gram of level n with the node of each of its prefixes, by length, on the levels above
+    levels = {r: enumerate(counter.level(r)) for r in range(1, n)}
+    current = {r: (None, None) for r in range(1, n)}
+    for key, count, first in counter.level(n):
+        nodes = [None]
+        for r in range(1, n):
+            index, prefix = current[r]
+            while prefix != key[:r]:
+                index, (prefix, _, _) = next(levels[r])
+            current[r] = (index, prefix)
+            nodes.append(index)
+        yield key, nodes
+def join_level(level, records, width):
+    # Each node of a level with the rest of the keys of those records, sorted on their first width IDs, under it
+    records = iter(records)
+    record = next(records, None)
+    for index, (key, count, first) in enumerate(level):
+        rest = []
+        while record is not None and record[0][:width] <= key:
+            if record[0][:width] == key:
+                rest.append(record[0][width:])
+            record = next(records, None)
+        yield index, key, rest
+def sorted_runs(directory, width, records, batch):
+    # Records with unique keys sorted out of core, batch of them at a time
+    runs = SortedRuns(directory, width)
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= batch:
+            buffer.sort()
+            runs.spill(buffer)
+            buffer = []
+    buffer.sort()
+    runs.spill(buffer)
+    runs.finish()
+    return runs
+def spilled_remaining(counter, n, link_type, sentence_end, chars):
+    """The section of remaining characters build_min_remaining finds for
+    order n, a value for each node of level n - 1, by the same search.
+    The grams arriving at each state and the states ending with each
+    shorter prefix are sorted out of core into DiskLists, and the search
+    reads them, and keeps its distances, a page at a time."""
+    directory, batch = counter.directory, max(counter.max_memory // GRAM_ENTRY_BYTES, RUN_RECORDS)
+    lengths = link_lengths(n, link_type)
+    shorter = [r for r in lengths if r < n - 1]
+    # Half the memory for pages, shared by every DiskArray of the search
+    pages = max(counter.max_memory // (2 * (3 + 2 * len(shorter)) * DISK_PAGE * 8), 2)
+
+    # Grams by the state they arrive at, with the node and cost of each prefix linked on
+    arriving = sorted_runs(directory, n - 1 + 2 * len(lengths), ((key[1:] + tuple(nodes[r] for r in lengths)
+            + tuple(gram_chars(key, r, chars) for r in lengths), 0, 0) for key, nodes in level_ancestors(counter, n)),
+            batch)
+    frontier = Frontier(directory)
+    section = SectionFile(directory, COUNT_TYPECODE)
+    def states():
+        for index, key, rest in join_level(counter.level(n - 1), arriving, n - 1):
+            section.append(UNREACHABLE)
+            if rest and key[-1] in sentence_end:
+                frontier.push(0, index << 4)
+            yield rest
+    arrivals = DiskLists(directory, states(), 2 * len(lengths), pages)
+    ending = {}
+    for r in shorter:
+        suffixes = sorted_runs(directory, r + 1, ((key[-r:] + (index,), 0, 0)
+                for index, (key, count, first) in enumerate(counter.level(n - 1))), batch)
+        lists = DiskLists(directory, (rest for index, key, rest in join_level(counter.level(r), suffixes, r)), 1, pages)
+        ending[r] = (lists, bytearray(lists.nodes // 8 + 1))
+
+    # Entries are a node index shifted past the prefix length, none for a state
+    remaining = DiskArray(section, pages)
+    for distance, entries in frontier:
+        for entry in entries:
+            r, index = entry & 15, entry >> 4
+            if r:
+                lists, settled = ending[r]
+                if settled[index >> 3] & (1 << (index & 7)):
+                    continue
+                settled[index >> 3] |= 1 << (index & 7)
+                for state, in lists[index]:
+                    if remaining[state] == UNREACHABLE:
+                        frontier.push(distance, state << 4)
+                continue
+            if remaining[index] != UNREACHABLE:
+                continue
+            remaining[index] = distance
+            for record in arrivals[index]:
+                for ndx, r in enumerate(lengths):
+                    node, cost = record[ndx], distance + record[len(lengths) + ndx]
+                    if r == n - 1:
+                        if remaining[node] == UNREACHABLE:
+                            frontier.push(cost, node << 4)
+                    elif not ending[r][1][node >> 3] & (1 << (node & 7)):
+                        frontier.push(cost, node << 4 | r)
+    remaining.close()
+    arrivals.close()
+    for lists, settled in ending.values():
+        lists.close()
+    return section
+def running_totals(level, shift = 0):
+    total = 0
+    for key, count, first in level:
+        total += max(count >> shift, 1) if count else 0
+        yield total
+def spilled_sections(counter, quantize = False):
+    """The sections model_sections lays out for a counted model, made from
+    the merged runs of a SpillingCounter one section at a time, sorting
+    out of core wherever the in-memory build sorts. Only the vocabulary is
+    held whole."""
+    directory, vocabulary, low, high = counter.directory, counter.vocabulary, counter.low, counter.high
+    batch = max(counter.max_memory // GRAM_ENTRY_BYTES, RUN_RECORDS)
+    wide = COUNT_TYPECODE if quantize else OFFSET_TYPECODE
+    sections = []
+    for n in range(1, high + 1):
+        sections.append(("trie/%d/ids" % n, SectionFile(directory, ID_TYPECODE,
+                (key[-1] for key, count, first in counter.level(n)))))
+        if n < high:
+            sections.append(("trie/%d/children" % n, SectionFile(directory, wide,
+                    level_children(counter.level(n), counter.level(n + 1)))))
+        shift = 0
+        if quantize:
+            length, total = 0, 0
+            for key, count, first in counter.level(n):
+                length, total = length + 1, total + count
+            shift = count_shift(total, length)
+        sections.append(("trie/%d/cumulative" % n, SectionFile(directory, wide, running_totals(counter.level(n), shift))))
+    sections.append(("spans/hashes", SectionFile(directory, SPAN_TYPECODE,
+            (key[0] for key, count, first in counter.span_runs))))
+    sentence_end = set(vocabulary.ids[t] for t in SENTENCE_END if t in vocabulary.ids)
+    starters = set()
+    if low <= 2 <= high:
+        starters = set(key[1] for key, count, first in counter.level(2)
+                if key[0] in sentence_end and vocabulary.tokens[key[1]][0].isupper())
+    chars = lambda id, previous: token_chars(vocabulary.tokens[id],
+            vocabulary.tokens[previous] if previous is not None else None)
+    for n in range(low, high + 1):
+        if n > 1:
+            with METRICS.timer("remaining"):
+                for link_type in LINK_TYPES:
+                    sections.append(("remaining/%d/%s" % (n, str(link_type).lower()),
+                            spilled_remaining(counter, n, link_type, sentence_end, chars)))
+        # Starters go in the order the in-memory build first met them
+        counted = sorted_runs(directory, n + 1, (((first,) + key, count, 0)
+                for key, count, first in counter.level(n) if key[0] in starters), batch)
+        grams, cumulative = SectionFile(directory, ID_TYPECODE), SectionFile(directory, COUNT_TYPECODE)
+        total = 0
+        for key, count, first in counted:
+            total += count
+            for id in key[1:]:
+                grams.append(id)
+            cumulative.append(total)
+        sections.append(("starter/%d/grams" % n, grams))
+        sections.append(("starter/%d/cumulative" % n, cumulative))
+    blob = bytearray()
+    offsets = array(OFFSET_TYPECODE, [0])
+    for token in vocabulary.tokens:
+        blob.extend(token.encode("utf-8"))
+        offsets.append(len(blob))
+    sections.append(("vocabulary/offsets", offsets))
+    sections.append(("vocabulary/blob", array("B", blob)))
+    return sections, sorted(sentence_end)
+def save_spilled_model(counter, filename, corpus = None, tokenizer = NGram.tokenizer, quantize = False):
+    """Writes the model of what a SpillingCounter counted, the same model
+    file an in-memory build of the same documents saves."""
+    LOGGER.debug("Saving out-of-core model to %s", filename)
+    start = time.perf_counter()
+    counter.finish()
+    sections, sentence_end = spilled_sections(counter, quantize)
+    write_model(filename, {
+            "low" : counter.low,
+            "high" : counter.high,
+            "tokenizer" : tokenizer,
+            "span_tokens" : counter.spans.k,
+            "byteorder" : sys.byteorder,
+            "sentence_end" : sentence_end,
+            "tail" : counter.tail(),
+            "corpus" : corpus or {},
+            "pruning" : pruning_header(quantize = quantize),
+            }, sections)
+    METRICS.time("save", time.perf_counter() - start)
+    return True
+
+# Model Mixing
+MIX_SCALE = 1 << 32
+def encode_prefix(prefix, vocabulary):
+    # The IDs of prefix in a model's vocabulary, or None if it has a token the model never saw
+    if vocabulary is None:
+        return prefix
+    known = vocabulary.ids
+    ids = tuple(known.get(token) for token in prefix)
+    return None if None in ids else ids
+class TokenTable(object):
+    """A table of a model keeping token IDs, seen as one of tokens."""
+    __slots__ = ("table", "vocabulary")
+    def __init__(self, table, vocabulary):
+        self.table = table
+        self.vocabulary = vocabulary
+    def __len__(self):
+        return len(self.table)
+    def __iter__(self):
+        for gram, count in successors(self.table):
+            yield tuple(self.vocabulary.decode(gram)), count
+    def sample(self, rng = random):
+        return tuple(self.vocabulary.decode(sample(self.table, rng)))
+class TokenLookup(object):
+    """One order of the lookup of a model keeping token IDs, looked up and
+    answered in tokens, so that models with different vocabularies agree."""
+    def __init__(self, lookup, vocabulary):
+        self.lookup = lookup
+        self.vocabulary = vocabulary
+    def __contains__(self, prefix):
+        ids = encode_prefix(prefix, self.vocabulary)
+        return ids is not None and ids in self.lookup
+    def __getitem__(self, prefix):
+        ids = encode_prefix(prefix, self.vocabulary)
+        if ids is None:
+            raise KeyError(prefix)
+        return TokenTable(self.lookup[ids], self.vocabulary)
+def token_view(table, vocabulary, lookup = False):
+    if vocabulary is None:
+        return table
+    return TokenLookup(table, vocabulary) if lookup else TokenTable(table, vocabulary)
+class MixedTable(object):
+    """The successors of one prefix under several weighted models. Sampling
+    picks a model by weight, then samples from that model's own table, which
+    draws from the interpolated distribution without merging the tables."""
+    __slots__ = ("tables", "weight")
+    def __init__(self, tables):
+        self.tables = tables
+        self.weight = sum(weight for weight, table in tables)
+    def __len__(self):
+        return sum(len(table) for weight, table in self.tables)
+    def __iter__(self):
+        # Counts rescaled to each model's share, whole numbers as sample_where needs
+        for weight, table in self.tables:
+            counted = list(successors(table))
+            total = sum(count for gram, count in counted)
+            for gram, count in counted:
+                yield gram, max(int(MIX_SCALE * weight * count / (self.weight * total)), 1)
+    def sample(self, rng = random):
+        r = rng.random() * self.weight
+        for weight, table in self.tables:
+            r -= weight
+            if r < 0:
+                break
+        return sample(table, rng)
+class MixedLookup(object):
+    """One order of several models' lookups, interpolated with weights over
+    whichever of them know each prefix."""
+    def __init__(self, lookups, weights):
+        self.lookups = list(zip(weights, lookups))
+    def __contains__(self, prefix):
+        return any(prefix in lookup for weight, lookup in self.lookups)
+    def __getitem__(self, prefix):
+        tables = [(weight, lookup[prefix]) for weight, lookup in self.lookups if prefix in lookup]
+        if not tables:
+            raise KeyError(prefix)
+        return MixedTable(tables)
+class MixedRemaining(object):
+    """Remaining characters of each state under any one of several models.
+    Every model's shortest way on is a walk the mix can take too, so the
+    fewest of them never leaves a budgeted walk stuck."""
+    def __init__(self, remainings, vocabularies):
+        self.remainings = list(zip(remainings, vocabularies))
+    def get(self, state):
+        best = None
+        for remaining, vocabulary in self.remainings:
+            ids = encode_prefix(state, vocabulary)
+            value = remaining.get(ids) if ids is not None else None
+            if value is not None and (best is None or value < best):
+                best = value
+        return best
+class MixedNGram(NGram):
+    """Generates from a weighted interpolation of several models, mixing
+    their tables a step at a time in tokens. No merged model is built, so
+    mixing costs no more memory than the models themselves."""
+    def __init__(self, generators, weights = None):
+        assert generators, "Nothing to mix"
+        weights = list(weights) if weights is not None else [1.0] * len(generators)
+        assert len(weights) == len(generators) and all(w > 0 for w in weights), "Weights must be positive"
+
+        # Store Relevant Data
+        self.generators     = list(generators)
+        self.weights        = weights
+        self.low            = max(g.low for g in generators)
+        self.high           = min(g.high for g in generators)
+        self.text           = None
+        self.pos            = False
+        self.remaining      = {}
+        self.lookup         = {n: MixedLookup([token_view(g.lookup[n], g.vocabulary, True) for g in generators],
+                weights) for n in range(self.low, self.high + 1)}
+        self.starter_grams  = {n: MixedTable([(w, token_view(g.starter_grams[n], g.vocabulary))
+                for w, g in zip(weights, generators)]) for n in range(self.low, self.high + 1)}
+    def footprint(self):
+        return sum(g.footprint() for g in self.generators)
+    def min_remaining(self, n, link_type = None):
+        if (n, link_type) not in self.remaining:
+            self.remaining[(n, link_type)] = MixedRemaining([g.min_remaining(n, link_type) for g in self.generators],
+                    [g.vocabulary for g in self.generators])
+        return self.remaining[(n, link_type)]
+    def copies(self, word_list):
+        return any(g.spans.copies(word_list) for g in self.generators)
+    def reverse_lookup(self):
+        if self.reverse is None:
+            self.reverse = {n: MixedLookup([token_view(g.reverse_lookup()[n], g.vocabulary, True)
+                    for g in self.generators], self.weights) for n in range(self.low, self.high + 1)}
+        return self.reverse
+    def reverse_remaining(self, n):
+        if self.backward is None:
+            self.backward = {}
+        if n not in self.backward:
+            self.backward[n] = MixedRemaining([g.reverse_remaining(n) for g in self.generators],
+                    [g.vocabulary for g in self.generators])
+        return self.backward[n]
+    def token_scores(self, token_lists):
+        # Each token scores the weighted mean of what the models score it
+        total = sum(self.weights)
+        models = [g.token_scores(token_lists) for g in self.generators]
+        return [[log(sum(w * exp(m[s][t]) for w, m in zip(self.weights, models)) / total)
+                for t in range(len(token_lists[s]))] for s in range(len(token_lists))]
+
+# Model Registry
+REGISTRY_BUDGET = 1 << 30
+class ModelRegistry(object):
+    """Named models loaded on first use and kept resident within budget
+    bytes of footprint, evicting the least recently used. Models are served
+    mapped from their model files, so an evicted model costs nothing but a
+    fresh mapping when it is next wanted. Safe to share across threads: a
+    model is loaded outside the lock, once, however many threads want it."""
+    def __init__(self, budget = REGISTRY_BUDGET):
+        self.budget = budget
+        self.sources = {}
+        self.resident = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+    def register(self, name, filename, n = 4, model = False, **params):
+        """Names a corpus to load with load_generator, or with model, a model
+        file to map with load_model."""
+        self.sources[name] = (filename, n, model, params)
+    def names(self):
+        return sorted(self.sources)
+    def high(self, name):
+        return self.sources[name][1]
+    def __contains__(self, name):
+        return name in self.sources
+    def __len__(self):
+        return len(self.resident)
+    def load(self, name):
+        filename, n, model, params = self.sources[name]
+        LOGGER.info("Loading %s from %s" % (name, filename))
+        if model:
+            return load_model(filename, n)
+        generator = load_generator(filename, n, **dict(params))
+        if not isinstance(generator, MappedNGram) and not params.get("pos"):
+            # Freshly built, served from the file just saved like every other model
+            generator = MappedNGram(cache_filename(filename))
+        return generator
+    def get(self, name):
+        if name not in self.sources:
+            raise KeyError(name)
+        with self.lock:
+            if name in self.resident:
+                self.resident.move_to_end(name)
+                METRICS.count("registry_hits")
+                return self.resident[name]
+            # Another thread loading it already is waited on rather than loading it again
+            loader = name not in self.loading
+            if loader:
+                self.loading[name] = Future()
+            future = self.loading[name]
+        if not loader:
+            return future.result()
+        METRICS.count("registry_loads")
+        try:
+            generator = self.load(name)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[name]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[name]
+            self.resident[name] = generator
+            self.evict()
+        future.set_result(generator)
+        return generator
+    def footprint(self):
+        return sum(generator.footprint() for generator in self.resident.values())
+    def evict(self):
+        # The model just used is never evicted, even when it alone is over budget
+        total = self.footprint()
+        while total > self.budget and len(self.resident) > 1:
+            name, generator = self.resident.popitem(last = False)
+            total -= generator.footprint()
+            LOGGER.info("Evicted %s, %d bytes resident" % (name, total))
+            METRICS.count("evictions")
+        METRICS.gauge("resident_models", len(self.resident))
+        METRICS.gauge("resident_bytes", total)
+    def mix(self, weights):
+        """A MixedNGram over the named models, weights mapping each name to its weight."""
+        names = list(weights)
+        return MixedNGram([self.get(name) for name in names], [weights[name] for name in names])
 
 def main():
     parser = get_arg_parser()
@@ -306,25 +3141,21 @@ def main():
     # Get Texts
     filename = args.texts_filename
     n = args.n
-    generator = None
-    if args.cache and os.path.isfile(cache_filename(filename)):
-        LOGGER.debug("Loading from cache at %s" % cache_filename(filename))
-        with open(cache_filename(filename), "rb") as file:
-            generator = pickle.load(file)
-    if generator == None or generator.high < n:
-        LOGGER.debug("Getting Text") if generator == None else LOGGER.debug(
-                "%d smaller than %d. Rebuilding." % (generator.high, n))
-        texts = []
-        raw = ""
-        for text in open_json(filename):
-            texts.append(text["text"])
-        raw = '\n'.join(texts)
-        for d in DELET:
-            raw = raw.replace(d,"")
-        generator = NGram(raw, high = n)
-        with open(cache_filename(filename), "wb") as file:
-            LOGGER.debug("Caching as %s" % cache_filename(filename))
-            pickle.dump(generator, file)
+    if args.model and args.pos:
+        parser.error("model files hold no tags, --pos needs the corpus")
+    if args.compact and (args.min_count or args.top_k or args.max_bytes):
+        parser.error("compact models can't be pruned")
+    if args.max_memory and (args.compact or args.pos or args.min_count or args.top_k or args.max_bytes):
+        parser.error("out-of-core builds keep every gram as counted, untagged")
+    if args.keyword and args.pos:
+        parser.error("--keyword walks words, not tags")
+    if args.model:
+        generator = load_model(filename, n)
+    else:
+        generator = load_generator(filename, n, args.cache, args.tokens, compact = args.compact, sampling = args.sampling,
+                jobs = args.jobs, tokenizer = args.tokenizer, pos = args.pos, min_counts = order_min_counts(args.min_count, n),
+                top_k = args.top_k, max_bytes = args.max_bytes, quantize = args.quantize,
+                max_memory = args.max_memory << 20 if args.max_memory else None)
 
     # Make a Sentence
     link_type = None
@@ -332,11 +3163,33 @@ def main():
         link_type = "last"
     if args.random:
         link_type = "random"
-    ngram_sentence = generator.make_ngram_sentence(n, link_type)
-    print(ngram_sentence)
+    seeds = lambda index: sentence_seed(args.seed, index) if args.seed is not None else None
+    if args.pos:
+        for index in range(args.count or 1):
+            print(generator.make_pos_sentence(n, seeds(index)))
+    elif args.pool:
+        for ngram_sentence in generator.make_best_sentences(args.count or 1, args.pool, n, link_type, args.max_chars,
+                args.min_chars, args.novel, args.seed, keyword = args.keyword):
+            print(ngram_sentence)
+    elif args.count is not None:
+        if args.jobs > 1:
+            sentences = generator.make_parallel_sentences(args.count, n, link_type, args.max_chars, args.min_chars,
+                    args.novel, args.seed, args.jobs, args.keyword)
+        else:
+            sentences = generator.make_ngram_sentences(args.count, n, link_type, args.max_chars, args.min_chars,
+                    args.novel, args.seed, args.keyword)
+        for ngram_sentence in sentences:
+            print(ngram_sentence)
+    else:
+        ngram_sentence = generator.make_ngram_sentence(n, link_type, args.max_chars, args.min_chars, args.novel,
+                seeds(0), args.keyword)
+        print(ngram_sentence)
+    if args.metrics:
+        METRICS.save(args.metrics)
     return 0
 
 if __name__ == "__main__":
+    configure_logging()
     LOGGER.info("Beginning Session")
     rtn = main()
     LOGGER.info("Ending Session")
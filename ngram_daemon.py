@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+
+# System
+import sys
+import os
+import socket
+import asyncio
+from argparse import ArgumentParser
+import json
+
+# NGram
+import ngram
+
+# Logging
+import logging
+LOGGER = logging.getLogger(__name__)
+SH = logging.StreamHandler()
+SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+LOGGER.setLevel(logging.DEBUG)
+
+DEFAULT_SOCKET = "ngram.sock"
+POOL_SIZE = 64
+REFILL_BATCH = 8
+REQUEST_TIMEOUT = 10.0
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+DESCRIPTION="""Keeps n-gram models loaded and serves pre-generated sentences from them."""
+def get_arg_parser():
+    parser = ArgumentParser(prog=sys.argv[0], description=DESCRIPTION)
+    parser.add_argument("-i", "--info",
+            action = "store_true",
+            help = "set console logging output to INFO")
+    parser.add_argument("-d", "--debug",
+            action = "store_true",
+            help = "set console logging output to DEBUG")
+    parser.add_argument("-q", "--quiet",
+            action = "store_true",
+            help = "set console logging output to ERROR (mostly quiet output)")
+    parser.add_argument(
+            metavar = "<text.json>",
+            dest = "texts_filenames",
+            nargs = "+",
+            help = "JSON corpora to load models for, served by file name without extension")
+    parser.add_argument("-s", "--socket",
+            default = DEFAULT_SOCKET,
+            help = "Unix socket to listen on (default: %s)" % DEFAULT_SOCKET)
+    parser.add_argument("-p", "--port",
+            type = int,
+            help = "listen on this localhost TCP port instead of a Unix socket")
+    parser.add_argument("--high",
+            type = int,
+            default = 4,
+            help = "largest n to load the models for (default: 4)")
+    parser.add_argument("--tokenizer",
+            choices = sorted(ngram.TOKENIZERS),
+            help = "how documents are split into tokens, should a model be built (default: the cached model's, "
+                "else word_tokenize)")
+    parser.add_argument("--pool-size",
+            type = int,
+            default = POOL_SIZE,
+            help = "sentences kept ready for each kind of request (default: %d)" % POOL_SIZE)
+    parser.add_argument("--budget",
+            type = int,
+            default = ngram.REGISTRY_BUDGET >> 20,
+            help = "megabytes of models kept resident, evicting the least recently used (default: %d)"
+                % (ngram.REGISTRY_BUDGET >> 20))
+    return parser
+
+def corpus_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+def mix_name(weights):
+    return "+".join("%s:%g" % (corpus, weight) for corpus, weight in sorted(weights.items()))
+
+class SentencePool(object):
+    """Sentences pre-generated for one kind of request, topped up by a
+    background task that generates in a worker thread whenever the queue
+    has room. source returns the generator afresh for every batch, so that
+    an idle model can be evicted from the registry."""
+    def __init__(self, source, n, link_type, max_chars, novel = False, size = POOL_SIZE):
+        self.source = source
+        self.n = n
+        self.link_type = link_type
+        self.max_chars = max_chars
+        self.novel = novel
+        self.queue = asyncio.Queue(size)
+        self.task = asyncio.ensure_future(self.refill())
+    def generate(self, count):
+        return list(self.source().make_ngram_sentences(count, self.n, self.link_type, self.max_chars,
+                novel = self.novel))
+    async def refill(self):
+        loop = asyncio.get_event_loop()
+        delay = RETRY_DELAY
+        while True:
+            count = max(min(REFILL_BATCH, self.queue.maxsize - self.queue.qsize()), 1)
+            try:
+                sentences = await loop.run_in_executor(None, self.generate, count)
+            except ValueError as e:
+                # Requests that can never be met get the error instead of waiting on a pool that won't fill
+                LOGGER.error("Stopped filling %d-Gram pool: %r" % (self.n, e))
+                await self.queue.put(e)
+                return
+            except Exception as e:
+                # Anything else, say a model failing to load or map, may well pass, so waiters keep waiting
+                LOGGER.error("Failed filling %d-Gram pool, retrying in %gs: %r" % (self.n, delay, e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            for sentence in sentences:
+                await self.queue.put(sentence)
+    async def get(self):
+        sentence = await self.queue.get()
+        if isinstance(sentence, Exception):
+            self.queue.put_nowait(sentence)
+            raise sentence
+        return sentence
+
+class SentenceServer(object):
+    """Answers one JSON request per line with a sentence from the matching
+    pool, creating pools on first request, or with the metrics when the
+    request asks for them. A request naming a mix, corpora to weights, is
+    generated from those corpora's models interpolated. A request with a
+    keyword is walked there and then, there being no pool for every word."""
+    def __init__(self, registry, pool_size = POOL_SIZE):
+        self.registry = registry
+        self.pool_size = pool_size
+        self.pools = {}
+    def source(self, request):
+        # The name, largest n and generator source the request is for
+        mix = request.get("mix")
+        if mix is not None:
+            if not mix:
+                raise ValueError("Nothing to mix")
+            weights = {corpus: float(weight) for corpus, weight in mix.items()}
+            for corpus, weight in weights.items():
+                if corpus not in self.registry:
+                    raise ValueError("Unknown corpus %s" % corpus)
+                if weight <= 0:
+                    raise ValueError("Weight of %s must be positive" % corpus)
+            return (mix_name(weights), min(self.registry.high(c) for c in weights),
+                    lambda: self.registry.mix(weights))
+        corpus = request.get("corpus")
+        names = self.registry.names()
+        if corpus is None and len(names) == 1:
+            corpus = names[0]
+        if corpus not in self.registry:
+            raise ValueError("Unknown corpus %s" % corpus)
+        return corpus, self.registry.high(corpus), lambda: self.registry.get(corpus)
+    def kind(self, request):
+        # The name and generator source the request is for, and how to walk its sentence
+        corpus, high, source = self.source(request)
+        n = int(request.get("n", 3))
+        link_type = request.get("link_type")
+        max_chars = request.get("max_chars")
+        novel = bool(request.get("novel", False))
+        if not 2 <= n <= high:
+            raise ValueError("n must be from 2 to %d" % high)
+        if link_type not in ngram.LINK_TYPES:
+            raise ValueError("Unknown link type %s" % link_type)
+        if max_chars is not None and (type(max_chars) is not int or max_chars < 1):
+            raise ValueError("max_chars must be a positive whole number")
+        return corpus, source, n, link_type, max_chars, novel
+    def pool(self, request):
+        corpus, source, n, link_type, max_chars, novel = self.kind(request)
+        key = (corpus, n, link_type, max_chars, novel)
+        if key not in self.pools:
+            LOGGER.info("Starting pool for %s" % (key,))
+            self.pools[key] = SentencePool(source, n, link_type, max_chars, novel, self.pool_size)
+        return self.pools[key]
+    async def reply(self, request):
+        corpus, source, n, link_type, max_chars, novel = self.kind(request)
+        keyword = str(request["keyword"])
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: next(source().make_ngram_sentences(1, n, link_type, max_chars,
+                novel = novel, keyword = keyword)))
+    def metrics(self, format = "json"):
+        for (corpus, n, link_type, max_chars, novel), pool in self.pools.items():
+            ngram.METRICS.gauge("pool_sentences", pool.queue.qsize(), corpus = corpus, n = n,
+                    link_type = str(link_type).lower(), max_chars = max_chars, novel = str(novel).lower())
+        if format == "prometheus":
+            return ngram.METRICS.prometheus()
+        return ngram.METRICS.snapshot()
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if "metrics" in request:
+                    response = {"metrics" : self.metrics(request["metrics"])}
+                elif request.get("keyword"):
+                    response = {"sentence" : await self.reply(request)}
+                else:
+                    response = {"sentence" : await self.pool(request).get()}
+            except (ValueError, TypeError, AttributeError) as e:
+                response = {"error" : str(e)}
+            except Exception as e:
+                LOGGER.error("Failed request %s: %r" % (line, e))
+                response = {"error" : repr(e)}
+            writer.write((json.dumps(response) + "\n").encode("utf-8"))
+            await writer.drain()
+        writer.close()
+
+def request(payload, path = DEFAULT_SOCKET, port = None, timeout = REQUEST_TIMEOUT):
+    """Sends one request to a running daemon and returns its response.
+    Raises OSError when no daemon answers and ValueError when it can't serve
+    the request."""
+    if port is not None:
+        connection = socket.create_connection(("127.0.0.1", port), timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(path)
+    with connection:
+        connection.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+        with connection.makefile("rb") as file:
+            line = file.readline()
+    if not line:
+        raise OSError("Daemon closed the connection")
+    response = json.loads(line.decode("utf-8"))
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response
+def request_sentence(n = 3, link_type = None, max_chars = None, corpus = None, novel = False, mix = None,
+        keyword = None, **connection):
+    # Pops a sentence from the daemon's pool for this kind of request, or has one walked with keyword in it
+    payload = {"corpus" : corpus, "n" : n, "link_type" : link_type, "max_chars" : max_chars, "novel" : novel}
+    if mix is not None:
+        payload["mix"] = mix
+    if keyword is not None:
+        payload["keyword"] = keyword
+    return request(payload, **connection)["sentence"]
+def request_metrics(format = "json", **connection):
+    return request({"metrics" : format}, **connection)["metrics"]
+
+async def serve(server, path, port):
+    if port is not None:
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", port)
+        LOGGER.info("Listening on 127.0.0.1:%d" % port)
+    else:
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = await asyncio.start_unix_server(server.handle, path)
+        LOGGER.info("Listening on %s" % path)
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    # Logging Information
+    if args.info:
+        SH.setLevel(logging.INFO)
+    if args.debug:
+        SH.setLevel(logging.DEBUG)
+    if args.quiet:
+        SH.setLevel(logging.ERROR)
+
+    registry = ngram.ModelRegistry(args.budget << 20)
+    for filename in args.texts_filenames:
+        registry.register(corpus_name(filename), filename, args.high, tokenizer = args.tokenizer)
+    for name in registry.names():
+        # Builds any stale model up front rather than on its first request
+        registry.get(name)
+    server = SentenceServer(registry, args.pool_size)
+    try:
+        asyncio.run(serve(server, args.socket, args.port))
+    except KeyboardInterrupt:
+        LOGGER.info("Interrupted")
+    finally:
+        if args.port is None and os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+if __name__ == "__main__":
+    ngram.configure_logging((LOGGER, SH))
+    LOGGER.info("Beginning Session")
+    rtn = main()
+    LOGGER.info("Ending Session")
+    sys.exit(rtn)
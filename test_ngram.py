@@ -0,0 +1,256 @@
+#! /usr/bin/env python3
+
+# System
+import sys
+import os
+import random
+import tempfile
+from collections import Counter
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+# NGram
+import ngram
+
+# Logging
+import logging
+LOGGER = logging.getLogger(__name__)
+SH = logging.StreamHandler()
+SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+LOGGER.setLevel(logging.DEBUG)
+LOGGER.addHandler(SH)
+
+DESCRIPTION="""Checks n-gram models built from small corpora behave as they should, printing any failures."""
+def get_arg_parser():
+    parser = ArgumentParser(prog=sys.argv[0], description=DESCRIPTION)
+    parser.add_argument("-i", "--info",
+            action = "store_true",
+            help = "set console logging output to INFO")
+    parser.add_argument("-d", "--debug",
+            action = "store_true",
+            help = "set console logging output to DEBUG")
+    return parser
+
+def check_backoff():
+    """A token scores the same whatever follows it, at the end of the
+    tokens or with more after it."""
+    failures = []
+    generator = ngram.NGram(["a b c . z b d .", "q z b e ."], 1, 3, tokenizer = "regex")
+    end, middle = generator.token_scores([["z", "b", "c"], ["z", "b", "c", "."]])
+    if abs(end[2] - middle[2]) > 1e-9:
+        failures.append("c after z b scored %.3f at the end, %.3f mid-sentence" % (end[2], middle[2]))
+    # z b c was never seen, b c once of the three times b was followed
+    expected = ngram.log(ngram.BACKOFF) + ngram.log(1 / 3)
+    if abs(middle[2] - expected) > 1e-9:
+        failures.append("c after z b scored %.3f mid-sentence, expected %.3f" % (middle[2], expected))
+    return failures
+
+WALL = ["We will build a wall . And Mexico will pay for the wall .",
+        "The wall will be great . They hate the wall . We love it !",
+        "Build that wall ! Who pays for the wall ? Mexico pays ."]
+def check_keyword():
+    """Sentences walked through a keyword hold it, and end once, on their
+    last token, even where the keyword was mostly seen ending a sentence."""
+    failures = []
+    generator = ngram.NGram(WALL, 1, 3, tokenizer = "regex")
+    for index in range(200):
+        words = generator.walk(3, None, None, None, verbose = False, rng = random.Random(index), keyword = "wall")
+        inner = [token for token in words[:-1] if token in generator.sentence_end]
+        if "wall" not in words or inner or words[-1] not in generator.sentence_end:
+            failures.append("walked %s" % " ".join(words))
+    return failures
+
+def check_max_chars():
+    """Every sentence walked with max_chars comes out no longer than that,
+    from counted, compact and mapped models alike."""
+    failures = []
+    documents = WALL + ["Mexico will pay for the wall , they say , and we will build it very high and very long ."]
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in ("counted", "compact", "mapped"):
+            generator = ngram.NGram(documents, 1, 3, compact = kind == "compact", tokenizer = "regex")
+            if kind == "mapped":
+                filename = os.path.join(directory, "wall.model")
+                ngram.save_model(generator, filename)
+                generator = ngram.MappedNGram(filename)
+            for n in (2, 3):
+                for link_type in ngram.LINK_TYPES:
+                    for max_chars in (12, 20, 30, 50):
+                        for sentence in generator.make_ngram_sentences(50, n, link_type, max_chars, seed = n):
+                            if len(sentence) > max_chars:
+                                failures.append("%s %d-Gram sentence linking %s over %d characters: %s" % (kind, n,
+                                        link_type, max_chars, sentence))
+    return failures
+
+SAMPLES = 4000
+def check_sampling():
+    """Cumulative and alias sampling both draw each successor as often as
+    it was counted after its prefix."""
+    failures = []
+    for sampling in ngram.SAMPLING:
+        generator = ngram.NGram(WALL, 1, 3, sampling = sampling, tokenizer = "regex")
+        for n, tables in generator.lookup.items():
+            for prefix, table in tables.items():
+                rng = random.Random(n)
+                drawn = Counter(ngram.sample(table, rng) for index in range(SAMPLES))
+                counts = dict(ngram.successors(table))
+                for gram in set(drawn) | set(counts):
+                    expected = counts.get(gram, 0) / table.total
+                    if abs(drawn[gram] / SAMPLES - expected) > 0.03:
+                        failures.append("%s sampled %s after %s %.3f of the time, expected %.3f" % (sampling,
+                                " ".join(gram), " ".join(prefix), drawn[gram] / SAMPLES, expected))
+    return failures
+
+def check_jobs():
+    """Models built across processes lay out the same model file as those
+    built in one, counted or compact, however the documents are sharded."""
+    failures = []
+    documents = WALL * 3 + ["Document %d says the wall is %d feet high ." % (d, d % 7) for d in range(60)]
+    shard_documents = ngram.shard_documents
+    # Shards of a few documents, so the counts of many are merged
+    ngram.shard_documents = lambda documents, size = 200: shard_documents(documents, size)
+    try:
+        for compact in (False, True):
+            serial = ngram.model_sections(ngram.NGram(documents, 1, 3, compact = compact, tokenizer = "regex"))
+            sharded = ngram.model_sections(ngram.NGram(documents, 1, 3, compact = compact, tokenizer = "regex", jobs = 2))
+            kind = "compact" if compact else "counted"
+            if serial[1] != sharded[1]:
+                failures.append("%s sentence ends %s serially, %s across jobs" % (kind, serial[1], sharded[1]))
+            for (name, data), (sharded_name, sharded_data) in zip(serial[0], sharded[0]):
+                if name != sharded_name or data != sharded_data:
+                    failures.append("%s section %s differs across jobs" % (kind, name))
+            if len(serial[0]) != len(sharded[0]):
+                failures.append("%s model has %d sections serially, %d across jobs" % (kind, len(serial[0]),
+                        len(sharded[0])))
+    finally:
+        ngram.shard_documents = shard_documents
+    return failures
+
+def check_spilling():
+    """A build counting out of core, spilling its counts to disk many times
+    over, saves the same model file as one built in memory."""
+    failures = []
+    documents = WALL + ["Writer %d says the wall is %d feet high and %d miles long ." % (d % 5, d, d * 7 % 11)
+            for d in range(300)]
+    with tempfile.TemporaryDirectory() as directory:
+        for quantize in (False, True):
+            memory = os.path.join(directory, "memory.model")
+            spilled = os.path.join(directory, "spilled.model")
+            ngram.save_model(ngram.NGram(documents, 1, 4, tokenizer = "regex", quantize = quantize), memory)
+            counter = ngram.SpillingCounter(1, 4, directory, 1 << 12)
+            counter.count(documents, "regex")
+            ngram.save_spilled_model(counter, spilled, tokenizer = "regex", quantize = quantize)
+            if counter.spilled < 10:
+                failures.append("only spilled %d times under a 4 KB cap" % counter.spilled)
+            with open(memory, "rb") as file, open(spilled, "rb") as other:
+                if file.read() != other.read():
+                    failures.append("spilled model%s differs from the one built in memory" %
+                            (" quantized" if quantize else ""))
+    return failures
+
+STUCK = [[". Loop and loop and loop around and around and around and stuck"], [". Loop and loop and loop"]]
+def check_no_end():
+    """Walks in a corpus whose starters can reach no sentence end, on a
+    prefix with no successors or round a loop, stop within MAX_STEPS steps,
+    or raise a ValueError when a limit on the characters can't be met, for
+    counted, compact and mapped models alike."""
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for documents in STUCK:
+            for kind in ("counted", "compact", "mapped"):
+                generator = ngram.NGram(documents, 1, 3, compact = kind == "compact", tokenizer = "regex")
+                if kind == "mapped":
+                    filename = os.path.join(directory, "stuck.model")
+                    ngram.save_model(generator, filename)
+                    generator = ngram.MappedNGram(filename)
+                for n in (2, 3):
+                    for link_type in ngram.LINK_TYPES:
+                        for max_chars in (None, 40):
+                            steps = ngram.METRICS.snapshot()["counters"].get("steps", 0)
+                            try:
+                                generator.walk(n, link_type, max_chars, None, verbose = False, rng = random.Random(n))
+                            except ValueError:
+                                pass
+                            steps = ngram.METRICS.snapshot()["counters"].get("steps", 0) - steps
+                            if steps > ngram.MAX_STEPS:
+                                failures.append("%s %d-Gram walk linking %s took %d steps in %s" % (kind, n, link_type,
+                                        steps, documents[0]))
+    return failures
+
+def put_documents(filename, documents):
+    with ngram.TokenCache(filename) as cache:
+        for document in documents:
+            cache.put(ngram.document_key(document, "regex"), ngram.regex_tokenize(document))
+
+def check_token_cache():
+    """Processes sharing a token cache lose none of each other's records,
+    and a record that can't be read is a miss rather than an error."""
+    failures = []
+    documents = ["Document %d from writer %d ." % (d, w) for w in range(4) for d in range(200)]
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "tokens.cache")
+        with Pool(4) as pool:
+            pool.starmap(put_documents, [(filename, documents[w::4]) for w in range(4)])
+        cache = ngram.TokenCache(filename)
+        missing = [d for d in documents if cache.get(ngram.document_key(d, "regex")) != ngram.regex_tokenize(d)]
+        if missing:
+            failures.append("%d of %d documents lost by writers sharing the cache" % (len(missing), len(documents)))
+        cache.close()
+        key = ngram.document_key(documents[0], "regex")
+        offset, length = cache.index[key]
+        with open(filename, "r+b") as file:
+            file.seek(offset)
+            file.write(b"\xff" * length)
+        with ngram.TokenCache(filename) as cache:
+            try:
+                tokens = cache.get(key)
+            except Exception as e:
+                tokens = e
+            if tokens is not None:
+                failures.append("read %r from a corrupt record" % (tokens,))
+            cache.put(key, ngram.regex_tokenize(documents[0]))
+        with ngram.TokenCache(filename) as cache:
+            if cache.get(key) != ngram.regex_tokenize(documents[0]):
+                failures.append("corrupt record not written over")
+    return failures
+
+ABBREVIATED = [
+        ("Mr. Trump met Sen. Cruz and Dr. Carson .", ["Mr.", "Trump", "met", "Sen.", "Cruz", "and", "Dr.", "Carson", "."]),
+        ("Made in the U.S. at 9 a.m. today .", ["Made", "in", "the", "U.S.", "at", "9", "a.m.", "today", "."]),
+        ("We win. Mr. Smith lost.", ["We", "win", ".", "Mr.", "Smith", "lost", "."]),
+        ]
+def check_abbreviations():
+    """The regex tokenizer keeps the dot of titles and dotted initialisms,
+    so only the dots ending sentences come apart."""
+    failures = []
+    for text, expected in ABBREVIATED:
+        tokens = ngram.regex_tokenize(text)
+        if tokens != expected:
+            failures.append("tokenized %r as %s" % (text, tokens))
+    return failures
+
+CHECKS = (check_backoff, check_keyword, check_max_chars, check_sampling, check_jobs, check_spilling, check_no_end,
+        check_token_cache, check_abbreviations)
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+    SH.setLevel(logging.ERROR)
+    if args.info:
+        SH.setLevel(logging.INFO)
+    if args.debug:
+        SH.setLevel(logging.DEBUG)
+    # Checks walk into dead ends and corrupt caches on purpose, which ngram logs only when asked
+    ngram.LOGGER.addHandler(SH if args.info or args.debug else logging.NullHandler())
+
+    failures = []
+    for check in CHECKS:
+        LOGGER.info("Running %s" % check.__name__)
+        failures.extend("%s: %s" % (check.__name__, failure) for failure in check())
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    if not failures:
+        print("All %d checks passed" % len(CHECKS))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    rtn = main()
+    sys.exit(rtn)
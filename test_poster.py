@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+
+# System
+import sys
+import os
+import re
+import time
+import tempfile
+import asyncio
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import json
+
+# Math
+import random
+
+# Data Structures
+from collections import defaultdict
+from collections import Counter
+
+# NGram
+import ngram
+import tweet_poster
+
+# Logging
+import logging
+LOGGER = logging.getLogger(__name__)
+SH = logging.StreamHandler()
+SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+LOGGER.setLevel(logging.DEBUG)
+LOGGER.addHandler(SH)
+
+DESCRIPTION="""Posts queued tweets from many accounts through tweet_poster to a local stub of the Twitter API
+that fails and rate limits requests, checking every tweet is posted exactly once."""
+def get_arg_parser():
+    parser = ArgumentParser(prog=sys.argv[0], description=DESCRIPTION)
+    parser.add_argument("-i", "--info",
+            action = "store_true",
+            help = "set console logging output to INFO")
+    parser.add_argument("-d", "--debug",
+            action = "store_true",
+            help = "set console logging output to DEBUG")
+    parser.add_argument("--accounts",
+            type = int,
+            default = 50,
+            help = "bot accounts to post from (default: 50)")
+    parser.add_argument("--apps",
+            type = int,
+            default = 5,
+            help = "apps the accounts are spread across (default: 5)")
+    parser.add_argument("--tweets",
+            type = int,
+            default = 10,
+            help = "tweets queued for each account (default: 10)")
+    parser.add_argument("--failures",
+            type = float,
+            default = 0.1,
+            help = "fraction of requests the stub answers 503 (default: 0.1)")
+    parser.add_argument("--lost",
+            type = float,
+            default = 0.05,
+            help = "fraction of posts the stub makes but answers 503, as if the answer was lost (default: 0.05)")
+    parser.add_argument("--quota",
+            type = int,
+            default = 4,
+            help = "posts each account may make in a window before the stub answers 429 (default: 4)")
+    parser.add_argument("--window",
+            type = float,
+            default = 1.0,
+            help = "seconds in a stub rate limit window (default: 1)")
+    parser.add_argument("--rate",
+            type = float,
+            default = 36000,
+            help = "tweets an hour the poster allows each account and app (default: 36000)")
+    parser.add_argument("--connections",
+            type = int,
+            default = tweet_poster.POOL_CONNECTIONS,
+            help = "HTTP connections the poster shares (default: %d)" % tweet_poster.POOL_CONNECTIONS)
+    return parser
+
+class StubAPI(BaseHTTPRequestHandler):
+    """Answers statuses/update as Twitter would, keeping connections alive,
+    failing requests at random and rate limiting each account's token."""
+    protocol_version = "HTTP/1.1"
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+    def respond(self, code, body, headers = {}):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    def do_POST(self):
+        server = self.server
+        body = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        token = re.search(r'oauth_token="([^"]*)"', self.headers.get("Authorization", ""))
+        if self.path != "/1.1/statuses/update.json":
+            return self.respond(404, {"errors" : [{"code" : 34, "message" : "Sorry, that page does not exist"}]})
+        if token is None:
+            return self.respond(400, {"errors" : [{"code" : 215, "message" : "Bad Authentication data."}]})
+        token, status = token.group(1), body["status"][0]
+        with server.lock:
+            server.requests += 1
+            if random.random() < server.failures:
+                return self.respond(503, {"errors" : [{"code" : 130, "message" : "Over capacity"}]})
+            now = time.time()
+            window = [t for t in server.windows[token] if t > now - server.window]
+            server.windows[token] = window
+            if len(window) >= server.quota:
+                server.limited += 1
+                reset = int(window[0] + server.window)
+                return self.respond(429, {"errors" : [{"code" : 88, "message" : "Rate limit exceeded"}]},
+                        {"X-Rate-Limit-Reset" : str(reset)})
+            if (token, status) in server.posted:
+                server.duplicates += 1
+                return self.respond(403, {"errors" : [{"code" : 187, "message" : "Status is a duplicate."}]})
+            window.append(now)
+            server.posted[(token, status)] = len(server.posted)
+            if random.random() < server.lost:
+                return self.respond(503, {"errors" : [{"code" : 131, "message" : "Internal error"}]})
+        self.respond(200, {"id_str" : str(server.posted[(token, status)]), "text" : status})
+    def log_message(self, format, *args):
+        LOGGER.debug("Stub:" + format % args)
+
+def start_stub(args):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAPI)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = server.requests = server.limited = server.duplicates = 0
+    server.windows = defaultdict(list)
+    server.posted = {}
+    server.failures, server.lost = args.failures, args.lost
+    server.quota, server.window = args.quota, args.window
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+    if args.quota < 1:
+        parser.error("--quota must let at least one post through a window")
+    tweet_poster.LOGGER.addHandler(SH)
+    SH.setLevel(logging.ERROR)
+    if args.info:
+        SH.setLevel(logging.INFO)
+    if args.debug:
+        SH.setLevel(logging.DEBUG)
+
+    # Retries are spaced for a stub, not for Twitter
+    tweet_poster.BACKOFF_BASE = 0.05
+    server = start_stub(args)
+    api_url = "http://127.0.0.1:%d/%%s" % server.server_address[1]
+    accounts = {"bot%d" % a : {"APP_KEY" : "app%d" % (a % args.apps), "APP_SECRET" : "secret",
+            "OAUTH_TOKEN" : "token%d" % a, "OAUTH_TOKEN_SECRET" : "secret"} for a in range(args.accounts)}
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = tweet_poster.Outbox(os.path.join(directory, "outbox.jsonl"))
+        for t in range(args.tweets):
+            for name in accounts:
+                outbox.put(name, "Tweet %d from %s" % (t, name))
+        queued = len(outbox)
+        LOGGER.info("Posting %d tweets from %d accounts" % (queued, len(accounts)))
+        start = time.time()
+        announced = Counter()
+        poster = tweet_poster.Poster(accounts, outbox, args.rate, tweet_poster.TWEET_BURST, args.connections, api_url,
+                lambda entry: announced.update([entry["id"]]))
+        left = asyncio.run(poster.run(once = True))
+        elapsed = time.time() - start
+        reread = len(tweet_poster.Outbox(outbox.filename))
+    server.shutdown()
+
+    counters = ngram.METRICS.snapshot()["counters"]
+    per_account = Counter(token for token, status in server.posted)
+    print("Posted %d of %d tweets in %.2fs (%.1f tweets/second)" % (len(server.posted), queued, elapsed,
+            len(server.posted) / elapsed))
+    print("%d requests over %d connections, %d rate limited, %d retried, %d duplicates caught" % (server.requests,
+            server.connections, server.limited, counters.get("post_retries", 0), server.duplicates))
+    failures = []
+    if left or reread:
+        failures.append("%d tweets left queued, %d after reading the outbox again" % (left, reread))
+    if len(server.posted) != queued or set(per_account.values()) != {args.tweets}:
+        failures.append("posted %d tweets, expected %d for each account" % (len(server.posted), args.tweets))
+    if len(announced) != queued or set(announced.values()) != {1}:
+        failures.append("announced %d posts of %d tweets, %d of them distinct" % (sum(announced.values()), queued, len(announced)))
+    if server.connections > args.connections:
+        failures.append("opened %d connections for a pool of %d" % (server.connections, args.connections))
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    rtn = main()
+    sys.exit(rtn)
@@ -3,9 +3,9 @@
 # System
 import sys
 import os
-import pickle
 from argparse import ArgumentParser
 import json
+import asyncio
 from pprint import pformat
 
 # Math
@@ -16,21 +16,15 @@ from collections import defaultdict
 
 # NGram
 import ngram
+import ngram_daemon
+import tweet_poster
 
 # Logging
 import logging
-from logging import handlers
 LOGGER = logging.getLogger(__name__)
 SH = logging.StreamHandler()
-FH = logging.handlers.RotatingFileHandler(os.path.splitext(sys.argv[0])[0] + ".log", maxBytes=5 * 1000000, backupCount = 5)
 SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
-FH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(lineno)s:%(funcName)s:%(message)s"))
 LOGGER.setLevel(logging.DEBUG)
-LOGGER.addHandler(SH)
-LOGGER.addHandler(FH)
-
-# Twitter
-from twython import *
 
 DESCRIPTION="""Generates ngrams based off of a corpus."""
 def get_arg_parser():
@@ -49,6 +43,23 @@ def get_arg_parser():
             metavar = "<text.json>",
             dest = "texts_filename",
             help = "JSON containing the texts to generate n-grams from")
+    parser.add_argument("-s", "--socket",
+            help = "take the sentence from an ngram_daemon.py listening on this Unix socket")
+    parser.add_argument("-p", "--posted",
+            default = tweet_poster.POSTED_FILENAME,
+            help = "file remembering every tweet posted, so none is posted twice (default: %s)" % tweet_poster.POSTED_FILENAME)
+    parser.add_argument("-o", "--outbox",
+            default = tweet_poster.OUTBOX_FILENAME,
+            help = "outbox the tweet is queued in until posted (default: %s)" % tweet_poster.OUTBOX_FILENAME)
+    parser.add_argument("--tokenizer",
+            choices = sorted(ngram.TOKENIZERS),
+            help = "how documents are split into tokens, should the model be built (default: the cached model's, "
+                "else word_tokenize)")
+    parser.add_argument("--keyword",
+            help = "tweet a sentence with this word in it, as a reply would")
+    parser.add_argument("--queue",
+            action = "store_true",
+            help = "only queue the tweet, for a running tweet_poster.py to post")
     return parser
 
 def save_as_json(object, filename, check = False):
@@ -68,53 +79,44 @@ def open_json(filename, check = False):
     with open(filename, "r") as file:
         return json.load(file)
 
-OAUTH_KEYS = ("APP_KEY","APP_SECRET","OAUTH_TOKEN","OAUTH_TOKEN_SECRET")
-def build_twitter(oauth):
-    return Twython(
-            oauth["APP_KEY"], oauth["APP_SECRET"],
-            oauth["OAUTH_TOKEN"], oauth["OAUTH_TOKEN_SECRET"]
-            )
-
-def cache_filename(filename):
-    return os.path.splitext(filename)[0] + "-ngram.pickle"
-
-def trump(filename):
-    # Get Texts
-    n = random.choice((2,3,4))
-    generator = None
-    if os.path.isfile(cache_filename(filename)):
-        LOGGER.debug("Loading from cache at %s" % cache_filename(filename))
-        with open(cache_filename(filename), "rb") as file:
-            generator = pickle.load(file)
-    if generator == None or generator.high < n:
-        LOGGER.debug("Getting Text") if generator == None else LOGGER.debug(
-                "%d smaller than %d. Rebuilding." % (generator.high, n))
-        texts = []
-        raw = ""
-        for text in open_json(filename):
-            texts.append(text["text"])
-        raw = '\n'.join(texts)
-        for d in ngram.DELET:
-            raw = raw.replace(d,"")
-        generator = ngram.NGram(raw, high = n)
-        with open(cache_filename(filename), "wb") as file:
-            LOGGER.debug("Caching as %s" % cache_filename(filename))
-            pickle.dump(generator, file)
-
-    # Make a Sentence
-    link_type = random.choice((None, "last", "random"))
+TWEET_CHARS = 140
+TWEET_TRIES = 10
+TWEET_POOL = 32
+TWEET_SECONDS = 2.0
+def trump(filename, socket_path = None, posted = None, keyword = None, tokenizer = None):
+    """Makes a tweet that copies no long run of the corpus and, with posted,
+    hasn't been posted before. Generated locally, it is the best scoring of
+    up to TWEET_POOL sentences walked within TWEET_SECONDS, from a model
+    built with tokenizer should it need building. With keyword, the tweet
+    has that word in it."""
     suffix = " @realDonaldTrump"
-    tweet = None
-    tries = 0
-    while True:
-        tries += 1
-        ngram_sentence = generator.make_ngram_sentence(n, link_type)
+    max_chars = TWEET_CHARS - len(suffix)
+    generators = {}
+    for _ in range(TWEET_TRIES):
+        n = random.choice((2,3,4))
+        link_type = random.choice((None, "last", "random"))
+
+        # Make a Sentence
+        ngram_sentence = None
+        if socket_path:
+            try:
+                ngram_sentence = ngram_daemon.request_sentence(n, link_type, max_chars,
+                        corpus = ngram_daemon.corpus_name(filename), novel = True, keyword = keyword, path = socket_path)
+            except OSError as e:
+                LOGGER.warning("No sentence from daemon at %s (%s), generating locally" % (socket_path, e))
+                socket_path = None
+        if ngram_sentence is None:
+            if n not in generators:
+                generators[n] = ngram.load_generator(filename, n, tokenizer = tokenizer)
+            ngram_sentence = generators[n].make_best_sentences(1, TWEET_POOL, n, link_type, max_chars, novel = True,
+                    seconds = TWEET_SECONDS, keyword = keyword)[0]
         tweet = ngram_sentence + suffix
-        if len(tweet) <= 140:
-            LOGGER.debug("Try %d: Made a tweet of length %d after" % (tries, len(tweet)))
+        if posted is None or tweet not in posted:
             break
-        else:
-            LOGGER.debug("Try %d: Tweet of %s chars is longer than %d" % (tries, len(tweet), 140))
+        LOGGER.info("Already posted:%s" % tweet)
+    else:
+        raise ValueError("Every one of %d tweets had been posted before" % TWEET_TRIES)
+    LOGGER.debug("Made a tweet of length %d" % len(tweet))
     print(tweet)
     return tweet
 
@@ -131,18 +133,28 @@ def main():
     if args.quiet:
         SH.setLevel(logging.ERROR)
 
-    oauth = open_json(args.oauth_filename)
-    if not oauth or any(key not in oauth for key in OAUTH_KEYS):
-        LOGGER.critical("Failed to open %s. Existing file required." % args.oauth_filename)
-    twitter = build_twitter(oauth)
+    accounts = tweet_poster.load_accounts([args.oauth_filename])
+    account = tweet_poster.account_name(args.oauth_filename)
 
     filename = args.texts_filename
-    tweet = trump(filename)
-    LOGGER.debug("Tweeting(%d chars):%s" % (len(tweet), tweet))
-    twitter.update_status(status=tweet)
+    posted = tweet_poster.PostedTweets(args.posted)
+    tweet = trump(filename, args.socket, posted, args.keyword, args.tokenizer)
+    LOGGER.debug("Queueing(%d chars):%s" % (len(tweet), tweet))
+    outbox = tweet_poster.Outbox(args.outbox)
+    outbox.put(account, tweet)
+    if args.queue:
+        return 0
+
+    # Posts this tweet and any an earlier run left queued, retrying what fails for a while,
+    # remembering each only once it is out
+    poster = tweet_poster.Poster(accounts, outbox, on_posted = lambda entry: posted.add(entry["status"]))
+    left = asyncio.run(poster.run(once = True))
+    if left:
+        LOGGER.warning("%d tweets left queued in %s for the next run" % (left, args.outbox))
     return 0
 
 if __name__ == "__main__":
+    ngram.configure_logging((LOGGER, SH))
     LOGGER.info("Beginning Session")
     try:
         rtn = main()
@@ -0,0 +1,454 @@
+#! /usr/bin/env python3
+
+# System
+import sys
+import os
+import fcntl
+import time
+import uuid
+import asyncio
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import hashlib
+
+# Math
+import random
+
+# Data Structures
+from collections import OrderedDict
+
+# NGram
+import ngram
+
+# Logging
+import logging
+LOGGER = logging.getLogger(__name__)
+SH = logging.StreamHandler()
+SH.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+LOGGER.setLevel(logging.DEBUG)
+
+# Twitter
+import requests
+from twython import *
+
+OUTBOX_FILENAME = "outbox.jsonl"
+# 300 tweets every 3 hours, for each account and for each app
+TWEET_RATE = 100
+TWEET_BURST = 5
+POOL_CONNECTIONS = 8
+POLL_SECONDS = 5.0
+POST_TRIES = 8
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 15 * 60
+# Longest rate limit reset a single pass waits out before leaving the tweet queued
+ONCE_WAIT_MAX = 60
+
+DESCRIPTION="""Posts the tweets queued in an outbox from many accounts at once, within their rate limits."""
+def get_arg_parser():
+    parser = ArgumentParser(prog=sys.argv[0], description=DESCRIPTION)
+    parser.add_argument("-i", "--info",
+            action = "store_true",
+            help = "set console logging output to INFO")
+    parser.add_argument("-d", "--debug",
+            action = "store_true",
+            help = "set console logging output to DEBUG")
+    parser.add_argument("-q", "--quiet",
+            action = "store_true",
+            help = "set console logging output to ERROR (mostly quiet output)")
+    parser.add_argument(
+            metavar = "<oauth.json>",
+            dest = "oauth_filenames",
+            nargs = "+",
+            help = "JSON authorizations of the accounts to post for, each named by file name without extension")
+    parser.add_argument("-o", "--outbox",
+            default = OUTBOX_FILENAME,
+            help = "outbox the tweets are queued in (default: %s)" % OUTBOX_FILENAME)
+    parser.add_argument("-p", "--posted",
+            default = POSTED_FILENAME,
+            help = "file remembering every tweet posted, shared with tweet_ngram.py (default: %s)" % POSTED_FILENAME)
+    parser.add_argument("--once",
+            action = "store_true",
+            help = "post what is already queued then exit, 1 if any is left queued, instead of watching the outbox")
+    parser.add_argument("--poll",
+            type = float,
+            default = POLL_SECONDS,
+            help = "seconds between checks of the outbox for new tweets (default: %g)" % POLL_SECONDS)
+    parser.add_argument("--rate",
+            type = float,
+            default = TWEET_RATE,
+            help = "tweets an hour allowed to each account and to each app (default: %d)" % TWEET_RATE)
+    parser.add_argument("--burst",
+            type = int,
+            default = TWEET_BURST,
+            help = "tweets that may go out at once after a quiet spell (default: %d)" % TWEET_BURST)
+    parser.add_argument("--connections",
+            type = int,
+            default = POOL_CONNECTIONS,
+            help = "HTTP connections shared by every account (default: %d)" % POOL_CONNECTIONS)
+    parser.add_argument("--compact",
+            action = "store_true",
+            help = "rewrite the outbox with only the tweets still queued first, while nothing else queues to it")
+    parser.add_argument("--api-url",
+            help = "post to this API instead of Twitter's, %%s standing for the API version")
+    return parser
+
+OAUTH_KEYS = ("APP_KEY","APP_SECRET","OAUTH_TOKEN","OAUTH_TOKEN_SECRET")
+def build_twitter(oauth):
+    return Twython(
+            oauth["APP_KEY"], oauth["APP_SECRET"],
+            oauth["OAUTH_TOKEN"], oauth["OAUTH_TOKEN_SECRET"]
+            )
+
+def account_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def load_accounts(filenames):
+    """The authorization in each file, by account name. Raises ValueError
+    for a file missing any of OAUTH_KEYS."""
+    accounts = {}
+    for filename in filenames:
+        with open(filename, "r") as file:
+            oauth = json.load(file)
+        missing = [key for key in OAUTH_KEYS if key not in oauth]
+        if missing:
+            raise ValueError("%s has no %s" % (filename, ", ".join(missing)))
+        accounts[account_name(filename)] = oauth
+    return accounts
+
+POSTED_FILENAME = "posted_tweets.dat"
+POSTED_DIGEST = 8
+class PostedTweets(object):
+    """Digests of every tweet posted, appended to a file so that the same
+    tweet is never posted twice, across runs. Case and spacing are ignored.
+    A digest cut short by a crash is dropped and written over. Any number
+    of processes may add to the same file, each taking in the digests the
+    others wrote when it adds."""
+    def __init__(self, filename = POSTED_FILENAME):
+        self.filename = filename
+        self.digests = set()
+        self.end = 0
+        if os.path.isfile(filename):
+            with open(filename, "rb") as file:
+                data = file.read()
+            self.end = len(data) - len(data) % POSTED_DIGEST
+            self.digests.update(data[offset:offset + POSTED_DIGEST] for offset in range(0, self.end, POSTED_DIGEST))
+        LOGGER.debug("Remembering %d posted tweets from %s" % (len(self.digests), filename))
+    @staticmethod
+    def digest(tweet):
+        text = " ".join(tweet.casefold().split())
+        return hashlib.blake2b(text.encode("utf-8"), digest_size = POSTED_DIGEST).digest()
+    def __len__(self):
+        return len(self.digests)
+    def __contains__(self, tweet):
+        return self.digest(tweet) in self.digests
+    def add(self, tweet):
+        digest = self.digest(tweet)
+        if digest in self.digests:
+            return
+        with open(self.filename, "a+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(self.end)
+            data = file.read()
+            whole = len(data) - len(data) % POSTED_DIGEST
+            self.digests.update(data[offset:offset + POSTED_DIGEST] for offset in range(0, whole, POSTED_DIGEST))
+            self.end += whole
+            if digest in self.digests:
+                return
+            file.truncate(self.end)
+            file.write(digest)
+        self.digests.add(digest)
+        self.end += POSTED_DIGEST
+
+class Outbox(object):
+    """Tweets waiting to be posted, each journaled as a line of JSON when it
+    is queued and again once it is posted or given up on, so a crash loses
+    none. Any number of processes may queue into the same file; each reads
+    the lines the others write on refresh. A line cut short by a crash is
+    skipped."""
+    def __init__(self, filename = OUTBOX_FILENAME):
+        self.filename = filename
+        self.pending = OrderedDict()
+        self.offset = 0
+        self.refresh()
+        LOGGER.debug("%d tweets queued in %s" % (len(self.pending), filename))
+    def __len__(self):
+        return len(self.pending)
+    def __iter__(self):
+        return iter(list(self.pending.values()))
+    def refresh(self):
+        # Only whole lines are read, the rest is left for the next refresh
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "rb") as file:
+            file.seek(self.offset)
+            data = file.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if not line:
+                continue
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                LOGGER.warning("Skipping torn outbox line: %r" % line[:80])
+                continue
+            if "status" in record:
+                self.pending[record["id"]] = record
+            else:
+                self.pending.pop(record["id"], None)
+        self.offset += end
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with open(self.filename, "a+b") as file:
+            end = file.seek(0, os.SEEK_END)
+            if end:
+                file.seek(end - 1)
+                if file.read(1) != b"\n":
+                    # Sets a line torn by a crash apart from this one
+                    line = b"\n" + line
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+    def put(self, account, status):
+        """Queues status to be posted from account, returning its ID."""
+        record = {"id" : uuid.uuid4().hex, "account" : account, "status" : status, "queued" : time.time()}
+        self.append(record)
+        self.pending[record["id"]] = record
+        return record["id"]
+    def posted(self, id, tweet_id = None):
+        self.append({"id" : id, "posted" : tweet_id})
+        self.pending.pop(id, None)
+    def failed(self, id, error):
+        self.append({"id" : id, "failed" : error})
+        self.pending.pop(id, None)
+    def compact(self):
+        """Rewrites the file with only the tweets still pending. Only safe
+        while no other process is queueing to it."""
+        self.refresh()
+        temporary = self.filename + ".tmp"
+        with open(temporary, "wb") as file:
+            for record in self.pending.values():
+                file.write((json.dumps(record) + "\n").encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.filename)
+        self.offset = os.path.getsize(self.filename)
+
+class TokenBucket(object):
+    """Lets rate calls a second through on average, in bursts of up to
+    burst, and none at all while blocked."""
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked = 0.0
+    def wait(self):
+        # Seconds until a call can go through, taking its token if it can now
+        now = time.monotonic()
+        if now < self.blocked:
+            return self.blocked - now
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+    async def take(self):
+        delay = self.wait()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.wait()
+    def blocked_for(self):
+        # Seconds until a block lifts
+        return max(self.blocked - time.monotonic(), 0)
+    def block(self, seconds):
+        # Nothing goes through for seconds, and the bucket refills from empty after
+        self.blocked = max(self.blocked, time.monotonic() + seconds)
+        self.tokens = 0
+        self.stamp = self.blocked
+
+def backoff(attempt):
+    # Exponential, with jitter so that accounts failing together retry apart
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+def reset_delay(reset):
+    # Seconds until the epoch second a rate limit resets at, or None when the API didn't say
+    try:
+        return max(float(reset) - time.time(), 0) + 1
+    except (TypeError, ValueError):
+        return None
+
+class Poster(object):
+    """Posts the tweets of an Outbox, a worker per account taking its tweets
+    in order as fast as the token buckets of the account and of its app
+    allow. Posting blocks, so it runs in a pool of threads, every account's
+    client sharing one pool of HTTP connections. Transient errors are
+    retried with exponential backoff, rate limits wait out the reset the API
+    gives, and any other error fails the tweet. With on_posted, it is
+    called with each entry once the tweet is out."""
+    def __init__(self, accounts, outbox, rate = TWEET_RATE, burst = TWEET_BURST, connections = POOL_CONNECTIONS,
+            api_url = None, on_posted = None):
+        self.outbox = outbox
+        self.on_posted = on_posted
+        self.adapter = requests.adapters.HTTPAdapter(pool_maxsize = connections, pool_block = True)
+        self.executor = ThreadPoolExecutor(connections)
+        self.clients = {}
+        self.buckets = {}
+        apps = {}
+        for name, oauth in accounts.items():
+            client = build_twitter(oauth)
+            client.client.mount("https://", self.adapter)
+            client.client.mount("http://", self.adapter)
+            if api_url is not None:
+                client.api_url = api_url
+            self.clients[name] = client
+            if oauth["APP_KEY"] not in apps:
+                apps[oauth["APP_KEY"]] = TokenBucket(rate / 3600, burst)
+            self.buckets[name] = (TokenBucket(rate / 3600, burst), apps[oauth["APP_KEY"]])
+        self.queues = {}
+        self.workers = {}
+        self.dispatched = set()
+        self.unknown = set()
+        self.wait_max = None
+    def pending(self):
+        # Tweets queued for these accounts and not yet posted
+        return sum(1 for entry in self.outbox if entry["account"] in self.clients)
+    async def post(self, entry):
+        """Posts one tweet, returning whether it is out of the outbox. One
+        still failing after POST_TRIES, or rate limited for longer than
+        wait_max, is left there for the next run."""
+        name, status = entry["account"], entry["status"]
+        client, buckets = self.clients[name], self.buckets[name]
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while attempt < POST_TRIES:
+            if self.wait_max is not None and max(bucket.blocked_for() for bucket in buckets) > self.wait_max:
+                LOGGER.warning("%s rate limited, leaving %s queued" % (name, entry["id"]))
+                return False
+            for bucket in buckets:
+                await bucket.take()
+            try:
+                response = await loop.run_in_executor(self.executor, lambda: client.update_status(status = status))
+            except TwythonRateLimitError as e:
+                delay = reset_delay(e.retry_after)
+                if delay is None:
+                    delay = backoff(attempt)
+                attempt += 1
+                ngram.METRICS.count("rate_limited")
+                LOGGER.warning("%s rate limited, waiting %.1fs" % (name, delay))
+                for bucket in buckets:
+                    bucket.block(delay)
+                continue
+            except TwythonAuthError as e:
+                LOGGER.error("%s can't post: %s" % (name, e))
+                self.outbox.failed(entry["id"], str(e))
+                ngram.METRICS.count("post_failures")
+                return True
+            except TwythonError as e:
+                if e.error_code == 403 and "duplicate" in str(e).lower():
+                    # An earlier try got through before its answer was lost
+                    LOGGER.info("%s already posted %s" % (name, entry["id"]))
+                    self.outbox.posted(entry["id"])
+                    if self.on_posted is not None:
+                        self.on_posted(entry)
+                    return True
+                if e.error_code is not None and e.error_code < 500:
+                    LOGGER.error("%s couldn't post %s: %s" % (name, entry["id"], e))
+                    self.outbox.failed(entry["id"], str(e))
+                    ngram.METRICS.count("post_failures")
+                    return True
+                delay = backoff(attempt)
+                attempt += 1
+                LOGGER.warning("%s failed to post (%s), retrying in %.1fs" % (name, e, delay))
+                ngram.METRICS.count("post_retries")
+                await asyncio.sleep(delay)
+                continue
+            self.outbox.posted(entry["id"], response.get("id_str") if isinstance(response, dict) else None)
+            LOGGER.debug("%s posted:%s" % (name, status))
+            ngram.METRICS.count("tweets_posted")
+            if self.on_posted is not None:
+                self.on_posted(entry)
+            return True
+        LOGGER.error("%s gave up on %s after %d tries, leaving it queued" % (name, entry["id"], POST_TRIES))
+        return False
+    async def work(self, name):
+        queue = self.queues[name]
+        while True:
+            entry = await queue.get()
+            try:
+                await self.post(entry)
+            finally:
+                queue.task_done()
+    def dispatch(self):
+        # Hands every newly queued tweet to its account's worker
+        self.outbox.refresh()
+        for entry in self.outbox:
+            name = entry["account"]
+            if entry["id"] in self.dispatched:
+                continue
+            if name not in self.clients:
+                if name not in self.unknown:
+                    LOGGER.warning("No authorization for %s, leaving its tweets queued" % name)
+                    self.unknown.add(name)
+                continue
+            if name not in self.queues:
+                self.queues[name] = asyncio.Queue()
+                self.workers[name] = asyncio.ensure_future(self.work(name))
+            self.dispatched.add(entry["id"])
+            self.queues[name].put_nowait(entry)
+    async def run(self, once = False, poll = POLL_SECONDS):
+        """Posts until cancelled, checking the outbox for new tweets every
+        poll seconds. With once, only posts what is already queued, returning
+        how many tweets are left queued for these accounts, not waiting out
+        a rate limit reset further away than ONCE_WAIT_MAX."""
+        self.wait_max = ONCE_WAIT_MAX if once else None
+        try:
+            while True:
+                self.dispatch()
+                if once:
+                    for queue in list(self.queues.values()):
+                        await queue.join()
+                    return self.pending()
+                await asyncio.sleep(poll)
+        finally:
+            for worker in self.workers.values():
+                worker.cancel()
+            self.workers, self.queues = {}, {}
+            self.executor.shutdown(wait = False)
+
+def main():
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    # Logging Information
+    if args.info:
+        SH.setLevel(logging.INFO)
+    if args.debug:
+        SH.setLevel(logging.DEBUG)
+    if args.quiet:
+        SH.setLevel(logging.ERROR)
+
+    accounts = load_accounts(args.oauth_filenames)
+    outbox = Outbox(args.outbox)
+    if args.compact:
+        outbox.compact()
+    posted = PostedTweets(args.posted)
+    poster = Poster(accounts, outbox, args.rate, args.burst, args.connections, args.api_url,
+            lambda entry: posted.add(entry["status"]))
+    LOGGER.info("Posting for %d accounts from %s" % (len(accounts), args.outbox))
+    try:
+        left = asyncio.run(poster.run(args.once, args.poll))
+    except KeyboardInterrupt:
+        LOGGER.info("Interrupted")
+        return 0
+    if left:
+        LOGGER.warning("%d tweets left queued" % left)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    ngram.configure_logging((LOGGER, SH))
+    LOGGER.info("Beginning Session")
+    rtn = main()
+    LOGGER.info("Ending Session")
+    sys.exit(rtn)